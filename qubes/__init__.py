@@ -31,6 +31,7 @@ import collections
 import os
 import os.path
 import string
+import weakref
 
 import lxml.etree
 import qubes.config
@@ -134,6 +135,39 @@ class Label:
             self.icon_dispvm) + ".png"
 
 
+class _DefaultDependencies:
+    # pylint: disable=too-few-public-methods
+    '''What a cached default value (see :py:meth:`property.get_default`) was
+    computed from'''
+    __slots__ = ('reads', 'cacheable')
+
+    def __init__(self):
+        #: holders by ``(id(holder), key)``, where *key* is a property
+        #: name, or ``'feature:'`` and a feature name (qubes hash by qid,
+        #: which is a property itself, so they cannot be hashed here)
+        self.reads = {}
+        #: :py:obj:`False` if something not tracked was read
+        self.cacheable = True
+
+
+# one for each cached default being computed, innermost last
+_default_dependencies = []
+
+
+def record_default_dependency(holder, key):
+    '''Note that the cached default being computed (if any) reads *key* of
+    *holder*
+
+    :py:class:`property` and :py:class:`qubes.features.Features` call this
+    on each read.
+
+    :param PropertyHolder holder: object being read
+    :param str key: property name, or ``'feature:'`` and a feature name
+    '''
+    if _default_dependencies:
+        _default_dependencies[-1].reads[id(holder), key] = holder
+
+
 class property:  # pylint: disable=redefined-builtin,invalid-name
     '''Qubes property.
 
@@ -159,6 +193,10 @@ class property:  # pylint: disable=redefined-builtin,invalid-name
     :param int order: order of evaluation (bigger order values are later)
     :param bool clone: :py:meth:`PropertyHolder.clone_properties` will not \
         include this property by default if :py:obj:`False`
+    :param bool cache_default: if :py:obj:`True`, the result of callable \
+        default may be kept until anything it was computed from changes (see \
+        :py:meth:`get_default`); use only for defaults computed solely from \
+        properties and features
     :param str doc: docstring; this should be one paragraph of plain RST, no \
         sphinx-specific features
 
@@ -191,7 +229,7 @@ class property:  # pylint: disable=redefined-builtin,invalid-name
 
     def __init__(self, name, setter=None, saver=None, type=None,
             default=_NO_DEFAULT, write_once=False, load_stage=2, order=0,
-            save_via_ref=False, clone=True,
+            save_via_ref=False, clone=True, cache_default=False,
             doc=None):
         # pylint: disable=redefined-builtin
         self.__name__ = name
@@ -211,6 +249,7 @@ class property:  # pylint: disable=redefined-builtin,invalid-name
         self.load_stage = load_stage
         self.save_via_ref = save_via_ref
         self.clone = clone
+        self.cache_default = cache_default
         self.__doc__ = doc
         self._attr_name = '_qubesprop_' + name
 
@@ -223,6 +262,10 @@ class property:  # pylint: disable=redefined-builtin,invalid-name
             raise AttributeError('qubes.property should be used on '
                 'qubes.PropertyHolder instances only')
 
+        if _default_dependencies:
+            _default_dependencies[-1].reads[id(instance), self.__name__] = \
+                instance
+
         try:
             return getattr(instance, self._attr_name)
 
@@ -230,12 +273,49 @@ class property:  # pylint: disable=redefined-builtin,invalid-name
             return self.get_default(instance)
 
     def get_default(self, instance):
+        '''Get default value of the property for *instance*
+
+        With :py:attr:`cache_default`, and if *instance* caches defaults
+        (see :py:meth:`PropertyHolder.enable_default_cache`), the value is
+        computed once, and properties and features read while computing it
+        are recorded. When any of them is set or deleted, the cached value is
+        dropped. If the computation reads a callable default which is not
+        cached, the result is not cached either, because it is not known what
+        that default was computed from.
+        '''
         if self._default is self._NO_DEFAULT:
             raise AttributeError(
                 'property {!r} have no default'.format(self.__name__))
-        if self._default_function:
+        if not self._default_function:
+            return self._default
+        # pylint: disable=protected-access
+        cache = instance._default_cache
+        if not self.cache_default or cache is None:
+            if _default_dependencies:
+                _default_dependencies[-1].cacheable = False
             return self._default_function(instance)
-        return self._default
+
+        try:
+            return cache[self.__name__]
+        except KeyError:
+            pass
+        dependencies = _DefaultDependencies()
+        _default_dependencies.append(dependencies)
+        try:
+            value = self._default_function(instance)
+        except Exception:
+            # there is no value to invalidate, so whatever handles this
+            # depends directly on what was read
+            if len(_default_dependencies) > 1:
+                _default_dependencies[-2].reads.update(dependencies.reads)
+            raise
+        finally:
+            _default_dependencies.pop()
+            if not dependencies.cacheable and _default_dependencies:
+                _default_dependencies[-1].cacheable = False
+        if dependencies.cacheable:
+            instance._cache_default(self.__name__, value, dependencies.reads)
+        return value
 
     def __set__(self, instance, value):
         self._enforce_write_once(instance)
@@ -291,6 +371,7 @@ class property:  # pylint: disable=redefined-builtin,invalid-name
                 delattr(instance, self._attr_name)
             except AttributeError:
                 pass
+            instance.invalidate_cached_defaults(self.__name__)
             instance.fire_event('property-del:' + self.__name__,
                 name=self.__name__, oldvalue=oldvalue)
 
@@ -298,6 +379,7 @@ class property:  # pylint: disable=redefined-builtin,invalid-name
             instance.fire_event('property-pre-del:' + self.__name__,
                 pre_event=True,
                 name=self.__name__)
+            instance.invalidate_cached_defaults(self.__name__)
             instance.fire_event('property-del:' + self.__name__,
                 name=self.__name__)
 
@@ -493,6 +575,19 @@ class PropertyHolder(qubes.events.Emitter):
     def __init__(self, xml, **kwargs):
         self.xml = xml
 
+        # see property.get_default()
+        #: cached defaults of own properties, by name, if enabled
+        self._default_cache = None
+        #: holders of cached defaults computed from a property or feature
+        #: of this object, by key given to invalidate_cached_defaults(), then
+        #: by (id(holder), name of the property); weak, so that holders
+        #: (like removed domains) are not kept alive by what they read
+        self._default_dependents = {}
+
+        # values from <property> nodes of self.xml, by load stage, see
+        # load_properties()
+        self._xml_property_values = None
+
         propvalues = {}
 
         all_names = self.property_dict()
@@ -508,8 +603,7 @@ class PropertyHolder(qubes.events.Emitter):
 
         if self.xml is not None:
             # check if properties are appropriate
-            for node in self.xml.xpath('./properties/property'):
-                name = node.get('name')
+            for name in self._index_xml_properties():
                 if name not in all_names:
                     raise TypeError(
                         'property {!r} not applicable to {!r}'.format(
@@ -574,7 +668,50 @@ class PropertyHolder(qubes.events.Emitter):
         '''
 
         # pylint: disable=protected-access
-        setattr(self, self.property_get_def(prop)._attr_name, value)
+        prop = self.property_get_def(prop)
+        setattr(self, prop._attr_name, value)
+        self.invalidate_cached_defaults(prop.__name__)
+
+    def enable_default_cache(self):
+        '''Keep values of defaults of properties, which have
+        :py:attr:`property.cache_default` set
+
+        See :py:meth:`property.get_default`.
+        '''
+        if self._default_cache is None:
+            self._default_cache = {}
+
+    def _cache_default(self, name, value, reads):
+        '''Keep default value of property *name*, computed from *reads*'''
+        self._default_cache[name] = value
+        for (_, key), holder in reads.items():
+            # pylint: disable=protected-access
+            dependents = holder._default_dependents.get(key)
+            if dependents is None:
+                dependents = holder._default_dependents[key] = \
+                    weakref.WeakValueDictionary()
+            dependents[id(self), name] = self
+
+    def invalidate_cached_defaults(self, key):
+        '''Drop cached defaults (see :py:meth:`property.get_default`)
+        computed from *key* of this object
+
+        Properties and features do this automatically, when they are set or
+        deleted.
+
+        :param str key: property name, or ``'feature:'`` and a feature name
+        '''
+        dependents = self._default_dependents.pop(key, None)
+        if not dependents:
+            return
+        for (_, name), holder in list(dependents.items()):
+            # pylint: disable=protected-access
+            if holder._default_cache is None:
+                # closed
+                continue
+            holder._default_cache.pop(name, None)
+            # and everything computed from that default
+            holder.invalidate_cached_defaults(name)
 
 
     def property_is_default(self, prop):
@@ -637,16 +774,34 @@ class PropertyHolder(qubes.events.Emitter):
 
         if self.xml is None:
             return
-        all_names = set(
-            prop.__name__ for prop in self.property_list(load_stage))
-        for node in self.xml.xpath('./properties/property'):
-            name = node.get('name')
-            value = node.get('ref') or node.text
+        if self._xml_property_values is None:
+            self._index_xml_properties()
+        for name, value in self._xml_property_values.get(load_stage, ()):
+            setattr(self, name, value)
 
-            if not name in all_names:
-                continue
+    def _index_xml_properties(self):
+        '''Read ``<property>`` nodes of :py:attr:`xml` for
+        :py:meth:`load_properties`
 
-            setattr(self, name, value)
+        XML is scanned only once, instead of once per load stage. Call this
+        again after modifying the nodes.
+
+        :returns: names of all the properties found, including unknown ones
+        '''
+
+        props = self.property_dict()
+        names = []
+        values = {None: []}
+        for node in self.xml.iterfind('properties/property'):
+            name = node.get('name')
+            names.append(name)
+            if name not in props:
+                continue
+            value = node.get('ref') or node.text
+            values[None].append((name, value))
+            values.setdefault(props[name].load_stage, []).append((name, value))
+        self._xml_property_values = values
+        return names
 
 
     def xml_properties(self, with_defaults=False):
@@ -743,6 +898,8 @@ class PropertyHolder(qubes.events.Emitter):
         # Remove all properties -- somewhere in them there are cyclic
         # references. This just removes all the properties, just in case.
         # They are removed directly, bypassing write_once.
+        self._default_cache = None
+        self._default_dependents.clear()
         for prop in self.property_list():
             # pylint: disable=protected-access
             try:
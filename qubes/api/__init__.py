@@ -20,6 +20,8 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import bisect
+import collections
 import errno
 import functools
 import io
@@ -27,8 +29,11 @@ import os
 import shutil
 import socket
 import struct
+import time
 import traceback
+import weakref
 
+import qubes.events
 import qubes.exc
 
 class ProtocolError(AssertionError):
@@ -95,6 +100,100 @@ def apply_filters(iterable, filters):
     return iterable
 
 
+class PermissionCache:
+    '''Cache of effects of admin-permission:... events
+
+    Effects are cached by source, method, destination and argument of the
+    call, only for events which have all the handlers marked as cacheable (see
+    :py:func:`qubes.ext.handler`); refusals are cached too. Everything is
+    dropped when a tag of any qube changes, when a qube is added or removed and
+    when class handlers change (like when an extension is loaded).
+    '''
+
+    #: caches, by app
+    caches = weakref.WeakKeyDictionary()
+
+    #: maximum number of cached decisions
+    max_size = 4096
+
+    def __init__(self):
+        #: effects of the event, or class and arguments of the exception it
+        #: raised, by (src, event, dest, arg)
+        self.decisions = collections.OrderedDict()
+        self.generation = qubes.events.dispatch_generation
+        #: number of events answered from the cache
+        self.hits = 0
+        #: number of events actually fired
+        self.misses = 0
+
+    @classmethod
+    def get(cls, app):
+        '''Get cache for the *app*, creating it if needed'''
+        try:
+            return cls.caches[app]
+        except KeyError:
+            pass
+        cache = cls.caches[app] = cls()
+        app.add_handler('domain-add', cache.on_domain_add)
+        app.add_handler('domain-delete', cache.on_domain_delete)
+        for vm in app.domains:
+            cache.add_vm_handlers(vm)
+        return cache
+
+    def fire_event(self, src, event, dest, arg):
+        '''Fire *event* on *src*, unless its effects are already known'''
+        if self.generation != qubes.events.dispatch_generation:
+            self.invalidate()
+            self.generation = qubes.events.dispatch_generation
+
+        key = (src, event, dest, arg)
+        try:
+            effects, exc = self.decisions[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.decisions.move_to_end(key)
+            if exc is not None:
+                # a new instance, not to pile up tracebacks on one
+                exc_type, exc_args = exc
+                raise exc_type(*exc_args)
+            return list(effects)
+
+        try:
+            effects = src.fire_event(event, pre_event=True, dest=dest, arg=arg)
+        except PermissionDenied as e:
+            self.store(key, (None, (type(e), e.args)))
+            raise
+        self.store(key, (tuple(effects), None))
+        return effects
+
+    def store(self, key, decision):
+        self.decisions[key] = decision
+        if len(self.decisions) > self.max_size:
+            self.decisions.popitem(last=False)
+
+    def invalidate(self, *args, **kwargs):
+        '''Drop all cached decisions'''
+        # pylint: disable=unused-argument
+        self.decisions.clear()
+
+    def add_vm_handlers(self, vm):
+        vm.add_handler('domain-tag-add:*', self.invalidate)
+        vm.add_handler('domain-tag-delete:*', self.invalidate)
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self.add_vm_handlers(vm)
+        self.invalidate()
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        vm.remove_handler('domain-tag-add:*', self.invalidate)
+        vm.remove_handler('domain-tag-delete:*', self.invalidate)
+        self.invalidate()
+
+
 class AbstractQubesAPI:
     '''Common code for Qubes Management Protocol handling
 
@@ -114,7 +213,8 @@ class AbstractQubesAPI:
     #: the preferred socket location (to be overridden in child's class)
     SOCKNAME = None
 
-    def __init__(self, app, src, method_name, dest, arg, send_event=None):
+    def __init__(self, app, src, method_name, dest, arg, send_event=None,
+            send_serialized_event=None):
         #: :py:class:`qubes.Qubes` object
         self.app = app
 
@@ -133,10 +233,14 @@ class AbstractQubesAPI:
         #: callback for sending events if applicable
         self.send_event = send_event
 
+        #: callback for sending events serialised with
+        #: :py:meth:`QubesDaemonProtocol.serialize_event`, if available
+        self.send_serialized_event = send_serialized_event
+
         #: is this operation cancellable?
         self.cancellable = False
 
-        candidates = list(self.list_methods(self.method))
+        candidates = self.get_method_registry().get(self.method, ())
 
         if not candidates:
             raise ProtocolError('no such method: {!r}'.format(self.method))
@@ -165,6 +269,26 @@ class AbstractQubesAPI:
                 if select_method is None or mname == select_method:
                     yield (func, mname, endpoint)
 
+    @classmethod
+    def get_method_registry(cls):
+        '''Return mapping of method names to candidates from
+        :py:meth:`list_methods`.
+
+        It is built on first use and then kept in the class, since walking all
+        the attributes on each call is expensive.
+        '''
+        # look only in the class itself, subclasses have their own methods
+        try:
+            return cls.__dict__['_method_registry']
+        except KeyError:
+            pass
+
+        registry = {}
+        for func, mname, endpoint in cls.list_methods():
+            registry.setdefault(mname, []).append((func, mname, endpoint))
+        cls._method_registry = registry
+        return registry
+
     def execute(self, *, untrusted_payload):
         '''Execute management operation.
 
@@ -185,8 +309,16 @@ class AbstractQubesAPI:
 
 
     def fire_event_for_permission(self, **kwargs):
-        '''Fire an event on the source qube to check for permission'''
-        return self.src.fire_event('admin-permission:' + self.method,
+        '''Fire an event on the source qube to check for permission
+
+        When all the handlers allow it, the effects are remembered in
+        :py:class:`PermissionCache`, unless there are additional *kwargs*.
+        '''
+        event = 'admin-permission:' + self.method
+        if not kwargs and self.src.event_cacheable(event):
+            return PermissionCache.get(self.app).fire_event(self.src, event,
+                self.dest, self.arg)
+        return self.src.fire_event(event,
             pre_event=True, dest=self.dest, arg=self.arg, **kwargs)
 
     def fire_event_for_filter(self, iterable, **kwargs):
@@ -201,13 +333,142 @@ class AbstractQubesAPI:
             raise PermissionDenied()
 
 
+class _MuxChannel(asyncio.Transport):
+    '''Transport of a single request multiplexed over a connection
+
+    Everything written is sent to the client in frames tagged with the request
+    id, :py:meth:`close` and :py:meth:`abort` end the request instead of the
+    connection.
+    '''
+
+    def __init__(self, protocol, request_id):
+        super().__init__()
+        self._protocol = protocol
+        self._request_id = request_id
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        if self._protocol.transport is None:
+            return default
+        return self._protocol.transport.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    def write(self, data):
+        if data and not self._closing:
+            self._protocol.mux_send(self._request_id,
+                self._protocol.MUX_DATA, data)
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        # the end of response is sent by close()
+        pass
+
+    def close(self):
+        self._finish(self._protocol.MUX_END)
+
+    def abort(self):
+        self._finish(self._protocol.MUX_ABORT)
+
+    def _finish(self, frame_type):
+        if self._closing:
+            return
+        self._closing = True
+        self._protocol.mux_finish(self._request_id, frame_type)
+
+
+class RequestStats:
+    '''Statistics of calls of a single method, see
+    :py:attr:`QubesDaemonProtocol.request_stats`'''
+    # pylint: disable=too-few-public-methods
+
+    #: upper bounds of latency histogram buckets, in seconds; there is one more
+    #: bucket for everything longer
+    latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        #: total time of all the calls, in seconds
+        self.time = 0.0
+        #: number of calls in each of :py:attr:`latency_buckets`
+        self.histogram = [0] * (len(self.latency_buckets) + 1)
+
+    def record(self, latency, success):
+        '''Account for a single call'''
+        self.count += 1
+        if not success:
+            self.errors += 1
+        self.time += latency
+        self.histogram[bisect.bisect_left(self.latency_buckets, latency)] += 1
+
+
 class QubesDaemonProtocol(asyncio.Protocol):
+    '''Protocol of qubesd sockets
+
+    By default, the client sends a single request
+    (``src\\0method\\0dest\\0arg\\0payload``) and closes its end of the
+    connection. The response is written back and then the connection is
+    closed.
+
+    A client which wants to make many calls can start the connection with
+    :py:attr:`mux_magic` instead. Then any number of requests can be sent, each
+    in a frame of :py:attr:`mux_request_header` (request id and length)
+    followed by the same request as above. Requests are handled concurrently
+    and responses are sent back in frames of :py:attr:`mux_response_header`
+    (request id, frame type and length), possibly interleaved. The content of
+    :py:attr:`MUX_DATA` frames is exactly what would be sent over a separate
+    connection. The response is complete with :py:attr:`MUX_END` frame, or
+    :py:attr:`MUX_ABORT` if the separate connection would be just aborted. An
+    empty request frame cancels the request with that id, like closing
+    the separate connection would do. The connection is closed after the
+    client closes its end, and all pending responses are sent.
+    '''
+
     buffer_size = 65536
     header = struct.Struct('Bx')
+
+    #: first bytes of a connection which multiplexes requests; it cannot be
+    #: mistaken for a request, as qube names cannot be empty
+    mux_magic = b'\0mux\0'
+    #: request id and length of request
+    mux_request_header = struct.Struct('!II')
+    #: request id, frame type and length of frame
+    mux_response_header = struct.Struct('!IBI')
+    #: frame type: part of response
+    MUX_DATA = 0
+    #: frame type: response is complete
+    MUX_END = 1
+    #: frame type: response is aborted
+    MUX_ABORT = 2
+
+    #: limits of the transport's write buffer; above the high one, events are
+    #: queued in :py:attr:`pending_events` until it drops below the low one
+    write_buffer_high = 256 * 1024
+    write_buffer_low = 64 * 1024
+    #: limit of size of :py:attr:`pending_events`, above which the client is
+    #: disconnected
+    max_pending_events_size = 4 * 1024 * 1024
+    #: events which only report the current state of something, so when
+    #: queued, only the latest one for each subject is kept
+    coalesced_events = ('property-pre-set:', 'property-set:',
+        'property-pre-del:', 'property-del:', 'domain-feature-set:',
+        'domain-feature-delete:', 'vm-stats')
+
     # keep track of connections, to gracefully close them at server exit
     # (including cleanup of integration test)
     connections = set()
 
+    #: :py:class:`RequestStats` of the calls, by method name; calls of unknown
+    #: methods are not counted
+    request_stats = {}
+
+    #: :py:class:`qubes.profiler.Profiler` currently running, if any
+    profiler = None
+
     def __init__(self, handler, *args, app, debug=False, **kwargs):
         super().__init__(*args, **kwargs)
         self.handler = handler
@@ -218,10 +479,27 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.debug = debug
         self.event_sent = False
         self.mgmt = None
+        #: :py:obj:`None` until it is known whether the connection
+        #: multiplexes requests
+        self.mux = None
+        #: protocols of pending multiplexed requests, by request id
+        self.mux_requests = {}
+        self.mux_eof = False
+        self.untrusted_mux_buffer = bytearray()
+        self.writing_paused = False
+        #: events waiting for the client to read the previous ones
+        self.pending_events = collections.OrderedDict()
+        self.pending_events_size = 0
+        self.pending_events_count = 0
 
     def connection_made(self, transport):
         self.transport = transport
         self.connections.add(self)
+        try:
+            transport.set_write_buffer_limits(
+                high=self.write_buffer_high, low=self.write_buffer_low)
+        except NotImplementedError:
+            pass
 
     def connection_lost(self, exc):
         self.untrusted_buffer.close()
@@ -230,8 +508,36 @@ class QubesDaemonProtocol(asyncio.Protocol):
             self.mgmt.cancel()
         self.transport = None
         self.connections.remove(self)
+        for protocol in list(self.mux_requests.values()):
+            protocol.connection_lost(exc)
+        self.mux_requests.clear()
+        self.pending_events.clear()
+        self.pending_events_size = 0
+
+    def pause_writing(self):
+        self.writing_paused = True
+        for protocol in self.mux_requests.values():
+            protocol.pause_writing()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.flush_pending_events()
+        for protocol in list(self.mux_requests.values()):
+            protocol.resume_writing()
+
+    def flush_pending_events(self):
+        '''Write queued events, until the transport's buffer is full again'''
+        while self.pending_events and not self.writing_paused \
+                and self.transport is not None:
+            _, data = self.pending_events.popitem(last=False)
+            self.pending_events_size -= len(data)
+            self.transport.write(data)
 
     def data_received(self, untrusted_data):  # pylint: disable=arguments-differ
+        if self.mux:
+            self.mux_data_received(untrusted_data)
+            return
+
         if self.len_untrusted_buffer + len(untrusted_data) > self.buffer_size:
             self.app.log.warning('request too long')
             self.transport.abort()
@@ -241,7 +547,78 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.len_untrusted_buffer += \
             self.untrusted_buffer.write(untrusted_data)
 
+        if self.mux is None:
+            untrusted_value = self.untrusted_buffer.getvalue()
+            if not self.mux_magic.startswith(
+                    untrusted_value[:len(self.mux_magic)]):
+                self.mux = False
+            elif len(untrusted_value) >= len(self.mux_magic):
+                self.mux = True
+                self.untrusted_buffer.close()
+                self.mux_data_received(untrusted_value[len(self.mux_magic):])
+
+    def mux_data_received(self, untrusted_data):
+        '''Handle data of connection which multiplexes requests'''
+        self.untrusted_mux_buffer += untrusted_data
+        header_size = self.mux_request_header.size
+        while len(self.untrusted_mux_buffer) >= header_size:
+            request_id, untrusted_length = \
+                self.mux_request_header.unpack_from(self.untrusted_mux_buffer)
+            if untrusted_length > self.buffer_size:
+                self.app.log.warning('request too long')
+                self.transport.abort()
+                return
+            length = untrusted_length
+            if len(self.untrusted_mux_buffer) < header_size + length:
+                break
+            untrusted_request = bytes(
+                self.untrusted_mux_buffer[header_size:header_size + length])
+            del self.untrusted_mux_buffer[:header_size + length]
+
+            if not untrusted_request:
+                # cancel
+                if request_id in self.mux_requests:
+                    self.mux_requests[request_id].transport.abort()
+                continue
+
+            if request_id in self.mux_requests:
+                self.app.log.warning('duplicate request id')
+                self.transport.abort()
+                return
+
+            protocol = type(self)(self.handler, app=self.app,
+                debug=self.debug)
+            protocol.mux = False
+            protocol.writing_paused = self.writing_paused
+            self.mux_requests[request_id] = protocol
+            protocol.connection_made(_MuxChannel(self, request_id))
+            protocol.data_received(untrusted_request)
+            protocol.eof_received()
+
+    def mux_send(self, request_id, frame_type, data=b''):
+        '''Send a frame of response to multiplexed request'''
+        if self.transport is None:
+            return
+        self.transport.write(self.mux_response_header.pack(
+            request_id, frame_type, len(data)) + data)
+
+    def mux_finish(self, request_id, frame_type):
+        '''Finish response to multiplexed request'''
+        self.mux_send(request_id, frame_type)
+        protocol = self.mux_requests.pop(request_id, None)
+        if protocol is not None:
+            # like the real transports do, let the protocol finish first
+            asyncio.get_event_loop().call_soon(protocol.connection_lost, None)
+        if self.mux_eof and not self.mux_requests \
+                and self.transport is not None:
+            self.transport.close()
+
     def eof_received(self):
+        if self.mux:
+            self.mux_eof = True
+            # keep the connection open for pending responses
+            return bool(self.mux_requests)
+
         try:
             src, meth, dest, arg, untrusted_payload = \
                 self.untrusted_buffer.getvalue().split(b'\0', 4)
@@ -259,14 +636,38 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
     @asyncio.coroutine
     def respond(self, src, meth, dest, arg, *, untrusted_payload):
+        start_time = time.monotonic()
+        success = yield from self._respond(src, meth, dest, arg,
+            untrusted_payload=untrusted_payload)
+        if self.mgmt is not None:
+            # known method, so it is a valid name
+            meth = meth.decode('ascii')
+            try:
+                stats = self.request_stats[meth]
+            except KeyError:
+                stats = self.request_stats[meth] = RequestStats()
+            stats.record(time.monotonic() - start_time, success)
+            if self.profiler is not None:
+                self.profiler.request_done()
+
+    @asyncio.coroutine
+    def _respond(self, src, meth, dest, arg, *, untrusted_payload):
+        '''Execute the call and send the response
+
+        :return: :py:obj:`True` if the call succeeded
+        '''
         try:
             self.mgmt = self.handler(self.app, src, meth, dest, arg,
-                self.send_event)
+                self.send_event,
+                send_serialized_event=self.send_serialized_event)
             response = yield from self.mgmt.execute(
                 untrusted_payload=untrusted_payload)
             assert not (self.event_sent and response)
+            # saving may be deferred (see Qubes.save_delay), but the change
+            # must be on disk before we report success
+            yield from self.app.wait_for_save()
             if self.transport is None:
-                return
+                return True
 
         # except clauses will fall through to transport.abort() below
 
@@ -294,7 +695,7 @@ class QubesDaemonProtocol(asyncio.Protocol):
                 self.send_exception(err)
                 self.transport.write_eof()
                 self.transport.close()
-            return
+            return False
 
         except Exception:  # pylint: disable=broad-except
             self.app.log.exception(
@@ -310,49 +711,102 @@ class QubesDaemonProtocol(asyncio.Protocol):
             except NotImplementedError:
                 pass
             self.transport.close()
-            return
+            return True
 
         # this is reached if from except: blocks; do not put it in finally:,
         # because this will prevent the good case from sending the reply
         if self.transport:
             self.transport.abort()
+        return False
 
     def send_header(self, *args):
         self.transport.write(self.header.pack(*args))
 
     def send_response(self, content):
         assert not self.event_sent
-        self.send_header(0x30)
-        if content is not None:
-            self.transport.write(content.encode('utf-8'))
+        if content is None:
+            self.send_header(0x30)
+        else:
+            # in one piece, so that multiplexed response is in one frame
+            self.transport.write(
+                self.header.pack(0x30) + content.encode('utf-8'))
 
     def send_event(self, subject, event, **kwargs):
         if self.transport is None:
             return
+        self.send_serialized_event(
+            self.serialize_event(self.app, subject, event, **kwargs),
+            self.coalesce_key(subject, event))
+
+    def send_serialized_event(self, data, coalesce_key=None):
+        '''Send event serialised with :py:meth:`serialize_event`
+
+        If the client does not keep up with reading, the event is queued,
+        replacing the queued one with the same *coalesce_key* (see
+        :py:meth:`coalesce_key`).
+        '''
+        if self.transport is None or self.transport.is_closing():
+            return
         self.event_sent = True
-        self.send_header(0x31)
 
-        if subject is not self.app:
-            self.transport.write(str(subject).encode('ascii'))
-        self.transport.write(b'\0')
+        if not self.writing_paused:
+            self.transport.write(data)
+            return
+
+        if coalesce_key is None:
+            self.pending_events_count += 1
+            coalesce_key = self.pending_events_count
+        else:
+            old_data = self.pending_events.pop(coalesce_key, None)
+            if old_data is not None:
+                self.pending_events_size -= len(old_data)
+        self.pending_events[coalesce_key] = data
+        self.pending_events_size += len(data)
+
+        if self.pending_events_size > self.max_pending_events_size:
+            self.app.log.warning(
+                'client does not read events, disconnecting '
+                '(%d events of %d bytes pending)',
+                len(self.pending_events), self.pending_events_size)
+            self.pending_events.clear()
+            self.pending_events_size = 0
+            self.transport.abort()
+
+    @classmethod
+    def coalesce_key(cls, subject, event):
+        '''Return key under which event is queued, if only the latest one
+        is needed, or :py:obj:`None`'''
+        if event.startswith(cls.coalesced_events):
+            return (str(subject), event)
+        return None
+
+    @classmethod
+    def serialize_event(cls, app, subject, event, **kwargs):
+        '''Serialise event, so it can be sent to many clients'''
+        data = [cls.header.pack(0x31)]
+        if subject is not app:
+            data.append(str(subject).encode('ascii'))
+        data.append(b'\0')
 
-        self.transport.write(event.encode('ascii') + b'\0')
+        data.append(event.encode('ascii') + b'\0')
 
         for k, v in kwargs.items():
-            self.transport.write('{}\0{}\0'.format(k, str(v)).encode('ascii'))
-        self.transport.write(b'\0')
+            data.append('{}\0{}\0'.format(k, str(v)).encode('ascii'))
+        data.append(b'\0')
+        return b''.join(data)
 
     def send_exception(self, exc):
-        self.send_header(0x32)
+        data = [self.header.pack(0x32)]
 
-        self.transport.write(type(exc).__name__.encode() + b'\0')
+        data.append(type(exc).__name__.encode() + b'\0')
 
         if self.debug:
-            self.transport.write(''.join(traceback.format_exception(
+            data.append(''.join(traceback.format_exception(
                 type(exc), exc, exc.__traceback__)).encode('utf-8'))
-        self.transport.write(b'\0')
+        data.append(b'\0')
 
-        self.transport.write(str(exc).encode('utf-8') + b'\0')
+        data.append(str(exc).encode('utf-8') + b'\0')
+        self.transport.write(b''.join(data))
 
 
 def cleanup_socket(sockpath, force):
@@ -25,6 +25,7 @@ import asyncio
 import functools
 import itertools
 import os
+import re
 import string
 import subprocess
 
@@ -35,44 +36,134 @@ import yaml
 
 import qubes.api
 import qubes.backup
+import qubes.batch
 import qubes.config
 import qubes.devices
+import qubes.events
 import qubes.firewall
 import qubes.storage
 import qubes.utils
 import qubes.vm
 import qubes.vm.adminvm
+import qubes.vm.dispvm
 import qubes.vm.qubesvm
 
 
-class QubesMgmtEventsDispatcher:
-    def __init__(self, filters, send_event):
+class QubesMgmtEventsSubscriber:
+    '''Single admin.Events call, subscribed to
+    :py:class:`QubesMgmtEventsHub`'''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, dest, filters, send_event, send_serialized_event=None):
+        #: qube which events are sent, or :py:obj:`None` for all the qubes
+        #: and the app
+        self.dest = dest
+        #: filters returned by admin-permission event
         self.filters = filters
         self.send_event = send_event
+        self.send_serialized_event = send_serialized_event
+
+
+class QubesMgmtEventsHub:
+    '''Dispatcher of events to all the admin.Events calls
+
+    It handles each event once, no matter how many calls are there, and if
+    it is to be sent to any of them, serialises it once.
+    '''
+
+    #: hubs with any subscribers, by app
+    hubs = {}
+
+    #: internal events of qubes, which are not sent
+    internal_event_prefixes = ('admin-permission:', 'device-get:',
+        'device-list:', 'device-list-attached:')
+    internal_events = ('domain-is-fully-usable',)
+
+    def __init__(self, app):
+        self.app = app
+        #: subscribers of events of all the qubes
+        self.subscribers = []
+        #: subscribers of events of a single qube, by the qube
+        self.vm_subscribers = {}
+
+    @classmethod
+    def subscribe(cls, app, subscriber):
+        '''Start sending events to *subscriber*'''
+        try:
+            hub = cls.hubs[app]
+        except KeyError:
+            hub = cls.hubs[app] = cls(app)
+            hub.add_handlers()
+
+        if subscriber.dest is None:
+            hub.subscribers.append(subscriber)
+        else:
+            hub.vm_subscribers.setdefault(subscriber.dest, []).append(
+                subscriber)
+
+    @classmethod
+    def unsubscribe(cls, app, subscriber):
+        '''Stop sending events to *subscriber*'''
+        hub = cls.hubs[app]
+        if subscriber.dest is None:
+            hub.subscribers.remove(subscriber)
+        else:
+            hub.vm_subscribers[subscriber.dest].remove(subscriber)
+            if not hub.vm_subscribers[subscriber.dest]:
+                del hub.vm_subscribers[subscriber.dest]
+
+        if not hub.subscribers and not hub.vm_subscribers:
+            hub.remove_handlers()
+            del cls.hubs[app]
+
+    def add_handlers(self):
+        self.app.add_handler('*', self.app_handler)
+        self.app.add_handler('domain-add', self.on_domain_add)
+        self.app.add_handler('domain-delete', self.on_domain_delete)
+        for vm in self.app.domains:
+            vm.add_handler('*', self.vm_handler)
+
+    def remove_handlers(self):
+        self.app.remove_handler('*', self.app_handler)
+        self.app.remove_handler('domain-add', self.on_domain_add)
+        self.app.remove_handler('domain-delete', self.on_domain_delete)
+        for vm in self.app.domains:
+            vm.remove_handler('*', self.vm_handler)
 
     def vm_handler(self, subject, event, **kwargs):
         # do not send internal events
-        if event.startswith('admin-permission:'):
-            return
-        if event.startswith('device-get:'):
-            return
-        if event.startswith('device-list:'):
-            return
-        if event.startswith('device-list-attached:'):
+        if event.startswith(self.internal_event_prefixes):
             return
-        if event in ('domain-is-fully-usable',):
+        if event in self.internal_events:
             return
 
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
-            return
-        self.send_event(subject, event, **kwargs)
+        subscribers = self.subscribers
+        if self.vm_subscribers and subject in self.vm_subscribers:
+            subscribers = subscribers + self.vm_subscribers[subject]
+        self.dispatch(subscribers, subject, event, kwargs)
+
+    # it has no effects on admin-permission events, so it should not prevent
+    # caching them (see qubes.api.PermissionCache)
+    vm_handler.ha_cacheable = True
 
     def app_handler(self, subject, event, **kwargs):
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
-            return
-        self.send_event(subject, event, **kwargs)
+        self.dispatch(self.subscribers, subject, event, kwargs)
+
+    def dispatch(self, subscribers, subject, event, kwargs):
+        '''Send event to those of *subscribers*, which filters accept it'''
+        data = None
+        for subscriber in list(subscribers):
+            if subscriber.filters and not list(qubes.api.apply_filters(
+                    [(subject, event, kwargs)], subscriber.filters)):
+                continue
+            if subscriber.send_serialized_event is None:
+                subscriber.send_event(subject, event, **kwargs)
+                continue
+            if data is None:
+                data = qubes.api.QubesDaemonProtocol.serialize_event(
+                    self.app, subject, event, **kwargs)
+                coalesce_key = qubes.api.QubesDaemonProtocol.coalesce_key(
+                    subject, event)
+            subscriber.send_serialized_event(data, coalesce_key)
 
     def on_domain_add(self, subject, event, vm):
         # pylint: disable=unused-argument
@@ -82,6 +173,210 @@ class QubesMgmtEventsDispatcher:
         # pylint: disable=unused-argument
         vm.remove_handler('*', self.vm_handler)
 
+class QubesVMStatsSubscriber:
+    '''Single admin.vm.Stats call, subscribed to
+    :py:class:`QubesVMStatsSampler`'''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, only_vm, filters, send_event,
+            send_serialized_event=None, every=1):
+        #: qube which stats are sent, or :py:obj:`None` for all the qubes
+        self.only_vm = only_vm
+        #: filters returned by admin-permission event
+        self.filters = filters
+        self.send_event = send_event
+        self.send_serialized_event = send_serialized_event
+        #: send only every n-th sample
+        self.every = every
+        #: number of samples taken, before the subscription
+        self.first_sample = None
+        #: future finished when sampling fails
+        self.done = asyncio.get_event_loop().create_future()
+
+
+class QubesVMStatsSampler:
+    '''Source of VM stats for all the admin.vm.Stats calls
+
+    It polls :py:meth:`qubes.app.QubesHost.get_vm_stats` once every
+    :py:attr:`qubes.app.Qubes.stats_interval`, no matter how many calls are
+    there, and sends the results to all of them.
+    '''
+
+    #: samplers with any subscribers, by app
+    samplers = {}
+
+    def __init__(self, app):
+        self.app = app
+        self.subscribers = []
+        #: VM names, by domain ID; :py:obj:`None` for domains which are not
+        #: qubes (like stubdomains)
+        self.id_to_name_map = {0: 'dom0'}
+        #: number of samples taken so far
+        self.samples = 0
+        #: stats to send, from the last sample
+        self.last_stats = []
+        self.task = None
+
+    @classmethod
+    def subscribe(cls, app, subscriber):
+        '''Start sending stats to *subscriber*'''
+        try:
+            sampler = cls.samplers[app]
+        except KeyError:
+            sampler = cls.samplers[app] = cls(app)
+            sampler.add_handlers()
+            sampler.task = asyncio.ensure_future(sampler.run())
+
+        subscriber.first_sample = sampler.samples
+        sampler.subscribers.append(subscriber)
+        # do not make a new call wait for the next sample
+        if sampler.samples:
+            subscriber.first_sample -= 1
+            sampler.dispatch([subscriber], sampler.last_stats)
+
+    @classmethod
+    def unsubscribe(cls, app, subscriber):
+        '''Stop sending stats to *subscriber*'''
+        sampler = cls.samplers.get(app)
+        if sampler is None or subscriber not in sampler.subscribers:
+            return
+        sampler.subscribers.remove(subscriber)
+        if not sampler.subscribers:
+            sampler.stop()
+            sampler.task.cancel()
+
+    def stop(self):
+        self.remove_handlers()
+        del self.samplers[self.app]
+
+    def add_handlers(self):
+        self.app.add_handler('domain-add', self.on_domain_add)
+        self.app.add_handler('domain-delete', self.on_domain_delete)
+        for vm in self.app.domains:
+            self.add_vm_handlers(vm)
+
+    def remove_handlers(self):
+        self.app.remove_handler('domain-add', self.on_domain_add)
+        self.app.remove_handler('domain-delete', self.on_domain_delete)
+        for vm in self.app.domains:
+            self.remove_vm_handlers(vm)
+
+    def add_vm_handlers(self, vm):
+        vm.add_handler('domain-start', self.on_domain_start)
+        vm.add_handler('domain-shutdown', self.on_domain_shutdown)
+
+    def remove_vm_handlers(self, vm):
+        vm.remove_handler('domain-start', self.on_domain_start)
+        vm.remove_handler('domain-shutdown', self.on_domain_shutdown)
+
+    @asyncio.coroutine
+    def run(self):
+        '''Take samples until all the subscribers are gone'''
+        info_time = None
+        info = None
+        while True:
+            try:
+                info_time, info = self.sample(info_time, info)
+            except Exception as e:  # pylint: disable=broad-except
+                for subscriber in self.subscribers:
+                    subscriber.done.set_exception(e)
+                self.subscribers.clear()
+                self.stop()
+                return
+            self.dispatch(self.subscribers, self.last_stats)
+            yield from asyncio.sleep(self.app.stats_interval)
+
+    def sample(self, info_time, info):
+        '''Take a single sample and store it in :py:attr:`last_stats`
+
+        :param info_time: time of previous sample
+        :param info: information retrieved in previous sample
+        :return: tuple(info_time, info) - new information (to be passed to
+        the next call)
+        '''
+        (info_time, info) = self.app.host.get_vm_stats(info_time, info)
+
+        # forget domains which are gone
+        for vm_id in list(self.id_to_name_map):
+            if vm_id not in info:
+                del self.id_to_name_map[vm_id]
+
+        stats = []
+        for vm_id, vm_info in info.items():
+            if vm_id not in self.id_to_name_map:
+                self.id_to_name_map[vm_id] = self.lookup_name(vm_id)
+            name = self.id_to_name_map[vm_id]
+
+            # skip VMs with unknown name
+            if name is None:
+                continue
+
+            stats.append((name, {
+                'memory_kb': int(vm_info['memory_kb']),
+                'cpu_time': int(vm_info['cpu_time'] / 1000000),
+                'cpu_usage': int(vm_info['cpu_usage']),
+            }))
+
+        self.samples += 1
+        self.last_stats = stats
+        return info_time, info
+
+    def lookup_name(self, vm_id):
+        '''Name of a domain which did not start while being sampled'''
+        try:
+            return self.app.vmm.libvirt_conn.lookupByID(vm_id).name()
+        except libvirt.libvirtError as err:
+            if err.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                # stubdomain or so
+                return None
+            raise
+
+    def dispatch(self, subscribers, stats):
+        '''Send *stats* to those of *subscribers*, which want this sample'''
+        subscribers = [subscriber for subscriber in subscribers
+            if (self.samples - subscriber.first_sample - 1) %
+                subscriber.every == 0]
+        if not subscribers:
+            return
+
+        for name, kwargs in stats:
+            data = None
+            for subscriber in subscribers:
+                if subscriber.only_vm is not None \
+                        and subscriber.only_vm.name != name:
+                    continue
+                if subscriber.filters and not list(qubes.api.apply_filters(
+                        [name], subscriber.filters)):
+                    continue
+                if subscriber.send_serialized_event is None:
+                    subscriber.send_event(name, 'vm-stats', **kwargs)
+                    continue
+                if data is None:
+                    data = qubes.api.QubesDaemonProtocol.serialize_event(
+                        self.app, name, 'vm-stats', **kwargs)
+                    coalesce_key = qubes.api.QubesDaemonProtocol.coalesce_key(
+                        name, 'vm-stats')
+                subscriber.send_serialized_event(data, coalesce_key)
+
+    def on_domain_start(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        xid = subject.xid
+        if xid >= 0:
+            self.id_to_name_map[xid] = subject.name
+
+    def on_domain_shutdown(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        for vm_id, name in list(self.id_to_name_map.items()):
+            if name == subject.name:
+                del self.id_to_name_map[vm_id]
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self.add_vm_handlers(vm)
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self.remove_vm_handlers(vm)
+
 
 class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     '''Implementation of Qubes Management API calls
@@ -169,7 +464,11 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission()
 
-        property_def = dest.property_get_def(self.arg)
+        return self._serialize_property(dest, self.arg)
+
+    @staticmethod
+    def _serialize_property(dest, name):
+        property_def = dest.property_get_def(name)
         # explicit list to be sure that it matches protocol spec
         if isinstance(property_def, qubes.vm.VMProperty):
             property_type = 'vm'
@@ -177,21 +476,88 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             property_type = 'int'
         elif property_def.type is bool:
             property_type = 'bool'
-        elif self.arg == 'label':
+        elif name == 'label':
             property_type = 'label'
         else:
             property_type = 'str'
 
         try:
-            value = getattr(dest, self.arg)
+            value = getattr(dest, name)
         except AttributeError:
             return 'default=True type={} '.format(property_type)
         else:
             return 'default={} type={} {}'.format(
-                str(dest.property_is_default(self.arg)),
+                str(dest.property_is_default(name)),
                 property_type,
                 str(value) if value is not None else '')
 
+    @qubes.api.method('admin.vm.property.GetAll', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_property_get_all(self):
+        '''Get values of all properties of a qube'''
+        return self._property_get_all(self.dest)
+
+    @qubes.api.method('admin.property.GetAll', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def property_get_all(self):
+        '''Get values of all global properties'''
+        self.enforce(self.dest.name == 'dom0')
+        return self._property_get_all(self.app)
+
+    def _property_get_all(self, dest):
+        self.enforce(not self.arg)
+
+        properties = self.fire_event_for_filter(dest.property_list())
+
+        return ''.join('{} {}\n'.format(name,
+                self._escape_value(self._serialize_property_entry(dest, name)))
+            for name in sorted(prop.__name__ for prop in properties))
+
+    @qubes.api.method('admin.vm.property.GetAllVMs', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def vm_property_get_all_vms(self):
+        '''Get values of all properties of all qubes
+
+        Qubes are filtered like in admin.vm.List.
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        domains = self.fire_event_for_filter(self.app.domains)
+
+        response = []
+        for vm in sorted(domains):
+            response.extend('{} {} {}\n'.format(vm.name, name,
+                    self._escape_value(self._serialize_property_entry(vm,
+                        name)))
+                for name in sorted(prop.__name__
+                    for prop in vm.property_list()))
+        return ''.join(response)
+
+    def _serialize_property_entry(self, dest, name):
+        '''Serialize property for one entry of a GetAll call
+
+        If getting the value fails, the entry reports the exception, like
+        admin.vm.property.Get would, as ``error=<exception class> <message>``.
+        '''
+        try:
+            return self._serialize_property(dest, name)
+        except qubes.exc.QubesException as err:
+            return 'error={} {}'.format(type(err).__name__, err)
+        except Exception as err:  # pylint: disable=broad-except
+            self.app.log.exception(
+                'unhandled exception while getting property %s of %s',
+                name, dest)
+            return 'error={} '.format(type(err).__name__)
+
+    @staticmethod
+    def _escape_value(value):
+        '''Escape value, so it fits in one line of response'''
+        return value.replace('\\', '\\\\').replace('\n', '\\n')
+
     @qubes.api.method('admin.vm.property.GetDefault', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -264,6 +630,101 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         setattr(dest, self.arg, newvalue)
         self.app.save()
 
+    @qubes.api.method('admin.vm.property.SetMany',
+        scope='global', write=True)
+    @asyncio.coroutine
+    def vm_property_set_many(self, untrusted_payload):
+        '''Set values of many properties of many qubes at once
+
+        The payload consists of ``qube property value`` lines, where the value
+        is escaped like in admin.vm.property.GetAll. All the values are
+        checked first, then set, and if setting any of them fails, the ones
+        already set are reverted. Each value is checked with the same
+        ``admin-permission`` event as admin.vm.property.Set would fire.
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        changes = []
+        for vm, name, untrusted_value in self._parse_set_many(
+                untrusted_payload):
+            if name not in vm.property_list():
+                raise qubes.exc.QubesNoSuchPropertyError(vm, name)
+
+            property_def = vm.property_get_def(name)
+            newvalue = property_def.sanitize(
+                untrusted_newvalue=untrusted_value)
+
+            self.src.fire_event('admin-permission:admin.vm.property.Set',
+                pre_event=True, dest=vm, arg=name, newvalue=newvalue)
+
+            try:
+                # pylint: disable=protected-access
+                oldvalue = getattr(vm, property_def._attr_name)
+            except AttributeError:
+                oldvalue = qubes.property.DEFAULT
+            changes.append((
+                functools.partial(setattr, vm, name, newvalue),
+                functools.partial(setattr, vm, name, oldvalue)))
+
+        self._apply_all(changes)
+        self.app.save()
+
+    def _parse_set_many(self, untrusted_payload):
+        '''Parse ``qube name value`` lines of SetMany calls'''
+        untrusted_lines = untrusted_payload.split(b'\n')
+        if untrusted_lines[-1] == b'':
+            del untrusted_lines[-1]
+        self.enforce(untrusted_lines)
+
+        for untrusted_line in untrusted_lines:
+            try:
+                untrusted_vmname, untrusted_name, untrusted_value = \
+                    untrusted_line.split(b' ', 2)
+            except ValueError:
+                raise qubes.api.ProtocolError('invalid line')
+            vmname = untrusted_vmname.decode('ascii', errors='strict')
+            if vmname not in self.app.domains:
+                raise qubes.exc.QubesVMNotFoundError(vmname)
+            # validation of the name is done by the caller
+            name = untrusted_name.decode('ascii', errors='strict')
+            yield (self.app.domains[vmname], name,
+                self._unescape_value(untrusted_value))
+
+    @staticmethod
+    def _unescape_value(untrusted_value):
+        '''Reverse :py:meth:`_escape_value`'''
+        def unescape(match):
+            if match.group(1) == b'n':
+                return b'\n'
+            if match.group(1) == b'\\':
+                return b'\\'
+            raise qubes.api.ProtocolError('invalid escape sequence')
+        return re.sub(rb'\\(.?)', unescape, untrusted_value, flags=re.DOTALL)
+
+    def _apply_all(self, changes):
+        '''Make all the *changes*, or none of them
+
+        Each change is a pair of functions, the first one makes the change and
+        the second one restores the state from before it.
+        '''
+        reverts = []
+        try:
+            for change, revert in changes:
+                # also when the change fails, as it might be partially done,
+                # for example when handler of the post-event raises
+                reverts.append(revert)
+                change()
+        except:
+            for revert in reversed(reverts):
+                try:
+                    revert()
+                except Exception:  # pylint: disable=broad-except
+                    self.app.log.exception('failed to revert change')
+            raise
+
     @qubes.api.method('admin.vm.property.Help', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -835,6 +1296,50 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             raise qubes.exc.QubesException('Start failed: ' + str(e) +
                 ', see /var/log/libvirt/libxl/libxl-driver.log for details')
 
+    @qubes.api.method('admin.vm.StartMany', scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_start_many(self, untrusted_payload):
+        '''Start qubes listed in the payload (one name per line), each one
+        after its network provider. The argument, if given, is the number of
+        qubes started concurrently.
+
+        Besides this call, ``admin.vm.Start`` needs to be allowed for each qube
+        to be started, including network providers started along.'''
+        self.enforce(not self.arg or (self.arg.isdigit() and int(self.arg) > 0))
+        self.enforce(self.dest.name == 'dom0')
+
+        vms = self._vm_list(untrusted_payload)
+
+        self.fire_event_for_permission(vms=vms)
+        # network providers started along are checked too
+        self._check_permission_each('admin.vm.Start',
+            qubes.batch.domains_to_start(vms))
+
+        failed = yield from qubes.batch.start_many(self.app, vms,
+            int(self.arg) if self.arg else qubes.batch.DEFAULT_CONCURRENCY)
+        if failed:
+            raise qubes.exc.QubesException(
+                'Failed to start: ' + qubes.batch.describe_failures(failed))
+
+    def _vm_list(self, untrusted_payload):
+        '''Qubes named in the payload, separated with whitespace'''
+        try:
+            untrusted_names = untrusted_payload.decode('ascii').split()
+        except UnicodeDecodeError:
+            raise qubes.api.ProtocolError('Invalid payload')
+        self.enforce(untrusted_names)
+        self.enforce(all(untrusted_name in self.app.domains
+            for untrusted_name in untrusted_names))
+        return [self.app.domains[name] for name in untrusted_names]
+
+    def _check_permission_each(self, method, vms):
+        '''Check permission for calling *method* on each of *vms*, so that
+        calls handling many qubes at once do not bypass restrictions placed on
+        their single-qube counterparts'''
+        for vm in sorted(vms):
+            self.src.fire_event('admin-permission:' + method, pre_event=True,
+                dest=vm, arg='')
+
 
     @qubes.api.method('admin.vm.Shutdown', no_payload=True,
         scope='local', execute=True)
@@ -844,6 +1349,52 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission()
         yield from self.dest.shutdown()
 
+    @qubes.api.method('admin.vm.ShutdownMany', scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_shutdown_many(self, untrusted_payload):
+        '''Shut down qubes listed in the payload (one name per line), each one
+        before its network provider. The argument, if given, is the time in
+        seconds after which qubes still running are killed.
+
+        Besides this call, ``admin.vm.Shutdown`` needs to be allowed for each
+        qube listed.'''
+        self.enforce(not self.arg or self.arg.isdigit())
+        self.enforce(self.dest.name == 'dom0')
+
+        vms = self._vm_list(untrusted_payload)
+
+        self.fire_event_for_permission(vms=vms)
+        self._check_permission_each('admin.vm.Shutdown', vms)
+
+        failed = yield from qubes.batch.shutdown_many(self.app, vms,
+            int(self.arg) if self.arg else None)
+        if failed:
+            raise qubes.exc.QubesException(
+                'Failed to shut down: ' + qubes.batch.describe_failures(failed))
+
+    @qubes.api.method('admin.vm.PhaseTimings', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_phase_timings(self):
+        '''Time spent in each phase of recent starts and shutdowns of the
+        qube, oldest first'''
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        response = []
+        # dom0 is never started
+        for timings in getattr(self.dest, 'phase_timings', ()):
+            response.append('{} time={:.6f} total={:.6f} result={}\n'.format(
+                timings.action, timings.time, timings.total, timings.result))
+            for name, offset, duration in timings.phases:
+                response.append('phase {} offset={:.6f} time={:.6f}\n'.format(
+                    name, offset, duration))
+            for name, duration in sorted(timings.handlers.items()):
+                response.append('handler {} time={:.6f}\n'.format(
+                    name, duration))
+        return ''.join(response)
+
     @qubes.api.method('admin.vm.Pause', no_payload=True,
         scope='local', execute=True)
     @asyncio.coroutine
@@ -881,15 +1432,10 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         # cache event filters, to not call an event each time an event arrives
         event_filters = self.fire_event_for_permission()
 
-        dispatcher = QubesMgmtEventsDispatcher(event_filters, self.send_event)
-        if self.dest.name == 'dom0':
-            self.app.add_handler('*', dispatcher.app_handler)
-            self.app.add_handler('domain-add', dispatcher.on_domain_add)
-            self.app.add_handler('domain-delete', dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.add_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.add_handler('*', dispatcher.vm_handler)
+        subscriber = QubesMgmtEventsSubscriber(
+            None if self.dest.name == 'dom0' else self.dest,
+            event_filters, self.send_event, self.send_serialized_event)
+        QubesMgmtEventsHub.subscribe(self.app, subscriber)
 
         # send artificial event as a confirmation that connection is established
         self.send_event(self.app, 'connection-established')
@@ -900,15 +1446,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             # the above waiting was already interrupted, this is all we need
             pass
 
-        if self.dest.name == 'dom0':
-            self.app.remove_handler('*', dispatcher.app_handler)
-            self.app.remove_handler('domain-add', dispatcher.on_domain_add)
-            self.app.remove_handler('domain-delete',
-                dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.remove_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.remove_handler('*', dispatcher.vm_handler)
+        QubesMgmtEventsHub.unsubscribe(self.app, subscriber)
 
     @qubes.api.method('admin.vm.feature.List', no_payload=True,
         scope='local', read=True)
@@ -1008,6 +1546,47 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.dest.features[self.arg] = value
         self.app.save()
 
+    @qubes.api.method('admin.vm.feature.SetMany',
+        scope='global', write=True)
+    @asyncio.coroutine
+    def vm_feature_set_many(self, untrusted_payload):
+        '''Set values of many features of many qubes at once
+
+        The payload is the same as for admin.vm.property.SetMany, and so is
+        the handling of failures. Each value is checked with the same
+        ``admin-permission`` event as admin.vm.feature.Set would fire.
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        changes = []
+        for vm, name, untrusted_value in self._parse_set_many(
+                untrusted_payload):
+            # unlike arguments, names in the payload are not validated by
+            # qrexec-policy
+            self.enforce(name and
+                all(c in string.ascii_letters + string.digits + '_.-'
+                    for c in name))
+            value = untrusted_value.decode('ascii', errors='strict')
+            del untrusted_value
+
+            self.src.fire_event('admin-permission:admin.vm.feature.Set',
+                pre_event=True, dest=vm, arg=name, value=value)
+
+            if name in vm.features:
+                revert = functools.partial(vm.features.__setitem__, name,
+                    vm.features[name])
+            else:
+                revert = functools.partial(vm.features.__delitem__, name)
+            changes.append((
+                functools.partial(vm.features.__setitem__, name, value),
+                revert))
+
+        self._apply_all(changes)
+        self.app.save()
+
     @qubes.api.method('admin.vm.Create.{endpoint}', endpoints=(ep.name
             for ep in pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT)),
         scope='global', write=True)
@@ -1124,9 +1703,9 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission(dispvm_template=dispvm_template)
 
-        dispvm = yield from qubes.vm.dispvm.DispVM.from_appvm(dispvm_template)
         # TODO: move this to extension (in race-free fashion, better than here)
-        dispvm.tags.add('disp-created-by-' + str(self.src))
+        dispvm = yield from qubes.vm.dispvm.DispVM.from_appvm(dispvm_template,
+            tags=['disp-created-by-' + str(self.src)])
 
         return dispvm.name
 
@@ -1529,55 +2108,15 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             skip_passphrase=True)
         return backup.get_backup_summary()
 
-    def _send_stats_single(self, info_time, info, only_vm, filters,
-            id_to_name_map):
-        '''A single iteration of sending VM stats
-
-        :param info_time: time of previous iteration
-        :param info: information retrieved in previous iteration
-        :param only_vm: send information only about this VM
-        :param filters: filters to apply on stats before sending
-        :param id_to_name_map: ID->VM name map, may be modified
-        :return: tuple(info_time, info) - new information (to be passed to
-        the next iteration)
-        '''
-
-        (info_time, info) = self.app.host.get_vm_stats(info_time, info,
-            only_vm=only_vm)
-        for vm_id, vm_info in info.items():
-            if vm_id not in id_to_name_map:
-                try:
-                    name = \
-                        self.app.vmm.libvirt_conn.lookupByID(vm_id).name()
-                except libvirt.libvirtError as err:
-                    if err.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                        # stubdomain or so
-                        name = None
-                    else:
-                        raise
-                id_to_name_map[vm_id] = name
-            else:
-                name = id_to_name_map[vm_id]
-
-            # skip VMs with unknown name
-            if name is None:
-                continue
-
-            if not list(qubes.api.apply_filters([name], filters)):
-                continue
-
-            self.send_event(name, 'vm-stats',
-                memory_kb=int(vm_info['memory_kb']),
-                cpu_time=int(vm_info['cpu_time'] / 1000000),
-                cpu_usage=int(vm_info['cpu_usage']))
-
-        return info_time, info
-
     @qubes.api.method('admin.vm.Stats', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
     def vm_stats(self):
-        self.enforce(not self.arg)
+        # optionally, send only every n-th sample
+        every = 1
+        if self.arg:
+            self.enforce(self.arg.isdigit() and int(self.arg) > 0)
+            every = int(self.arg)
 
         # run until client connection is terminated
         self.cancellable = True
@@ -1591,14 +2130,78 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.send_event(self.app, 'connection-established')
 
-        info_time = None
-        info = None
-        id_to_name_map = {0: 'dom0'}
+        subscriber = QubesVMStatsSubscriber(only_vm, stats_filters,
+            self.send_event, self.send_serialized_event, every=every)
+        QubesVMStatsSampler.subscribe(self.app, subscriber)
         try:
-            while True:
-                info_time, info = self._send_stats_single(info_time, info,
-                    only_vm, stats_filters, id_to_name_map)
-                yield from asyncio.sleep(self.app.stats_interval)
+            yield from subscriber.done
         except asyncio.CancelledError:
             # valid method to terminate this loop
             pass
+        finally:
+            QubesVMStatsSampler.unsubscribe(self.app, subscriber)
+
+    @qubes.api.method('admin.daemon.Stats', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def daemon_stats(self):
+        '''Report statistics of qubesd itself'''
+        self.enforce(not self.arg)
+        self.enforce(self.dest.name == 'dom0')
+
+        self.fire_event_for_permission()
+
+        try:
+            tasks = asyncio.all_tasks()
+        except AttributeError:
+            # Python < 3.7
+            tasks = asyncio.Task.all_tasks()  # pylint: disable=no-member
+
+        events_hub = QubesMgmtEventsHub.hubs.get(self.app)
+        events_subscribers = 0
+        if events_hub is not None:
+            events_subscribers = len(events_hub.subscribers) + sum(
+                len(subscribers)
+                for subscribers in events_hub.vm_subscribers.values())
+        stats_sampler = QubesVMStatsSampler.samplers.get(self.app)
+        permission_cache = qubes.api.PermissionCache.caches.get(self.app)
+
+        response = [
+            'connections {}\n'.format(
+                len(qubes.api.QubesDaemonProtocol.connections)),
+            'tasks {}\n'.format(sum(1 for task in tasks if not task.done())),
+            'events-subscribers {}\n'.format(events_subscribers),
+            'stats-subscribers {}\n'.format(
+                len(stats_sampler.subscribers) if stats_sampler else 0),
+            'permission-cache hits={} misses={}\n'.format(
+                permission_cache.hits if permission_cache else 0,
+                permission_cache.misses if permission_cache else 0),
+            'save count={} time={:.6f} coalesced={}\n'.format(
+                self.app.saves, self.app.save_time, self.app.saves_coalesced),
+        ]
+
+        for pool in sorted(qubes.vm.dispvm.DispVMPool.pools.values(),
+                key=lambda pool: pool.template.name):
+            if pool.template.app is not self.app:
+                continue
+            response.append(
+                'dispvm-pool {} size={} ready={} hits={} misses={} '
+                'hit-time={:.6f} miss-time={:.6f}\n'.format(
+                    pool.template.name,
+                    pool.configured_size(pool.template), len(pool.vms),
+                    pool.hits, pool.misses, pool.hit_time, pool.miss_time))
+
+        buckets = [str(bound) for bound in
+            qubes.api.RequestStats.latency_buckets] + ['inf']
+        for method, stats in sorted(
+                qubes.api.QubesDaemonProtocol.request_stats.items()):
+            response.append(
+                'method {} count={} errors={} time={:.6f} latency={}\n'.format(
+                    method, stats.count, stats.errors, stats.time,
+                    ','.join('{}:{}'.format(bound, count)
+                        for bound, count in zip(buckets, stats.histogram))))
+
+        for event, count in sorted(qubes.events.Emitter.event_counts.items()):
+            response.append('event {} {}\n'.format(event, count))
+
+        return ''.join(response)
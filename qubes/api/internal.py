@@ -26,6 +26,8 @@ import subprocess
 
 import qubes.api
 import qubes.api.admin
+import qubes.batch
+import qubes.profiler
 import qubes.vm.adminvm
 import qubes.vm.dispvm
 
@@ -81,6 +83,42 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         if not success:
             raise qubes.exc.QubesException('Data import failed')
 
+    @qubes.api.method('internal.Autostart', no_payload=True)
+    @asyncio.coroutine
+    def autostart(self):
+        '''
+        Start all VMs with autostart=True, called on host boot.
+
+        :return:
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        vms = [vm for vm in self.app.domains
+            if getattr(vm, 'autostart', False)]
+        failed = yield from qubes.batch.start_many(self.app, vms)
+        if failed:
+            raise qubes.exc.QubesException(
+                'Failed to start: ' + qubes.batch.describe_failures(failed))
+
+    @qubes.api.method('internal.ShutdownAll', no_payload=True)
+    @asyncio.coroutine
+    def shutdown_all(self):
+        '''
+        Shut down all VMs, called on host shutdown. The argument, if given,
+        is the time in seconds after which VMs still running are killed.
+
+        :return:
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg or self.arg.isdigit())
+
+        failed = yield from qubes.batch.shutdown_many(self.app,
+            list(self.app.domains), int(self.arg) if self.arg else None)
+        if failed:
+            raise qubes.exc.QubesException(
+                'Failed to shut down: ' + qubes.batch.describe_failures(failed))
+
     @qubes.api.method('internal.SuspendPre', no_payload=True)
     @asyncio.coroutine
     def suspend_pre(self):
@@ -164,3 +202,31 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         # FIXME: some timeout?
         if processes:
             yield from asyncio.wait([p.wait() for p in processes])
+
+    @qubes.api.method('internal.daemon.Profile')
+    @asyncio.coroutine
+    def daemon_profile(self, untrusted_payload):
+        '''
+        Profile qubesd, until given time passes or given number of requests
+        is served. The argument is kind of profiler (see
+        :py:mod:`qubes.profiler`), the payload is either ``seconds=N`` or
+        ``requests=N``.
+
+        :return: path of the file with results
+        '''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(self.arg in qubes.profiler.PROFILERS)
+
+        try:
+            limit, value = untrusted_payload.decode('ascii').strip().split('=')
+            value = int(value)
+        except ValueError:
+            raise qubes.api.ProtocolError('Invalid payload')
+        self.enforce(limit in ('seconds', 'requests'))
+        self.enforce(value > 0)
+
+        # stop early when the client disconnects
+        self.cancellable = True
+
+        profiler = qubes.profiler.PROFILERS[self.arg](**{limit: value})
+        return (yield from qubes.profiler.profile(profiler))
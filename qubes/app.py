@@ -59,6 +59,7 @@ else:
 # pylint: disable=wrong-import-position
 import qubes
 import qubes.ext
+import qubes.journal
 import qubes.utils
 import qubes.storage
 import qubes.storage.reflink
@@ -378,11 +379,30 @@ class VMCollection:
         self.app = app
         self._dict = dict()
 
+        #: name -> VM index
+        self._name_index = {}
+        #: uuid -> VM index
+        self._uuid_index = {}
+
+        # cached iteration orders, see qids() and vms()
+        self._sorted_qids = None
+        self._sorted_vms_qids = None
+
+        #: property -> (VM -> target, target -> set of VMs) indexes, see
+        #: get_dependents()
+        self._dependents = {}
+
 
     def close(self):
         del self.app
+        for vm in self._dict.values():
+            self._unsubscribe_vm(vm)
         self._dict.clear()
         del self._dict
+        self._name_index.clear()
+        self._uuid_index.clear()
+        self._invalidate_order()
+        self._dependents.clear()
 
 
     def __repr__(self):
@@ -402,7 +422,9 @@ class VMCollection:
         qids are sorted by numerical order.
         '''
 
-        return iter(sorted(self._dict.keys()))
+        if self._sorted_qids is None:
+            self._sorted_qids = sorted(self._dict.keys())
+        return iter(self._sorted_qids)
 
     keys = qids
 
@@ -422,11 +444,99 @@ class VMCollection:
         vms are sorted by qid.
         '''
 
-        return iter(sorted(self._dict.values()))
+        if self._sorted_vms_qids is None:
+            self._sorted_vms_qids = [vm.qid
+                for vm in sorted(self._dict.values())]
+        # take a snapshot, so the collection can be modified while iterating
+        return iter([self._dict[qid] for qid in self._sorted_vms_qids])
 
     __iter__ = vms
     values = vms
 
+    def _invalidate_order(self):
+        self._sorted_qids = None
+        self._sorted_vms_qids = None
+
+    def _subscribe_vm(self, vm):
+        vm.add_handler('property-set:name', self._on_property_set_identity)
+        vm.add_handler('property-set:uuid', self._on_property_set_identity)
+
+    def _unsubscribe_vm(self, vm):
+        try:
+            vm.remove_handler('property-set:name',
+                self._on_property_set_identity)
+            vm.remove_handler('property-set:uuid',
+                self._on_property_set_identity)
+        except KeyError:
+            # put into the collection behind our back
+            pass
+
+    def _on_property_set_identity(self, subject, event, name, newvalue,
+            oldvalue=None):
+        # pylint: disable=unused-argument
+        self.update_index(subject, name, oldvalue)
+
+    def _index_vm(self, vm):
+        self._name_index[vm.name] = vm
+        try:
+            self._uuid_index[vm.uuid] = vm
+        except AttributeError:
+            # uuid is assigned later, see QubesVM.on_domain_init_loaded()
+            pass
+
+    def _unindex_vm(self, vm):
+        if self._name_index.get(vm.name) is vm:
+            del self._name_index[vm.name]
+        try:
+            if self._uuid_index.get(vm.uuid) is vm:
+                del self._uuid_index[vm.uuid]
+        except AttributeError:
+            pass
+
+    def update_index(self, vm, name, oldvalue=None):
+        '''Update indexes after change of VM's identifying property.
+
+        This is called from ``property-set:name`` and ``property-set:uuid``
+        handlers, which the collection adds to each VM it holds.
+
+        :param qubes.vm.BaseVM vm: VM which has changed
+        :param str name: name of the property (``'name'`` or ``'uuid'``)
+        :param oldvalue: old value of the property, if any
+        '''
+
+        if self._dict.get(vm.qid) is not vm:
+            # not (yet) in this collection
+            return
+        index = self._name_index if name == 'name' else self._uuid_index
+        if oldvalue is not None and index.get(oldvalue) is vm:
+            del index[oldvalue]
+        index[getattr(vm, name)] = vm
+        if name == 'name':
+            self._invalidate_order()
+
+    def _lookup(self, index, attr, key):
+        '''Find VM by indexed attribute'''
+        vm = index.get(key)
+        if vm is not None and self._dict.get(vm.qid) is vm \
+                and getattr(vm, attr) == key:
+            return vm
+        if vm is None and len(index) == len(self._dict):
+            raise KeyError(key)
+
+        # the collection was modified behind our back, rebuild the indexes
+        self._reindex()
+        try:
+            return index[key]
+        except KeyError:
+            raise KeyError(key) from None
+
+    def _reindex(self):
+        self._name_index.clear()
+        self._uuid_index.clear()
+        for vm in self._dict.values():
+            self._index_vm(vm)
+        self._invalidate_order()
+
     def add(self, value, _enable_events=True):
         '''Add VM to collection
 
@@ -445,11 +555,19 @@ class VMCollection:
             raise ValueError('This collection already holds VM that has '
                 'qid={!r} ({!r})'.format(value.qid, self[value.qid]))
         if value.name in self:
-
             raise ValueError('A VM named {!s} already exists'
                 .format(value.name))
 
         self._dict[value.qid] = value
+        self._index_vm(value)
+        self._subscribe_vm(value)
+        self._invalidate_order()
+        if _enable_events:
+            for prop in self._dependents:
+                self._set_dependency(prop, value, getattr(value, prop, None))
+        else:
+            # properties are loaded later, with events disabled
+            self.invalidate_dependents()
         if _enable_events:
             value.events_enabled = True
             self.app.fire_event('domain-add', vm=value)
@@ -461,19 +579,13 @@ class VMCollection:
             return self._dict[key]
 
         if isinstance(key, str):
-            for vm in self:
-                if vm.name == key:
-                    return vm
-            raise KeyError(key)
+            return self._lookup(self._name_index, 'name', key)
 
         if isinstance(key, qubes.vm.BaseVM):
             key = key.uuid
 
         if isinstance(key, uuid.UUID):
-            for vm in self:
-                if vm.uuid == key:
-                    return vm
-            raise KeyError(key)
+            return self._lookup(self._uuid_index, 'uuid', key)
 
         raise KeyError(key)
 
@@ -492,21 +604,141 @@ class VMCollection:
                 # already undefined
                 pass
         del self._dict[vm.qid]
+        self._unindex_vm(vm)
+        self._unsubscribe_vm(vm)
+        self._invalidate_order()
+        for prop in self._dependents:
+            self._set_dependency(prop, vm, None)
+            self._dependents[prop][0].pop(vm, None)
         self.app.fire_event('domain-delete', vm=vm)
 
     def __contains__(self, key):
-        return any((key in (vm, vm.qid, vm.name))
-                   for vm in self)
+        if isinstance(key, int):
+            return key in self._dict
+        if isinstance(key, qubes.vm.BaseVM):
+            return self._dict.get(key.qid) is key
+        if isinstance(key, str):
+            try:
+                self._lookup(self._name_index, 'name', key)
+            except KeyError:
+                return False
+            return True
+        return False
 
 
     def __len__(self):
         return len(self._dict)
 
 
+    def _dependency_index(self, prop):
+        '''Return ``(forward, reverse)`` index of *prop*, (re)building it
+        when needed'''
+        try:
+            forward, reverse = self._dependents[prop]
+            if len(forward) == len(self._dict):
+                return forward, reverse
+        except KeyError:
+            pass
+
+        # not built yet, or the collection was modified behind our back
+        forward, reverse = {}, {}
+        for vm in self._dict.values():
+            target = getattr(vm, prop, None)
+            forward[vm] = target
+            if target is not None:
+                reverse.setdefault(target, set()).add(vm)
+        self._dependents[prop] = (forward, reverse)
+        return forward, reverse
+
+    def _set_dependency(self, prop, vm, target):
+        forward, reverse = self._dependents[prop]
+        old_target = forward.get(vm)
+        if old_target is not None and old_target is not target:
+            dependents = reverse.get(old_target, set())
+            dependents.discard(vm)
+            if not dependents:
+                reverse.pop(old_target, None)
+        forward[vm] = target
+        if target is not None:
+            reverse.setdefault(target, set()).add(vm)
+
+    def update_dependents(self, vm, prop):
+        '''Update reverse dependency index after change of VM's property.
+
+        This is called from ``property-set:template``, ``property-set:netvm``
+        and ``property-del:netvm`` handlers.
+
+        :param qubes.vm.BaseVM vm: VM which has changed
+        :param str prop: name of the property
+        '''
+
+        if prop in self._dependents and self._dict.get(vm.qid) is vm:
+            self._set_dependency(prop, vm, getattr(vm, prop, None))
+
+    def invalidate_dependents(self, prop=None):
+        '''Drop reverse dependency index, it will be rebuilt on next use.
+
+        This is needed when property value may have changed without
+        ``property-set:`` event, for example because its default has changed.
+
+        :param str prop: name of the property, or :py:obj:`None` for all
+        '''
+
+        if prop is None:
+            self._dependents.clear()
+        else:
+            self._dependents.pop(prop, None)
+
+    def get_dependents(self, vm, prop):
+        '''Get VMs, which have *prop* property set to *vm*
+
+        The lookup is indexed, so it does not depend on number of all VMs.
+
+        >>> app.domains.get_dependents(app.domains['sys-firewall'], 'netvm')
+        {<AppVM object at ... name='work' ...>, ...}
+
+        :param qubes.vm.BaseVM vm: target VM
+        :param str prop: name of the property (``'template'`` or ``'netvm'``)
+        :rtype: set
+        '''
+
+        _, reverse = self._dependency_index(prop)
+        return set(reverse.get(vm, ()))
+
+    def check_dependents(self):
+        '''Compare reverse dependency indexes with actual property values
+
+        This is a debugging aid, mostly for tests.
+
+        :returns: list of inconsistencies found (empty if there are none)
+        '''
+
+        errors = []
+        for prop in sorted(self._dependents):
+            forward, reverse = self._dependents[prop]
+            for vm in self._dict.values():
+                target = getattr(vm, prop, None)
+                if vm not in forward:
+                    errors.append('{}: {} is not indexed'.format(prop, vm.name))
+                elif forward[vm] is not target:
+                    errors.append('{}: {} indexed as {!r}, actual {!r}'.format(
+                        prop, vm.name, forward[vm], target))
+                if target is not None and vm not in reverse.get(target, ()):
+                    errors.append('{}: {} missing from dependents of {!r}'
+                        .format(prop, vm.name, target))
+            for target, dependents in reverse.items():
+                for vm in dependents:
+                    if self._dict.get(vm.qid) is not vm:
+                        errors.append('{}: {!r} depends on {!r}, but is not '
+                            'in collection'.format(prop, vm, target))
+                    elif getattr(vm, prop, None) is not target:
+                        errors.append('{}: {} listed as dependent of {!r}'
+                            .format(prop, vm.name, target))
+        return errors
+
     def get_vms_based_on(self, template):
         template = self[template]
-        return set(vm for vm in self
-            if hasattr(vm, 'template') and vm.template == template)
+        return self.get_dependents(template, 'template')
 
 
     def get_vms_connected_to(self, netvm):
@@ -519,7 +751,7 @@ class VMCollection:
 
         while new_vms:
             cur_vm = new_vms.pop()
-            for vm in cur_vm.connected_vms:
+            for vm in self.get_dependents(cur_vm, 'netvm'):
                 if vm in dependent_vms:
                     continue
                 dependent_vms.add(vm)
@@ -620,6 +852,10 @@ class Qubes(qubes.PropertyHolder):
     '''Main Qubes application
 
     :param str store: path to ``qubes.xml``
+    :param bool lazy_load: defer loading storage and logs of qubes until \
+        they are used, see :py:attr:`lazy_load`
+    :param bool cache_defaults: cache default values of properties, see \
+        :py:attr:`cache_defaults`
 
     The store is loaded in stages:
 
@@ -701,6 +937,41 @@ class Qubes(qubes.PropertyHolder):
             :param event: Event name (``'pool-delete'``)
             :param pool: Pool object
 
+        .. event:: memory-shortage (subject, event, vm)
+
+            When there is not enough memory to start a domain. Handlers may
+            free some memory (for example by killing domains started in
+            advance) and return :py:obj:`True`; in that case memory is
+            requested once again.
+
+            Handler for this event can be asynchronous (a coroutine).
+
+            :param subject: Event emitter
+            :param event: Event name (``'memory-shortage'``)
+            :param vm: Domain object being started
+
+        .. event:: domain-start-many-result (subject, event, vm, reason)
+
+            When domain started with :py:func:`qubes.batch.start_many` is
+            either started, or failed to start.
+
+            :param subject: Event emitter
+            :param event: Event name (``'domain-start-many-result'``)
+            :param vm: Domain object
+            :param reason: Error message, or :py:obj:`None` if the domain \
+                was started
+
+        .. event:: domain-shutdown-many-result (subject, event, vm, reason)
+
+            When domain shut down with :py:func:`qubes.batch.shutdown_many`
+            is either halted, or failed to shut down.
+
+            :param subject: Event emitter
+            :param event: Event name (``'domain-shutdown-many-result'``)
+            :param vm: Domain object
+            :param reason: Error message, or :py:obj:`None` if the domain \
+                was shut down
+
     Methods and attributes:
     '''
 
@@ -783,7 +1054,7 @@ class Qubes(qubes.PropertyHolder):
         doc='check for updates inside qubes')
 
     def __init__(self, store=None, load=True, offline_mode=None, lock=False,
-            **kwargs):
+            lazy_load=False, cache_defaults=False, **kwargs):
         #: logger instance for logging global messages
         self.log = logging.getLogger('app')
         self.log.debug('init() -> %#x', id(self))
@@ -822,6 +1093,52 @@ class Qubes(qubes.PropertyHolder):
         self.__locked_fh = None
         self._domain_event_callback_id = None
 
+        #: if not :py:obj:`None`, :py:meth:`save` only schedules writing
+        #: :file:`qubes.xml` this many seconds later, so that all the calls
+        #: made in the meantime result in a single write
+        self.save_delay = None
+
+        #: number of :py:meth:`save` calls merged into an already pending one
+        self.saves_coalesced = 0
+        #: number of writes of :file:`qubes.xml`
+        self.saves = 0
+        #: total time spent writing :file:`qubes.xml`, in seconds
+        self.save_time = 0.0
+
+        self._save_future = None
+        self._save_handle = None
+        self._save_lock = False
+
+        #: if :py:obj:`True`, :py:meth:`save` appends changed parts of
+        #: :file:`qubes.xml` to a journal next to it (see :py:mod:`qubes.journal`)
+        #: instead of rewriting the whole file
+        self.use_journal = False
+
+        #: size of the journal (in bytes), after which it is compacted into
+        #: a fresh :file:`qubes.xml`; compaction is done right after the save
+        #: which exceeded it, in the event loop (when running)
+        self.journal_max_size = 1024 * 1024
+
+        self._journal = qubes.journal.Journal(
+            qubes.journal.journal_path(self._store))
+        # fragments of qubes.xml, as already stored (qubes.journal.fragments())
+        self._journaled = None
+        self._journal_cache = {}
+        self._journal_compact_handle = None
+
+        #: if :py:obj:`True`, :py:meth:`load` sets up only what is needed
+        #: to know the qubes (properties, features, tags and devices), and
+        #: each qube's storage and log file are set up on first use
+        self.lazy_load = lazy_load
+
+        #: if :py:obj:`True`, this object and the qubes keep default values
+        #: of properties which allow that (see
+        #: :py:meth:`qubes.property.get_default`), instead of computing them
+        #: on each read
+        self.cache_defaults = cache_defaults
+        if cache_defaults:
+            self.enable_default_cache()
+
         #: jinja2 environment for libvirt XML templates
         self.env = jinja2.Environment(
             loader=jinja2.FileSystemLoader([
@@ -877,6 +1194,8 @@ class Qubes(qubes.PropertyHolder):
                         # manipulate xml directly, before loading netvm
                         # property, to avoid hitting netvm loop detection
                         properties.append(element)
+                        # pylint: disable=protected-access
+                        vm._index_xml_properties()
             except KeyError:
                 # if default_fw_netvm was set to invalid value, simply
                 # drop it
@@ -892,14 +1211,20 @@ class Qubes(qubes.PropertyHolder):
         '''
 
         fh = self._acquire_lock()
-        self.xml = lxml.etree.parse(fh)
+        data = fh.read()
+        self.xml = lxml.etree.ElementTree(lxml.etree.fromstring(data))
+
+        # apply changes saved since qubes.xml was written, see use_journal
+        if os.path.exists(self._journal.path):
+            qubes.journal.apply(self.xml.getroot(),
+                self._journal.read(qubes.journal.store_hash(data)))
 
         # stage 1: load labels and pools
-        for node in self.xml.xpath('./labels/label'):
+        for node in self.xml.iterfind('labels/label'):
             label = qubes.Label.fromxml(node)
             self.labels[label.index] = label
 
-        for node in self.xml.xpath('./pools/pool'):
+        for node in self.xml.iterfind('pools/pool'):
             name = node.get('name')
             assert name, "Pool name '%s' is invalid " % name
             try:
@@ -908,12 +1233,13 @@ class Qubes(qubes.PropertyHolder):
                 self.log.error(str(e))
 
         # stage 2: load VMs
-        for node in self.xml.xpath('./domains/domain'):
+        for node in self.xml.iterfind('domains/domain'):
             # pylint: disable=no-member
             cls = self.get_vm_class(node.get('class'))
             vm = cls(self, node)
             vm.load_properties(load_stage=2)
-            vm.init_log()
+            if not self.lazy_load:
+                vm.init_log()
             self.domains.add(vm, _enable_events=False)
 
         if 0 not in self.domains:
@@ -944,7 +1270,7 @@ class Qubes(qubes.PropertyHolder):
 
         # get a file timestamp (before closing it - still holding the lock!),
         #  to detect whether anyone else have modified it in the meantime
-        self.__load_timestamp = os.path.getmtime(self._store)
+        self.__load_timestamp = self._store_timestamp()
 
         if not lock:
             self._release_lock()
@@ -986,17 +1312,131 @@ class Qubes(qubes.PropertyHolder):
         - Attempts to write two or more files concurrently. This is done by
           sophisticated locking.
 
+        When :py:attr:`save_delay` is set (as in :program:`qubesd`), this
+        only schedules the write. Use :py:meth:`wait_for_save` to wait for it
+        to complete, or :py:meth:`flush_save` to write it immediately.
+
         :param bool lock: keep file locked after saving
         :throws EnvironmentError: failure on saving
         '''
 
+        if self.save_delay is None:
+            self._save_store(lock)
+            return
+
+        self._save_lock = self._save_lock or lock
+        if self._save_future is not None:
+            self.saves_coalesced += 1
+            return
+
+        loop = asyncio.get_event_loop()
+        self._save_future = loop.create_future()
+        self._save_handle = loop.call_later(self.save_delay, self.flush_save)
+
+    def flush_save(self):
+        '''Write :file:`qubes.xml` now, if there is a pending save
+
+        The error, if any, is logged and reported to :py:meth:`wait_for_save`
+        callers.
+        '''
+
+        if self._save_future is None:
+            return
+        future, self._save_future = self._save_future, None
+        self._save_handle.cancel()
+        self._save_handle = None
+        lock, self._save_lock = self._save_lock, False
+
+        try:
+            self._save_store(lock)
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.exception('failed to save %s', self._store)
+            future.set_exception(e)
+            # mark exception as retrieved, it is already logged
+            future.exception()
+        else:
+            future.set_result(None)
+
+    @asyncio.coroutine
+    def wait_for_save(self):
+        '''Wait until pending save, if any, is written to disk
+
+        This method is a coroutine.
+
+        :throws EnvironmentError: failure on saving
+        '''
+
+        if self._save_future is not None:
+            yield from asyncio.shield(self._save_future)
+
+    def _save_store(self, lock):
+        start_time = time.monotonic()
+        try:
+            self._save_store_locked(lock)
+        finally:
+            self.saves += 1
+            self.save_time += time.monotonic() - start_time
+
+    def _save_store_locked(self, lock):
         if not self.__locked_fh:
             self._acquire_lock(for_save=True)
 
+        element = self.__xml__()
+        if self.use_journal and self._journaled is not None \
+                and self._journal.size <= self.journal_max_size:
+            self._save_journal(element)
+        else:
+            self._save_full(element)
+
+        # update stored mtime, in case of multiple save() calls without
+        # loading qubes.xml again
+        self.__load_timestamp = self._store_timestamp()
+
+        if not lock:
+            self._release_lock()
+
+    def _save_journal(self, element):
+        fragments = qubes.journal.fragments(element, self._journal_cache)
+        commit = qubes.journal.diff(self._journaled, fragments)
+        if commit is not None:
+            try:
+                self._journal.append(commit)
+            except OSError:
+                self.log.exception('failed to append to %s, saving whole %s',
+                    self._journal.path, self._store)
+                self._save_full(element)
+                return
+        self._journaled = fragments
+
+        if self._journal.size > self.journal_max_size \
+                and self._journal_compact_handle is None:
+            loop = asyncio.get_event_loop()
+            if loop.is_running():
+                # don't make the current caller wait for it; this still runs
+                # in the event loop, blocking it for as long as a save without
+                # the journal would
+                self._journal_compact_handle = loop.call_soon(
+                    self._compact_journal)
+            # otherwise, next save() will do it
+
+    def _compact_journal(self):
+        self._journal_compact_handle = None
+        if self._journal.size <= self.journal_max_size:
+            # already done
+            return
+        self.log.debug('compacting %s', self._journal.path)
+        self._journaled = None
+        try:
+            self._save_store(lock=self.__locked_fh is not None)
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception('failed to compact %s', self._journal.path)
+
+    def _save_full(self, element):
         fh_new = tempfile.NamedTemporaryFile(
             prefix=self._store, delete=False)
-        lxml.etree.ElementTree(self.__xml__()).write(
-            fh_new, encoding='utf-8', pretty_print=True)
+        data = lxml.etree.tostring(lxml.etree.ElementTree(element),
+            encoding='utf-8', pretty_print=True)
+        fh_new.write(data)
         fh_new.flush()
         try:
             os.chown(fh_new.name, -1, grp.getgrnam('qubes').gr_gid)
@@ -1006,17 +1446,23 @@ class Qubes(qubes.PropertyHolder):
             pass
         os.rename(fh_new.name, self._store)
 
-        # update stored mtime, in case of multiple save() calls without
-        # loading qubes.xml again
-        self.__load_timestamp = os.path.getmtime(self._store)
-
         # this releases lock for all other processes,
         # but they should instantly block on the new descriptor
         self.__locked_fh.close()
         self.__locked_fh = fh_new
 
-        if not lock:
-            self._release_lock()
+        if self.use_journal:
+            self._journal.reset(qubes.journal.store_hash(data))
+            self._journaled = qubes.journal.fragments(element,
+                self._journal_cache)
+        else:
+            self._journal.remove()
+            self._journaled = None
+            self._journal_cache.clear()
+
+    def _store_timestamp(self):
+        '''Return something that changes whenever the store is modified'''
+        return (os.path.getmtime(self._store), self._journal.identity())
 
 
     def close(self):
@@ -1028,6 +1474,14 @@ class Qubes(qubes.PropertyHolder):
         for frame in traceback.extract_stack():
             self.log.debug('%s', frame)
 
+        self.flush_save()
+        if self._journal_compact_handle is not None:
+            # the journal is already durable, compaction can wait
+            self._journal_compact_handle.cancel()
+            self._journal_compact_handle = None
+        self._journal.close()
+        self._journal_cache.clear()
+
         super().close()
 
         if self._domain_event_callback_id is not None:
@@ -1076,7 +1530,7 @@ class Qubes(qubes.PropertyHolder):
                 continue
 
             if self.__load_timestamp and \
-                    os.path.getmtime(self._store) != self.__load_timestamp:
+                    self._store_timestamp() != self.__load_timestamp:
                 os.close(fd)
                 raise qubes.exc.QubesException(
                     'Someone else modified qubes.xml in the meantime')
@@ -1442,10 +1896,18 @@ class Qubes(qubes.PropertyHolder):
                     name='netvm', oldvalue=oldvalue)
 
 
+    @qubes.events.handler('property-del:default_netvm')
+    def on_property_del_default_netvm(self, event, name, oldvalue=None):
+        # pylint: disable=unused-argument
+        self.domains.invalidate_dependents('netvm')
+
+
     @qubes.events.handler('property-set:default_netvm')
     def on_property_set_default_netvm(self, event, name, newvalue,
             oldvalue=None):
         # pylint: disable=unused-argument
+        # netvm of qubes providing network may change too, without an event
+        self.domains.invalidate_dependents('netvm')
         for vm in self.domains:
             if hasattr(vm, 'provides_network') and not vm.provides_network and \
                     hasattr(vm, 'netvm') and vm.property_is_default('netvm'):
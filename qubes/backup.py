@@ -41,6 +41,7 @@ import time
 
 from .utils import size_to_human
 import qubes
+import qubes.journal
 import qubes.storage
 import qubes.storage.file
 import qubes.vm.templatevm
@@ -715,6 +716,11 @@ class Backup:
         qubes_xml = self.app.store
         self.tmpdir = tempfile.mkdtemp()
         shutil.copy(qubes_xml, os.path.join(self.tmpdir, 'qubes.xml'))
+        # recent changes may be still only in the journal
+        if os.path.exists(qubes.journal.journal_path(qubes_xml)):
+            shutil.copy(qubes.journal.journal_path(qubes_xml),
+                qubes.journal.journal_path(
+                    os.path.join(self.tmpdir, 'qubes.xml')))
         qubes_xml = os.path.join(self.tmpdir, 'qubes.xml')
         backup_app = qubes.Qubes(qubes_xml, offline_mode=True)
         backup_app.events_enabled = False
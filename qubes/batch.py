@@ -0,0 +1,329 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Starting and shutting down many domains at once
+
+Domains are started in waves: first those which do not depend on any other
+domain being started, then those whose network provider was started in the
+previous wave, and so on. Within a wave, up to given number of domains is
+started concurrently, with memory for all of them requested from qmemman at
+once.
+
+Shutdown goes the other way: first all domains which do not provide network
+to any other domain being shut down, then their network providers, and so on.
+Paused domains would not shut down, so they are unpaused first, except
+disposable ones waiting in a pool, which are just killed.
+'''
+
+import asyncio
+
+import qubes.exc
+import qubes.vm.adminvm
+import qubes.vm.dispvm
+import qubes.vm.qubesvm
+
+if qubes.vm.qubesvm.qmemman_present:
+    import qubes.qmemman.client
+
+#: default number of domains started concurrently
+DEFAULT_CONCURRENCY = 4
+
+
+class MemoryReservation:
+    '''Memory requested from qmemman for several domains at once
+
+    qmemman does not balance memory while the reservation is held, so it is
+    given back as soon as each domain it was made for called :py:meth:`close`
+    (which :py:meth:`qubes.vm.qubesvm.QubesVM.start` does right after creating
+    the domain, or when it fails or returns earlier), or on :py:meth:`release`,
+    whichever comes first. A domain already being started (or shut down) by
+    someone else drops out of the reservation without waiting for that, as
+    the other start may be waiting for qmemman itself.
+
+    :param list vms: domains to request memory for
+    '''
+
+    def __init__(self, vms):
+        self.vms = list(vms)
+        self._pending = set(self.vms)
+        self._client = None
+
+    def request(self):
+        '''Request memory for all the domains
+
+        This method blocks, run it in an executor.
+
+        :raises qubes.exc.QubesMemoryError: when not enough memory is available
+        '''
+        if not qubes.vm.qubesvm.qmemman_present:
+            return
+
+        mem_required = sum(vm.get_mem_required() for vm in self.vms)
+        client = qubes.qmemman.client.QMemmanClient()
+        try:
+            got_memory = client.request_memory(mem_required)
+        except IOError as e:
+            if getattr(client, 'sock', None) is not None:
+                client.close()
+            raise IOError('Failed to connect to qmemman: {!s}'.format(e))
+
+        if not got_memory:
+            client.close()
+            raise qubes.exc.QubesMemoryError(self.vms[0],
+                'Not enough memory to start domains {}'.format(
+                    ', '.join(vm.name for vm in self.vms)))
+        self._client = client
+
+    def close(self, vm):
+        '''Mark *vm* as no longer needing the reservation
+
+        Calling it again for the same domain does nothing.
+        '''
+        self._pending.discard(vm)
+        if not self._pending:
+            self.release()
+
+    def release(self):
+        '''Give the memory back to qmemman'''
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+def domains_to_start(vms):
+    '''Domains :py:func:`start_many` would start for *vms*: those of them
+    which are halted, and their network providers which are halted too
+
+    :param list vms: domains to start
+    :rtype: set
+    '''
+    pending = set()
+    for vm in vms:
+        while vm is not None and vm not in pending \
+                and not isinstance(vm, qubes.vm.adminvm.AdminVM) \
+                and vm.get_power_state() == 'Halted':
+            pending.add(vm)
+            vm = vm.netvm
+    return pending
+
+
+@asyncio.coroutine
+def start_many(app, vms, concurrency=DEFAULT_CONCURRENCY):
+    '''Start domains, each one after its network provider
+
+    Network providers which are not running are started too, even if not
+    listed in *vms*. A domain is not started if its network provider failed
+    to start. After each domain is handled, ``domain-start-many-result`` event
+    is fired on *app*.
+
+    This function is a coroutine.
+
+    :param qubes.Qubes app: the application
+    :param list vms: domains to start
+    :param int concurrency: maximum number of domains started concurrently
+    :returns: exceptions of domains which failed to start, by domain
+    '''
+
+    pending = domains_to_start(vms)
+
+    failed = {}
+    while pending:
+        # netvm property cannot form a loop, so there is always some
+        wave = sorted(vm for vm in pending if vm.netvm not in pending)
+        pending.difference_update(wave)
+
+        for vm in wave:
+            if vm.netvm in failed:
+                failed[vm] = qubes.exc.QubesVMError(vm,
+                    'NetVM {} of domain {} failed to start'.format(
+                        vm.netvm.name, vm.name))
+                _report(app, vm, failed[vm])
+        wave = [vm for vm in wave if vm not in failed]
+
+        for i in range(0, len(wave), concurrency):
+            yield from _start_chunk(app, wave[i:i + concurrency], failed)
+
+    return failed
+
+
+@asyncio.coroutine
+def _start_chunk(app, vms, failed):
+    reservation = MemoryReservation(vms)
+    try:
+        yield from asyncio.get_event_loop().run_in_executor(None,
+            reservation.request)
+    except qubes.exc.QubesMemoryError:
+        # not enough for all of them at once; each will try on its own
+        reservation = None
+    except IOError as e:
+        # each will try on its own, and report the error if it persists
+        app.log.warning('Failed to reserve memory for %s: %s',
+            ', '.join(vm.name for vm in vms), e)
+        reservation = None
+
+    try:
+        results = yield from asyncio.gather(
+            *(_start_one(vm, reservation) for vm in vms),
+            return_exceptions=True)
+    finally:
+        if reservation is not None:
+            reservation.release()
+
+    for vm, result in zip(vms, results):
+        if isinstance(result, BaseException):
+            failed[vm] = result
+            _report(app, vm, result)
+        else:
+            _report(app, vm, None)
+
+
+@asyncio.coroutine
+def _start_one(vm, reservation):
+    try:
+        yield from vm.start(mem_reservation=reservation)
+    finally:
+        # in case start() failed before getting to it, do not keep memory
+        # of the other domains reserved until all of them are started
+        if reservation is not None:
+            reservation.close(vm)
+
+
+def _report(app, vm, exc):
+    if exc is not None:
+        vm.log.error('Start failed: %s', exc)
+    app.fire_event('domain-start-many-result', vm=vm,
+        reason=None if exc is None else str(exc))
+
+
+@asyncio.coroutine
+def shutdown_many(app, vms, timeout=None):
+    '''Shut down domains, each one before its network provider
+
+    Domains which do not provide network to any other domain being shut down
+    are shut down concurrently, then their network providers, and so on. A
+    domain is not shut down if any of its clients failed to. Each such group
+    gets an equal share of *timeout* left when it starts shutting down;
+    domains still running after that are killed. After each domain is
+    handled, ``domain-shutdown-many-result`` event is fired on *app*.
+
+    This function is a coroutine.
+
+    :param qubes.Qubes app: the application
+    :param list vms: domains to shut down
+    :param timeout: time for all the domains to shut down, in seconds; if \
+        :py:obj:`None`, each domain waits for its \
+        :py:attr:`~qubes.vm.qubesvm.QubesVM.shutdown_timeout`
+    :returns: exceptions of domains which failed to shut down, by domain
+    '''
+
+    loop = asyncio.get_event_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+
+    pending = set(vm for vm in vms
+        if not isinstance(vm, qubes.vm.adminvm.AdminVM) and not vm.is_halted())
+
+    failed = {}
+    for vm in sorted(pending):
+        if vm.is_paused():
+            yield from _unpause_or_kill(app, vm, pending, failed)
+
+    waves = []
+    while pending:
+        # netvm property cannot form a loop, so there is always some
+        wave = sorted(vm for vm in pending
+            if not any(client.netvm is vm for client in pending))
+        pending.difference_update(wave)
+        waves.append(wave)
+
+    for i, wave in enumerate(waves):
+        wave_deadline = None
+        if deadline is not None:
+            now = loop.time()
+            wave_deadline = now + max(0, deadline - now) / (len(waves) - i)
+
+        coros = []
+        for vm in wave:
+            failed_clients = sorted(client.name for client in failed
+                if client.netvm is vm)
+            if failed_clients:
+                failed[vm] = qubes.exc.QubesVMError(vm,
+                    'Domains connected to {} failed to shut down: {}'.format(
+                        vm.name, ', '.join(failed_clients)))
+                _report_shutdown(app, vm, failed[vm])
+            else:
+                coros.append(_shutdown_one(app, vm, wave_deadline, failed))
+        if coros:
+            yield from asyncio.gather(*coros)
+
+    return failed
+
+
+@asyncio.coroutine
+def _unpause_or_kill(app, vm, pending, failed):
+    try:
+        if qubes.vm.dispvm.DispVMPool.is_pooled(vm):
+            # nothing to lose in it
+            pending.discard(vm)
+            try:
+                yield from vm.kill()
+            except qubes.exc.QubesVMNotStartedError:
+                pass
+            _report_shutdown(app, vm, None)
+        else:
+            yield from vm.unpause()
+    except Exception as e:  # pylint: disable=broad-except
+        if vm in pending:
+            # it will be killed when its time to shut down is over
+            vm.log.warning('Failed to unpause before shutdown: %s', e)
+        else:
+            failed[vm] = e
+            _report_shutdown(app, vm, e)
+
+
+@asyncio.coroutine
+def _shutdown_one(app, vm, deadline, failed):
+    timeout = None
+    if deadline is not None:
+        timeout = max(0, deadline - asyncio.get_event_loop().time())
+    try:
+        try:
+            yield from vm.shutdown(wait=True, timeout=timeout)
+        except qubes.exc.QubesVMShutdownTimeoutError:
+            vm.log.warning('Shutdown timed out, killing')
+            yield from vm.kill()
+    except qubes.exc.QubesVMNotStartedError:
+        # halted in the meantime
+        pass
+    except Exception as e:  # pylint: disable=broad-except
+        failed[vm] = e
+        _report_shutdown(app, vm, e)
+        return
+    _report_shutdown(app, vm, None)
+
+
+def _report_shutdown(app, vm, exc):
+    if exc is not None:
+        vm.log.error('Shutdown failed: %s', exc)
+    app.fire_event('domain-shutdown-many-result', vm=vm,
+        reason=None if exc is None else str(exc))
+
+
+def describe_failures(failed):
+    '''Describe failures returned by :py:func:`start_many` or
+    :py:func:`shutdown_many` in one line'''
+    return ', '.join('{} ({!s})'.format(vm.name, exc)
+        for vm, exc in sorted(failed.items()))
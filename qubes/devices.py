@@ -199,6 +199,14 @@ class DeviceCollection:
 
             :param device: :py:class:`DeviceInfo` object to be attached
 
+        .. event:: device-persistent-set:<class> (device, persistent)
+
+            Fired when `persistent` flag of already attached device is
+            changed.
+
+            :param device: :py:class:`DeviceInfo` object
+            :param persistent: new value of the flag
+
         .. event:: device-list:<class>
 
             Fired to get list of devices exposed by a VM. Handlers of this
@@ -288,6 +296,10 @@ class DeviceCollection:
             self._set.add(assignment)
         elif not persistent and device in self._set:
             self._set.discard(assignment)
+        else:
+            return
+        self._vm.fire_event('device-persistent-set:' + self._bus,
+            device=device, persistent=persistent)
 
     @asyncio.coroutine
     def detach(self, device_assignment: DeviceAssignment):
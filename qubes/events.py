@@ -26,8 +26,8 @@ etc.
 import asyncio
 import collections
 import fnmatch
-
-import itertools
+import functools
+import time
 
 
 def handler(*events):
@@ -69,6 +69,116 @@ def ishandler(obj):
         and hasattr(obj, 'ha_events')
 
 
+def _is_wildcard(pattern):
+    return any(char in pattern for char in '*?[')
+
+
+def _matching_handlers(handlers_dict, event):
+    '''Select handlers from one ``__handlers__`` dict which match *event*.
+
+    Handlers registered for exactly this event are found by a dictionary
+    lookup, only patterns containing wildcards are matched with
+    :py:func:`fnmatch.fnmatch`. Bound handlers go first.
+
+    :param dict handlers_dict: event pattern -> set of handlers
+    :param str event: event name
+    :rtype: list
+    '''
+
+    handlers = list(handlers_dict.get(event, ()))
+    for pattern, h_func_set in handlers_dict.items():
+        if pattern == event or not _is_wildcard(pattern):
+            continue
+        if pattern == '*' or fnmatch.fnmatch(event, pattern):
+            handlers.extend(h_func_set)
+    handlers.sort(key=(lambda handler: hasattr(handler, 'ha_bound')),
+        reverse=True)
+    return handlers
+
+
+@functools.lru_cache(maxsize=4096)
+def _class_dispatch(cls, event):
+    '''Compile class-level handlers for an event.
+
+    The result is cached per ``(cls, event)`` and must be invalidated with
+    :py:func:`invalidate_dispatch_cache` whenever handlers of any class
+    change.
+
+    :returns: tuple of non-empty handler tuples, one per class, in reversed \
+        method resolution order (base classes first)
+    '''
+
+    dispatch = []
+    for class_ in reversed(cls.__mro__):
+        try:
+            handlers_dict = class_.__handlers__
+        except AttributeError:
+            continue
+        handlers = _matching_handlers(handlers_dict, event)
+        if handlers:
+            dispatch.append(tuple(handlers))
+    return tuple(dispatch)
+
+
+@functools.lru_cache(maxsize=4096)
+def _class_cacheable(cls, event):
+    '''Check if all class-level handlers of an event are cacheable.
+
+    :returns: :py:obj:`None` if there are no handlers at all
+    '''
+
+    handlers = [func
+        for handlers in _class_dispatch(cls, event)
+        for func in handlers]
+    if not handlers:
+        return None
+    return all(getattr(func, 'ha_cacheable', False) for func in handlers)
+
+
+#: incremented each time class handlers change, so caches of event effects
+#: know when to drop them
+dispatch_generation = 0
+
+
+def invalidate_dispatch_cache():
+    '''Drop compiled dispatch tables of all classes.
+
+    This is called automatically by :py:meth:`EmitterMeta.add_class_handler`
+    and :py:meth:`EmitterMeta.remove_class_handler`. Call it explicitly if you
+    modify class ``__handlers__`` directly.
+    '''
+
+    global dispatch_generation  # pylint: disable=global-statement
+    _class_dispatch.cache_clear()
+    _class_cacheable.cache_clear()
+    dispatch_generation += 1
+
+
+def handler_name(func):
+    '''Name of event handler, as used in
+    :py:attr:`Emitter.handler_timings`'''
+    return '{}.{}'.format(getattr(func, '__module__', None),
+        getattr(func, '__qualname__', repr(func)))
+
+
+def _timed_call(timings, func, subject, event, kwargs):
+    name = handler_name(func)
+    start = time.monotonic()
+    effect = func(subject, event, **kwargs)
+    if asyncio.iscoroutinefunction(func):
+        return _timed_coro(timings, name, start, effect)
+    timings[name] += time.monotonic() - start
+    return effect
+
+
+@asyncio.coroutine
+def _timed_coro(timings, name, start, coro):
+    try:
+        return (yield from coro)
+    finally:
+        timings[name] += time.monotonic() - start
+
+
 class EmitterMeta(type):
     '''Metaclass for :py:class:`Emitter`'''
     def __init__(cls, name, bases, dict_):
@@ -93,6 +203,27 @@ class EmitterMeta(type):
             for event in attr.ha_events:
                 cls.__handlers__[event].add(attr)
 
+    def add_class_handler(cls, event, func):
+        '''Add event handler to the class itself, so it applies to all its
+        instances (and instances of subclasses).
+
+        :param str event: event identificator
+        :param collections.Callable handler: handler callable
+        '''
+
+        cls.__handlers__[event].add(func)
+        invalidate_dispatch_cache()
+
+    def remove_class_handler(cls, event, func):
+        '''Remove event handler added with :py:meth:`add_class_handler`.
+
+        :param str event: event identificator
+        :param collections.Callable handler: handler callable
+        '''
+
+        cls.__handlers__[event].remove(func)
+        invalidate_dispatch_cache()
+
 
 class Emitter(metaclass=EmitterMeta):
     '''Subject that can emit events.
@@ -101,6 +232,18 @@ class Emitter(metaclass=EmitterMeta):
     To enable event dispatch, set :py:attr:`events_enabled` to :py:obj:`True`.
     '''
 
+    #: number of times each event was fired, by any emitter; events are counted
+    #: by the name without the part after ``:`` (like ``property-set``), as
+    #: that part may come from a client and would make the table grow without
+    #: bounds
+    event_counts = collections.Counter()
+
+    #: if not :py:obj:`None`, a :py:class:`collections.Counter` to which
+    #: time spent in each handler of events of this emitter is added, by
+    #: handler name (see :py:func:`handler_name`); for asynchronous handlers,
+    #: this is the time until they finish
+    handler_timings = None
+
     def __init__(self, *args, **kwargs):
         super(Emitter, self).__init__(*args, **kwargs)
         if not hasattr(self, 'events_enabled'):
@@ -136,6 +279,30 @@ class Emitter(metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].remove(func)
+        if not self.__handlers__[event]:
+            del self.__handlers__[event]
+
+    def event_cacheable(self, event):
+        '''Check if effects of an event may be cached.
+
+        This is the case when there is at least one handler and all of them are
+        marked as cacheable, see :py:func:`qubes.ext.handler`.
+
+        :param str event: event identificator
+        :rtype: bool
+        '''
+
+        if not self.events_enabled:
+            return False
+        cacheable = _class_cacheable(self.__class__, event)
+        if cacheable is False:
+            return False
+        if self.__handlers__:
+            handlers = _matching_handlers(self.__handlers__, event)
+            if handlers:
+                return all(getattr(func, 'ha_cacheable', False)
+                    for func in handlers)
+        return bool(cacheable)
 
     def _fire_event(self, event, kwargs, pre_event=False):
         '''Fire event for classes in given order.
@@ -146,24 +313,24 @@ class Emitter(metaclass=EmitterMeta):
         if not self.events_enabled:
             return [], []
 
-        order = itertools.chain((self,), self.__class__.__mro__)
-        if not pre_event:
-            order = reversed(list(order))
+        self.event_counts[event.partition(':')[0]] += 1
+        dispatch = _class_dispatch(self.__class__, event)
+        if self.__handlers__:
+            # instance handlers go after (or, for pre-events, before) class
+            # handlers, as if the instance was the most derived class
+            dispatch += (tuple(_matching_handlers(self.__handlers__, event)),)
+        if pre_event:
+            dispatch = reversed(dispatch)
 
         effects = []
         async_effects = []
-        for i in order:
-            try:
-                handlers_dict = i.__handlers__
-            except AttributeError:
-                continue
-            handlers = [h_func for h_name, h_func_set in handlers_dict.items()
-                        for h_func in h_func_set
-                        if fnmatch.fnmatch(event, h_name)]
-            for func in sorted(handlers,
-                    key=(lambda handler: hasattr(handler, 'ha_bound')),
-                    reverse=True):
-                effect = func(self, event, **kwargs)
+        timings = self.handler_timings
+        for handlers in dispatch:
+            for func in handlers:
+                if timings is None:
+                    effect = func(self, event, **kwargs)
+                else:
+                    effect = _timed_call(timings, func, self, event, kwargs)
                 if asyncio.iscoroutinefunction(func):
                     async_effects.append(effect)
                 elif effect is not None:
@@ -44,12 +44,12 @@ class Extension:
 
                 if attr.ha_vm is not None:
                     for event in attr.ha_events:
-                        attr.ha_vm.__handlers__[event].add(attr)
+                        attr.ha_vm.add_class_handler(event, attr)
                 else:
                     # global hook
                     for event in attr.ha_events:
                         # pylint: disable=no-member
-                        qubes.Qubes.__handlers__[event].add(attr)
+                        qubes.Qubes.add_class_handler(event, attr)
 
         return cls._instance
 
@@ -73,10 +73,16 @@ def handler(*events, **kwargs):
     :param type vm: VM to hook (leave as None to hook all VMs)
     :param bool system: when :py:obj:`True`, hook is system-wide (not attached \
         to any VM)
+    :param bool cacheable: when :py:obj:`True`, the handler promises that its \
+        effects depend only on the event arguments, qube tags and the set of \
+        qubes, so they may be cached (see \
+        :py:class:`qubes.api.PermissionCache`)
     '''
 
     def decorator(func):
         func.ha_events = events
+        if kwargs.get('cacheable', False):
+            func.ha_cacheable = True
 
         if kwargs.get('system', False):
             func.ha_vm = None
@@ -25,7 +25,8 @@ class AdminExtension(qubes.ext.Extension):
     # pylint: disable=too-few-public-methods
     @qubes.ext.handler(
         'admin-permission:admin.vm.tag.Set',
-        'admin-permission:admin.vm.tag.Remove')
+        'admin-permission:admin.vm.tag.Remove',
+        cacheable=True)
     def on_tag_set_or_remove(self, vm, event, arg, **kwargs):
         '''Forbid changing specific tags'''
         # pylint: disable=no-self-use,unused-argument
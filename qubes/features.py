@@ -20,6 +20,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import qubes
 from . import vm as _vm
 
 _NO_DEFAULT = object()
@@ -52,6 +53,7 @@ class Features(dict):
 
     def __delitem__(self, key):
         super().__delitem__(key)
+        self._invalidate_cached_defaults(key)
         self.subject.fire_event('domain-feature-delete:' + key, feature=key)
 
     def __setitem__(self, key, value):
@@ -65,6 +67,7 @@ class Features(dict):
         except KeyError:
             has_oldvalue = False
         super().__setitem__(key, value)
+        self._invalidate_cached_defaults(key)
         if has_oldvalue:
             self.subject.fire_event('domain-feature-set:' + key, feature=key,
                 value=value, oldvalue=oldvalue)
@@ -110,6 +113,27 @@ class Features(dict):
     # end of overriding
     #
 
+    # reads are recorded for defaults cached by qubes.property; iterating
+    # is not, so defaults which do that cannot be cached
+
+    def __getitem__(self, key):
+        qubes.record_default_dependency(self.subject, 'feature:' + key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        qubes.record_default_dependency(self.subject, 'feature:' + key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        qubes.record_default_dependency(self.subject, 'feature:' + key)
+        return super().get(key, default)
+
+    def _invalidate_cached_defaults(self, key):
+        # done directly, not from domain-feature-* events, as those are not
+        # fired while loading
+        if isinstance(self.subject, qubes.PropertyHolder):
+            self.subject.invalidate_cached_defaults('feature:' + key)
+
     def _recursive_check(self, attr=None, *, feature, default,
             check_adminvm=False, check_app=False):
         '''Recursive search for a feature.
@@ -0,0 +1,280 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Append-only journal of changes to :file:`qubes.xml`
+
+Instead of rewriting whole :file:`qubes.xml` on each save, changed parts of it
+can be appended to a journal file next to it (see
+:py:attr:`qubes.Qubes.use_journal`). The unit of change is a top-level
+element (``labels``, ``pools``, ``properties``) or a single ``domain``.
+
+The journal is a sequence of lines, each being a JSON object. The first one
+identifies the :file:`qubes.xml` it applies to (by hash of its content), so a
+journal left over from before compaction is not applied to the newer file.
+Each of the following lines is one commit (one :py:meth:`qubes.Qubes.save`
+call)::
+
+    {"set": {"<key>": "<xml fragment>", ...}, "del": ["<key>", ...]}
+
+Commits are appended and fsync()-ed one at a time. If writing a commit fails
+(for example, there is no space left), the journal is truncated back to the
+end of the previous one and whole :file:`qubes.xml` is written instead, so an
+incomplete commit can only be left as the last line (crash in the middle of
+append). Such a commit is ignored. Any other malformed line is an error.
+
+The journal is read and written only with :file:`qubes.xml` lock held.
+'''
+
+import errno
+import grp
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import lxml.etree
+
+import qubes.exc
+
+
+def journal_path(store):
+    '''Return path of the journal for :file:`qubes.xml` at *store*'''
+    return store + '.journal'
+
+
+def store_hash(data):
+    '''Identify content of :file:`qubes.xml`, as recorded in the journal'''
+    return hashlib.sha256(data).hexdigest()
+
+
+def fragments(root, cache=None):
+    '''Split serialised :file:`qubes.xml` into journalled parts
+
+    :param lxml.etree._Element root: ``<qubes>`` element
+    :param dict cache: if given, remembers serialised elements between calls, \
+        so that elements reused by :py:meth:`qubes.vm.BaseVM.__xml__` are not \
+        serialised again
+    :returns: dict of key -> serialised element; keys are paths usable with \
+        :py:meth:`lxml.etree._Element.find` on *root*
+    '''
+
+    result = {}
+    for node in root:
+        if node.tag == 'domains':
+            for domain in node:
+                key = "domains/domain[@id='{}']".format(domain.get('id'))
+                result[key] = _serialise_node(key, domain, cache)
+        else:
+            result[node.tag] = _serialise_node(node.tag, node, cache)
+    if cache is not None:
+        for key in cache.keys() - result.keys():
+            del cache[key]
+    return result
+
+
+def _serialise_node(key, node, cache):
+    # cached element is only ever modified by swapping its direct children
+    # (see qubes.vm.qubesvm.QubesVM.__xml__)
+    children = list(node)
+    if cache is not None and key in cache:
+        cached_node, cached_children, data = cache[key]
+        if cached_node is node and len(children) == len(cached_children) \
+                and all(a is b for a, b in zip(children, cached_children)):
+            return data
+    data = lxml.etree.tostring(node, encoding='unicode', with_tail=False)
+    if cache is not None:
+        cache[key] = (node, children, data)
+    return data
+
+
+def diff(old, new):
+    '''Make a commit, which turns *old* fragments into *new* ones
+
+    :returns: the commit, or :py:obj:`None` if there are no changes
+    '''
+
+    commit = {}
+    changed = {key: value for key, value in new.items()
+        if old.get(key) != value}
+    if changed:
+        commit['set'] = changed
+    removed = sorted(old.keys() - new.keys())
+    if removed:
+        commit['del'] = removed
+    return commit or None
+
+
+def apply(root, commits):
+    '''Apply commits read from the journal to ``<qubes>`` element'''
+
+    for commit in commits:
+        for key in commit.get('del', ()):
+            node = root.find(key)
+            if node is not None:
+                node.getparent().remove(node)
+
+        for key, value in commit.get('set', {}).items():
+            node = lxml.etree.fromstring(value)
+            old_node = root.find(key)
+            if old_node is not None:
+                old_node.getparent().replace(old_node, node)
+                continue
+            parent_key = key.rpartition('/')[0]
+            parent = root.find(parent_key) if parent_key else root
+            if parent is None:
+                parent = lxml.etree.SubElement(root, parent_key)
+            parent.append(node)
+
+
+class Journal:
+    '''Journal file of :file:`qubes.xml`
+
+    :param str path: path of the journal file
+    '''
+
+    def __init__(self, path):
+        #: path of the journal file
+        self.path = path
+
+        #: size of the journal, as written by this process
+        self.size = 0
+
+        self.log = logging.getLogger('qubes.journal')
+        self._fh = None
+
+    def identity(self):
+        '''Return something that changes whenever the journal is modified'''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size)
+
+    def read(self, base_hash):
+        '''Read commits to be applied to :file:`qubes.xml`
+
+        :param str base_hash: :py:func:`store_hash` of :file:`qubes.xml`
+        :returns: list of commits; empty if there is no journal or it \
+            belongs to some other version of :file:`qubes.xml`
+        :raises qubes.exc.QubesException: when the journal is corrupted
+        '''
+
+        try:
+            with open(self.path, 'rb') as fh:
+                lines = fh.read().split(b'\n')
+        except FileNotFoundError:
+            return []
+
+        # the last element is empty, unless the last commit was interrupted
+        if lines[-1]:
+            self.log.warning('ignoring incomplete last commit in %s (%d bytes)',
+                self.path, len(lines[-1]))
+
+        records = []
+        for lineno, line in enumerate(lines[:-1], 1):
+            try:
+                records.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                raise qubes.exc.QubesException(
+                    'Journal {!r} is corrupted at line {}'.format(
+                        self.path, lineno))
+
+        if not records or 'base' not in records[0]:
+            raise qubes.exc.QubesException(
+                'Journal {!r} has no header'.format(self.path))
+        if records[0]['base'] != base_hash:
+            # written before qubes.xml was compacted
+            self.log.warning('ignoring stale journal %s', self.path)
+            return []
+        return records[1:]
+
+    def reset(self, base_hash):
+        '''Start a new, empty journal for given :file:`qubes.xml`
+
+        :param str base_hash: :py:func:`store_hash` of :file:`qubes.xml`
+        '''
+
+        self.close()
+        fh_new = tempfile.NamedTemporaryFile(prefix=self.path, delete=False)
+        try:
+            fh_new.write(self._serialise({'base': base_hash}))
+            fh_new.flush()
+            os.fsync(fh_new.fileno())
+            try:
+                os.chown(fh_new.name, -1, grp.getgrnam('qubes').gr_gid)
+                os.chmod(fh_new.name, 0o660)
+            except KeyError:  # group 'qubes' not found
+                # don't change mode if no 'qubes' group in the system
+                pass
+            os.rename(fh_new.name, self.path)
+        except:
+            fh_new.close()
+            os.unlink(fh_new.name)
+            raise
+        fh_new.close()
+
+        self._fh = open(self.path, 'ab', buffering=0)
+        self.size = os.fstat(self._fh.fileno()).st_size
+
+    def append(self, commit):
+        '''Append a commit (see :py:func:`diff`) to the journal
+
+        :raises OSError: when the commit could not be written whole; the \
+            journal is then truncated back to its previous size
+        '''
+
+        assert self._fh is not None, 'journal not open, call reset() first'
+        fd = self._fh.fileno()
+        data = self._serialise(commit)
+        try:
+            written = 0
+            while written < len(data):
+                count = os.write(fd, data[written:])
+                if not count:
+                    raise OSError(errno.EIO,
+                        'Short write to {!r}'.format(self.path))
+                written += count
+            os.fsync(fd)
+        except OSError:
+            # don't leave an incomplete commit for the next one to follow
+            try:
+                os.ftruncate(fd, self.size)
+            except OSError:
+                self.log.exception('failed to truncate %s', self.path)
+            raise
+        self.size += len(data)
+
+    def remove(self):
+        '''Remove the journal file, if any'''
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        '''Close the journal file, if open'''
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        self.size = 0
+
+    @staticmethod
+    def _serialise(record):
+        return json.dumps(record, separators=(',', ':'),
+            sort_keys=True).encode('utf-8') + b'\n'
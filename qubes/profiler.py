@@ -0,0 +1,215 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''On-demand profiling of :program:`qubesd`
+
+Profiling is started with ``internal.daemon.Profile`` call (see
+:py:class:`qubes.api.internal.QubesInternalAPI`) and lasts for given number of
+seconds or served requests. Only one profiler may run at a time; while none
+does, nothing is done on the request path besides checking
+:py:attr:`qubes.api.QubesDaemonProtocol.profiler`.
+
+There are two kinds of profilers:
+
+- ``deterministic`` uses :py:mod:`cProfile` and writes :py:mod:`pstats` file;
+  as each Admin API method is implemented by its own function, they can be
+  found there directly,
+- ``sampling`` periodically records the stack of the running code, and writes
+  it in collapsed stack format (as used by :program:`flamegraph.pl`), with the
+  Admin API method being served as the root frame.
+'''
+
+import asyncio
+import collections
+import cProfile
+import inspect
+import os
+import signal
+import time
+
+import qubes.api
+import qubes.exc
+
+
+class Profiler:
+    '''Base class for profilers
+
+    :param seconds: stop after this many seconds
+    :param requests: stop after this many requests were served
+    '''
+
+    #: directory to write results to
+    output_dir = '/var/log/qubes'
+
+    #: name of the kind of profiler, as used in ``internal.daemon.Profile``
+    name = None
+
+    #: extension of output file
+    suffix = None
+
+    def __init__(self, seconds=None, requests=None):
+        self.seconds = seconds
+        self.requests = requests
+        #: future, which result is the path of the output file
+        self.done = asyncio.get_event_loop().create_future()
+        self._timeout_handle = None
+
+    def start(self):
+        '''Start profiling'''
+        if self.seconds is not None:
+            self._timeout_handle = asyncio.get_event_loop().call_later(
+                self.seconds, self.stop)
+        self.enable()
+
+    def stop(self):
+        '''Stop profiling and write results'''
+        if self.done.done():
+            return
+        self.disable()
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+
+        path = os.path.join(self.output_dir, 'qubesd-{}-{}.{}'.format(
+            self.name, time.strftime('%Y%m%d-%H%M%S'), self.suffix))
+        try:
+            self.write(path)
+        except OSError as e:
+            self.done.set_exception(e)
+        else:
+            self.done.set_result(path)
+
+    def request_done(self):
+        '''Account for a served request'''
+        if self.requests is None:
+            return
+        self.requests -= 1
+        if self.requests <= 0:
+            self.stop()
+
+    def enable(self):
+        raise NotImplementedError()
+
+    def disable(self):
+        raise NotImplementedError()
+
+    def write(self, path):
+        raise NotImplementedError()
+
+
+class DeterministicProfiler(Profiler):
+    '''Profiler using :py:mod:`cProfile`'''
+    name = 'deterministic'
+    suffix = 'prof'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile = cProfile.Profile()
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+class SamplingProfiler(Profiler):
+    '''Profiler recording the stack on ``SIGPROF``
+
+    As the signal is delivered after given amount of CPU time, waiting for
+    I/O is not visible in the results.
+    '''
+    name = 'sampling'
+    suffix = 'folded'
+
+    #: CPU time between samples, in seconds
+    interval = 0.005
+
+    #: root frame for samples taken outside of any request
+    no_request = '(no request)'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #: number of samples, by stack (root frame first)
+        self.samples = collections.Counter()
+        self._request_code = inspect.unwrap(
+            qubes.api.QubesDaemonProtocol._respond).__code__
+        self._old_handler = None
+
+    def enable(self):
+        self._old_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._old_handler)
+
+    def sample(self, signum, frame):
+        '''Signal handler recording the stack of interrupted code'''
+        # pylint: disable=unused-argument
+        method = self.no_request
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            if code is self._request_code:
+                method = frame.f_locals['meth'].decode('ascii', 'replace')
+            elif code.co_varnames[:1] == ('self',):
+                # API methods run in a task of their own, without
+                # QubesDaemonProtocol on the stack
+                obj = frame.f_locals.get('self')
+                if isinstance(obj, qubes.api.AbstractQubesAPI):
+                    method = obj.method
+            stack.append('{} ({}:{})'.format(
+                code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack.append(method)
+        stack.reverse()
+        self.samples[tuple(stack)] += 1
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            for stack, count in self.samples.most_common():
+                output.write('{} {}\n'.format(
+                    ';'.join(frame.replace(';', ':') for frame in stack),
+                    count))
+
+
+#: profiler classes, by name
+PROFILERS = {cls.name: cls for cls in (DeterministicProfiler, SamplingProfiler)}
+
+
+@asyncio.coroutine
+def profile(profiler):
+    '''Run *profiler* on the request path, until it is done
+
+    This function is a coroutine.
+
+    :return: path of the output file
+    '''
+    if qubes.api.QubesDaemonProtocol.profiler is not None:
+        raise qubes.exc.QubesException('Profiling already in progress')
+
+    qubes.api.QubesDaemonProtocol.profiler = profiler
+    profiler.start()
+    try:
+        return (yield from asyncio.shield(profiler.done))
+    finally:
+        # on cancel (client disconnected), write what was collected so far
+        profiler.stop()
+        qubes.api.QubesDaemonProtocol.profiler = None
@@ -1337,7 +1337,9 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
             'qubes.tests.vm.appvm',
             'qubes.tests.vm.dispvm',
             'qubes.tests.app',
+            'qubes.tests.batch',
             'qubes.tests.tarwriter',
+            'qubes.tests.journal',
             'qubes.tests.api',
             'qubes.tests.api_admin',
             'qubes.tests.api_misc',
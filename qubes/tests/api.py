@@ -19,15 +19,20 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import shutil
 import socket
+import tempfile
+import time
 import unittest.mock
 
 import qubes.api
+import qubes.profiler
 import qubes.tests
 
 
 class TestMgmt(object):
-    def __init__(self, app, src, method, dest, arg, send_event=None):
+    def __init__(self, app, src, method, dest, arg, send_event=None,
+            send_serialized_event=None):
         self.app = app
         self.src = src
         self.method = method
@@ -41,6 +46,7 @@ class TestMgmt(object):
                 'mgmt.qubesexception': self.qubesexception,
                 'mgmt.exception': self.exception,
                 'mgmt.event': self.event,
+                'mgmt.events': self.events,
             }[self.method.decode()]
         except KeyError:
             raise qubes.api.ProtocolError('Invalid method')
@@ -92,11 +98,26 @@ class TestMgmt(object):
         except asyncio.CancelledError:
             pass
 
+    @asyncio.coroutine
+    def events(self, untrusted_payload):
+        # many events of which only the latest ones matter, with some
+        # which all have to be sent in between
+        for i in range(int(untrusted_payload)):
+            self.send_event('subject', 'property-set:prop', value=i)
+            self.send_event('subject', 'property-set:prop2', value=i)
+            if i % 1000 == 0:
+                self.send_event('subject', 'event', value=i)
+        try:
+            yield from asyncio.get_event_loop().create_future()
+        except asyncio.CancelledError:
+            pass
+
 class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
     def setUp(self):
         super(TC_00_QubesDaemonProtocol, self).setUp()
         self.app = unittest.mock.Mock()
         self.app.log = self.log
+        self.app.wait_for_save.side_effect = lambda: asyncio.sleep(0)
         self.sock_client, self.sock_server = socket.socketpair()
         self.reader, self.writer = self.loop.run_until_complete(
             asyncio.open_connection(sock=self.sock_client))
@@ -170,3 +191,335 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
         with self.assertNotRaises(asyncio.TimeoutError):
             self.loop.run_until_complete(
                 asyncio.wait_for(self.protocol.mgmt.task, 1))
+
+    def test_006_wait_for_save(self):
+        save_future = self.loop.create_future()
+        self.app.wait_for_save.side_effect = lambda: save_future
+        self.writer.write(b'dom0\0mgmt.success_none\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        read_task = asyncio.ensure_future(self.reader.read())
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertTrue(self.app.wait_for_save.called)
+        self.assertFalse(read_task.done())
+        save_future.set_result(None)
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(read_task, 1))
+        self.assertEqual(response, b"0\0")
+
+    def test_007_wait_for_save_error(self):
+        save_future = self.loop.create_future()
+        save_future.set_exception(OSError('disk full'))
+        self.app.wait_for_save.side_effect = lambda: save_future
+        self.writer.write(b'dom0\0mgmt.success_none\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b"")
+
+    def read_events(self, last_event):
+        events = []
+        while not events or events[-1] != last_event:
+            with self.assertNotRaises(asyncio.TimeoutError):
+                events.append(self.loop.run_until_complete(
+                    asyncio.wait_for(self.reader.readuntil(b'\0\0'), 1)))
+        return events
+
+    def test_008_events_not_read(self):
+        self.sock_client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.sock_server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.writer.write(b'dom0\0mgmt.events\0dom0\0arg\0' + b'10000')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        # the client does not read, so the events are queued
+        self.assertTrue(self.protocol.writing_paused)
+        self.assertLessEqual(self.protocol.transport.get_write_buffer_size(),
+            qubes.api.QubesDaemonProtocol.write_buffer_high + 4096)
+        # ... but only the latest of those which can be coalesced
+        self.assertLessEqual(len(self.protocol.pending_events), 12)
+
+        events = self.read_events(
+            b'1\0subject\0property-set:prop2\0value\09999\0\0')
+        self.assertEqual(events[-3:], [
+            b'1\0subject\0event\0value\09000\0\0',
+            b'1\0subject\0property-set:prop\0value\09999\0\0',
+            b'1\0subject\0property-set:prop2\0value\09999\0\0',
+        ])
+        self.assertEqual(
+            [event for event in events if b'\0event\0' in event],
+            [b'1\0subject\0event\0value\0' + str(i).encode() + b'\0\0'
+                for i in range(0, 10000, 1000)])
+        self.assertLess(len(events), 20000)
+        self.assertFalse(self.protocol.writing_paused)
+        self.sock_client.shutdown(socket.SHUT_RD)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.transport.abort()
+        self.loop.run_until_complete(self.protocol.mgmt.task)
+
+    def test_009_events_not_read_disconnect(self):
+        self.sock_client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.sock_server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.protocol.max_pending_events_size = 1024
+        self.app.log = unittest.mock.Mock()
+        # events which cannot be coalesced
+        with unittest.mock.patch.object(qubes.api.QubesDaemonProtocol,
+                'coalesced_events', ()):
+            self.writer.write(b'dom0\0mgmt.events\0dom0\0arg\0' + b'10000')
+            self.writer.write_eof()
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.app.log.warning.assert_called_once_with(
+            'client does not read events, disconnecting '
+            '(%d events of %d bytes pending)', unittest.mock.ANY,
+            unittest.mock.ANY)
+        self.assertIsNone(self.protocol.transport)
+        self.assertTrue(self.protocol.mgmt.task.done())
+
+    def mux_request(self, request_id, request):
+        return qubes.api.QubesDaemonProtocol.mux_request_header.pack(
+            request_id, len(request)) + request
+
+    def read_mux_responses(self, count):
+        '''Read frames until *count* responses are complete'''
+        header = qubes.api.QubesDaemonProtocol.mux_response_header
+        responses = {}
+        finished = 0
+        while finished < count:
+            request_id, frame_type, length = header.unpack(
+                self.loop.run_until_complete(asyncio.wait_for(
+                    self.reader.readexactly(header.size), 1)))
+            data = self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(length), 1))
+            response, _ = responses.get(request_id, (b'', None))
+            responses[request_id] = (response + data, frame_type)
+            if frame_type != qubes.api.QubesDaemonProtocol.MUX_DATA:
+                finished += 1
+        return responses
+
+    def test_010_mux(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic[:2])
+        self.loop.run_until_complete(self.writer.drain())
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic[2:])
+        self.writer.write(
+            self.mux_request(1, b'dom0\0mgmt.success\0dom0\0arg\0payload')
+            + self.mux_request(2, b'dom0\0mgmt.qubesexception\0dom0\0\0'))
+        request = self.mux_request(3, b'dom0\0mgmt.exception\0dom0\0\0')
+        self.writer.write(request[:5])
+        self.loop.run_until_complete(self.writer.drain())
+        self.writer.write(request[5:])
+        self.writer.write(self.mux_request(4, b'invalid'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            responses = self.read_mux_responses(4)
+        self.assertEqual(responses, {
+            1: (b"0\0src: b'dom0', dest: b'dom0', arg: b'arg', "
+                b"payload: b'payload'", qubes.api.QubesDaemonProtocol.MUX_END),
+            2: (b"2\0QubesException\0\0qubes-exception\0",
+                qubes.api.QubesDaemonProtocol.MUX_END),
+            3: (b"", qubes.api.QubesDaemonProtocol.MUX_ABORT),
+            4: (b"", qubes.api.QubesDaemonProtocol.MUX_ABORT),
+        })
+
+        # request ids can be reused, once the response is complete
+        self.writer.write(
+            self.mux_request(1, b'dom0\0mgmt.success_none\0dom0\0\0'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            responses = self.read_mux_responses(1)
+        self.assertEqual(responses,
+            {1: (b"0\0", qubes.api.QubesDaemonProtocol.MUX_END)})
+
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b"")
+        self.assertEqual(self.protocol.mux_requests, {})
+
+    def test_011_mux_event_cancel(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic)
+        self.writer.write(
+            self.mux_request(5, b'dom0\0mgmt.event\0dom0\0arg\0payload'))
+        self.writer.write_eof()
+        header = qubes.api.QubesDaemonProtocol.mux_response_header
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(header.size), 1))
+            request_id, frame_type, length = header.unpack(response)
+            response = self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(length), 1))
+        self.assertEqual((request_id, frame_type),
+            (5, qubes.api.QubesDaemonProtocol.MUX_DATA))
+        self.assertEqual(response,
+            b"1\0subject\0event\0payload\0payload\0\0")
+        task = self.protocol.mux_requests[5].mgmt.task
+
+        # closing the connection interrupts pending requests
+        self.sock_client.shutdown(socket.SHUT_RD)
+        self.transport.abort()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(task, 1))
+        self.assertEqual(self.protocol.mux_requests, {})
+
+    def test_012_mux_cancel(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic)
+        self.writer.write(
+            self.mux_request(5, b'dom0\0mgmt.event\0dom0\0arg\0payload'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.read_mux_responses(0)
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+        task = self.protocol.mux_requests[5].mgmt.task
+        self.writer.write(self.mux_request(5, b''))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            responses = self.read_mux_responses(1)
+            self.loop.run_until_complete(asyncio.wait_for(task, 1))
+        self.assertEqual(responses[5][1],
+            qubes.api.QubesDaemonProtocol.MUX_ABORT)
+
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b"")
+
+    def test_013_mux_too_long(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic)
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_request_header.pack(
+            1, qubes.api.QubesDaemonProtocol.buffer_size + 1))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b"")
+
+
+    @unittest.mock.patch.object(qubes.api.QubesDaemonProtocol,
+        'request_stats', {})
+    def test_014_request_stats(self):
+        def call(method):
+            sock_client, sock_server = socket.socketpair()
+            reader, writer = self.loop.run_until_complete(
+                asyncio.open_connection(sock=sock_client))
+            self.loop.run_until_complete(self.loop.create_connection(
+                lambda: qubes.api.QubesDaemonProtocol(TestMgmt, app=self.app),
+                sock=sock_server))
+            writer.write(b'dom0\0' + method + b'\0dom0\0arg\0payload')
+            writer.write_eof()
+            with self.assertNotRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(
+                    asyncio.wait_for(reader.read(), 1))
+            writer.close()
+            # let both the transports close
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.writer.write(b'dom0\0mgmt.success\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        call(b'mgmt.success')
+        call(b'mgmt.exception')
+        call(b'mgmt.unknown')
+
+        request_stats = qubes.api.QubesDaemonProtocol.request_stats
+        self.assertEqual(sorted(request_stats),
+            ['mgmt.exception', 'mgmt.success'])
+        self.assertEqual(request_stats['mgmt.success'].count, 2)
+        self.assertEqual(request_stats['mgmt.success'].errors, 0)
+        self.assertEqual(sum(request_stats['mgmt.success'].histogram), 2)
+        self.assertEqual(request_stats['mgmt.exception'].count, 1)
+        self.assertEqual(request_stats['mgmt.exception'].errors, 1)
+
+    def test_015_profile_sampling(self):
+        # the connection from setUp is not needed
+        self.writer.write(b'dom0\0mgmt.success\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.wait_for(self.reader.read(), 1))
+
+        self.app.domains = {'dom0': unittest.mock.sentinel.dom0}
+        sock_client, sock_server = socket.socketpair()
+        self.addCleanup(sock_client.close)
+        self.addCleanup(sock_server.close)
+        reader, writer = self.loop.run_until_complete(
+            asyncio.open_connection(sock=sock_client))
+        self.loop.run_until_complete(self.loop.create_connection(
+            lambda: qubes.api.QubesDaemonProtocol(TestAPI, app=self.app),
+            sock=sock_server))
+
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        profiler = qubes.profiler.SamplingProfiler(requests=1)
+        with unittest.mock.patch.object(qubes.profiler.Profiler, 'output_dir',
+                profile_dir):
+            profile_task = asyncio.ensure_future(
+                qubes.profiler.profile(profiler))
+            writer.write(b'dom0\0test.Busy\0dom0\0\0')
+            writer.write_eof()
+            with self.assertNotRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(
+                    asyncio.wait_for(reader.read(), 1))
+                path = self.loop.run_until_complete(
+                    asyncio.wait_for(profile_task, 1))
+        writer.close()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        with open(path) as samples_file:
+            samples = samples_file.read().splitlines()
+        # the method is the root frame
+        self.assertTrue(any(line.startswith('test.Busy;') and
+            ';busy (' in line for line in samples))
+
+class TestAPI(qubes.api.AbstractQubesAPI):
+    @qubes.api.method('test.Simple', no_payload=True)
+    @asyncio.coroutine
+    def simple(self):
+        return 'simple'
+
+    @qubes.api.method('test.Busy', no_payload=True)
+    @asyncio.coroutine
+    def busy(self):
+        start_time = time.process_time()
+        while time.process_time() - start_time < 0.1:
+            pass
+
+    @qubes.api.method('test.Endpoint.{endpoint}', no_payload=True,
+        endpoints=('a', 'b'))
+    @asyncio.coroutine
+    def endpoint(self, endpoint):
+        return endpoint
+
+
+class TestAPIChild(TestAPI):
+    @qubes.api.method('test.Child', no_payload=True)
+    @asyncio.coroutine
+    def child(self):
+        return 'child'
+
+
+class TC_10_AbstractQubesAPI(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = unittest.mock.Mock()
+        self.app.domains = {'dom0': unittest.mock.sentinel.dom0}
+
+    def call(self, api_class, method):
+        api = api_class(self.app, b'dom0', method, b'dom0', b'')
+        return self.loop.run_until_complete(
+            api.execute(untrusted_payload=b''))
+
+    def test_000_method_registry(self):
+        registry = TestAPI.get_method_registry()
+        self.assertCountEqual(registry.keys(),
+            ['test.Simple', 'test.Busy', 'test.Endpoint.a', 'test.Endpoint.b'])
+        self.assertEqual(registry['test.Endpoint.b'],
+            [(TestAPI.endpoint, 'test.Endpoint.b', 'b')])
+        self.assertIs(TestAPI.get_method_registry(), registry)
+
+        child_registry = TestAPIChild.get_method_registry()
+        self.assertIn('test.Child', child_registry)
+        self.assertIn('test.Simple', child_registry)
+        self.assertNotIn('test.Child', TestAPI.get_method_registry())
+
+    def test_001_dispatch(self):
+        self.assertEqual(self.call(TestAPI, b'test.Simple'), 'simple')
+        self.assertEqual(self.call(TestAPI, b'test.Endpoint.b'), 'b')
+        self.assertEqual(self.call(TestAPIChild, b'test.Child'), 'child')
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call(TestAPI, b'test.Child')
@@ -21,6 +21,7 @@
 ''' Tests for management calls endpoints '''
 
 import asyncio
+import collections
 import operator
 import os
 import shutil
@@ -32,8 +33,10 @@ import copy
 
 import qubes
 import qubes.devices
+import qubes.events
 import qubes.firewall
 import qubes.api.admin
+import qubes.batch
 import qubes.tests
 import qubes.storage
 
@@ -180,6 +183,68 @@ class TC_00_VMs(AdminAPITestCase):
             b'provides_network')
         self.assertEqual(value, 'type=bool False')
 
+    def test_027_vm_property_get_all(self):
+        self.vm.kernelopts = 'opt1\nopt2\\'
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll', b'test-vm1')
+        lines = value.splitlines()
+        self.assertEqual(len(lines), len(self.vm.property_list()))
+        self.assertEqual(lines, sorted(lines))
+        self.assertIn('name default=False type=str test-vm1', lines)
+        self.assertIn('vcpus default=True type=int 2', lines)
+        self.assertIn('netvm default=True type=vm ', lines)
+        self.assertIn('template default=False type=vm test-template', lines)
+        self.assertIn('kernelopts default=False type=str opt1\\nopt2\\\\',
+            lines)
+
+    def test_028_vm_property_get_all_filtered(self):
+        self.emitter.fire_event = unittest.mock.Mock(
+            return_value=[lambda prop: prop.__name__ in ('name', 'label')])
+        self.app.domains[0].fire_event = self.emitter.fire_event
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.property.GetAll', b'test-vm1', b'')
+        value = self.loop.run_until_complete(
+            mgmt_obj.execute(untrusted_payload=b''))
+        self.assertEqual(value,
+            'label default=False type=label red\n'
+            'name default=False type=str test-vm1\n')
+
+    def test_029_vm_property_get_all_vms(self):
+        self.emitter.fire_event = unittest.mock.Mock(
+            return_value=[lambda vm: vm.name != 'test-template'])
+        self.app.domains[0].fire_event = self.emitter.fire_event
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.property.GetAllVMs', b'dom0', b'')
+        value = self.loop.run_until_complete(
+            mgmt_obj.execute(untrusted_payload=b''))
+        lines = value.splitlines()
+        dom0 = self.app.domains['dom0']
+        self.assertEqual(len(lines),
+            len(dom0.property_list()) + len(self.vm.property_list()))
+        self.assertIn('dom0 label default=False type=label black', lines)
+        self.assertIn('test-vm1 template default=False type=vm test-template',
+            lines)
+        self.assertFalse(any(line.startswith('test-template ')
+            for line in lines))
+        self.emitter.fire_event.assert_called_once_with(
+            'admin-permission:admin.vm.property.GetAllVMs',
+            pre_event=True, dest=dom0, arg='')
+
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.property.GetAllVMs', b'test-vm1')
+
+    def test_029_vm_property_get_all_error(self):
+        def serialize_property(dest, name):
+            if name == 'kernel':
+                raise qubes.exc.QubesException('failed')
+            return 'default=True type=str value'
+        with unittest.mock.patch.object(qubes.api.admin.QubesAdminAPI,
+                '_serialize_property', side_effect=serialize_property):
+            value = self.call_mgmt_func(b'admin.vm.property.GetAll',
+                b'test-vm1')
+        lines = value.splitlines()
+        self.assertIn('kernel error=QubesException failed', lines)
+        self.assertIn('vcpus default=True type=str value', lines)
+
     def test_030_vm_property_set_vm(self):
         netvm = self.app.add_new_vm('AppVM', label='red', name='test-net',
             template='test-template', provides_network=True)
@@ -307,6 +372,83 @@ class TC_00_VMs(AdminAPITestCase):
             self.assertFalse(mock.called)
         self.assertFalse(self.app.save.called)
 
+    def test_045_vm_property_set_many(self):
+        self.vm.kernelopts = 'old'
+        value = self.call_mgmt_func(b'admin.vm.property.SetMany', b'dom0',
+            payload=b'test-vm1 vcpus 4\n'
+                b'test-vm1 kernelopts new\\nline\\\\\n'
+                b'test-template vcpus 3\n')
+        self.assertIsNone(value)
+        self.assertEqual(self.vm.vcpus, 4)
+        self.assertEqual(self.vm.kernelopts, 'new\nline\\')
+        self.assertEqual(self.template.vcpus, 3)
+        self.app.save.assert_called_once_with()
+
+    def test_046_vm_property_set_many_invalid(self):
+        for payload in (
+                b'test-vm1 vcpus 4\ntest-vm1 vcpus invalid\n',
+                b'test-vm1 vcpus 4\ntest-vm1 no_such_property 1\n',
+                b'test-vm1 vcpus 4\nno-such-vm vcpus 1\n',
+                b'test-vm1 vcpus 4\ntest-vm1 vcpus\n',
+                b'test-vm1 vcpus 4\ntest-vm1 kernelopts invalid\\escape\n',
+                b'',
+                ):
+            with self.subTest(payload=payload):
+                with unittest.mock.patch('qubes.property.__set__') as mock:
+                    with self.assertRaises((qubes.exc.QubesException,
+                            qubes.api.ProtocolError,
+                            qubes.api.PermissionDenied)):
+                        self.call_mgmt_func(b'admin.vm.property.SetMany',
+                            b'dom0', payload=payload)
+                    self.assertFalse(mock.called)
+        self.assertFalse(self.app.save.called)
+
+    def test_047_vm_property_set_many_rollback(self):
+        self.vm.kernelopts = 'old'
+        self.template.vcpus = 3
+        # netvm has to provide network, which is checked only when the
+        # property is set
+        with self.assertRaises(qubes.exc.QubesValueError):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'dom0',
+                payload=b'test-vm1 vcpus 4\n'
+                    b'test-vm1 kernelopts new\n'
+                    b'test-template vcpus 1\n'
+                    b'test-vm1 netvm test-template\n')
+        self.assertTrue(self.vm.property_is_default('vcpus'))
+        self.assertEqual(self.vm.kernelopts, 'old')
+        self.assertEqual(self.template.vcpus, 3)
+        self.assertTrue(self.vm.property_is_default('netvm'))
+        self.assertFalse(self.app.save.called)
+
+    def test_048_vm_property_set_many_permission(self):
+        checked = []
+
+        def fire_event(event, pre_event=False, dest=None, arg=None,
+                newvalue=None):
+            checked.append((event, dest.name, arg, newvalue))
+            if dest.name == 'test-template':
+                raise qubes.api.PermissionDenied()
+        self.app.domains[0].fire_event = fire_event
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.property.SetMany', b'dom0', b'')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.loop.run_until_complete(mgmt_obj.execute(
+                untrusted_payload=b'test-vm1 vcpus 4\n'
+                    b'test-template vcpus 3\n'))
+        self.assertEqual(checked, [
+            ('admin-permission:admin.vm.property.SetMany', 'dom0', '', None),
+            ('admin-permission:admin.vm.property.Set', 'test-vm1',
+                'vcpus', 4),
+            ('admin-permission:admin.vm.property.Set', 'test-template',
+                'vcpus', 3),
+        ])
+        self.assertTrue(self.vm.property_is_default('vcpus'))
+        self.assertFalse(self.app.save.called)
+
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+                payload=b'test-vm1 vcpus 4\n')
+
     def test_050_vm_property_help(self):
         value = self.call_mgmt_func(b'admin.vm.property.Help', b'test-vm1',
             b'label')
@@ -946,6 +1088,80 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         func_mock.assert_called_once_with()
 
+    def test_221_start_many(self):
+        failed = {}
+        func_mock = unittest.mock.Mock(return_value=failed)
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        with unittest.mock.patch('qubes.batch.start_many', coroutine_mock):
+            value = self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'2',
+                b'test-vm1\ntest-template\n')
+            self.assertIsNone(value)
+            func_mock.assert_called_once_with(self.app,
+                [self.vm, self.template], 2)
+
+            failed[self.vm] = qubes.exc.QubesException('failed')
+            with self.assertRaises(qubes.exc.QubesException) as e:
+                self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'',
+                    b'test-vm1')
+            self.assertEqual(str(e.exception),
+                'Failed to start: test-vm1 (failed)')
+            func_mock.assert_called_with(self.app, [self.vm],
+                qubes.batch.DEFAULT_CONCURRENCY)
+
+    def test_222_start_many_invalid(self):
+        func_mock = unittest.mock.Mock(return_value={})
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        with unittest.mock.patch('qubes.batch.start_many', coroutine_mock):
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'',
+                    b'test-vm1\nno-such-vm\n')
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'0',
+                    b'test-vm1')
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'', b'')
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.call_mgmt_func(b'admin.vm.StartMany', b'test-vm1', b'',
+                    b'test-vm1')
+        self.assertFalse(func_mock.called)
+
+    def test_223_start_many_permission(self):
+        self.netvm = self.app.add_new_vm('AppVM', label='red',
+            name='test-net1', template='test-template', provides_network=True)
+        self.vm.netvm = self.netvm
+        checked = []
+
+        def fire_event(event, pre_event=False, **kwargs):
+            # pylint: disable=unused-argument
+            checked.append((event, kwargs['dest'].name))
+            if event == 'admin-permission:admin.vm.Start' and \
+                    kwargs['dest'] is self.netvm:
+                raise qubes.api.PermissionDenied()
+        self.app.domains[0].fire_event = fire_event
+
+        func_mock = unittest.mock.Mock(return_value={})
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.StartMany', b'dom0', b'')
+        with unittest.mock.patch('qubes.batch.start_many', coroutine_mock):
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.loop.run_until_complete(mgmt_obj.execute(
+                    untrusted_payload=b'test-vm1\n'))
+        self.assertEqual(checked, [
+            ('admin-permission:admin.vm.StartMany', 'dom0'),
+            ('admin-permission:admin.vm.Start', 'test-net1'),
+        ])
+        self.assertFalse(func_mock.called)
+
     def test_230_shutdown(self):
         func_mock = unittest.mock.Mock()
 
@@ -957,6 +1173,87 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         func_mock.assert_called_once_with()
 
+    def test_231_shutdown_many(self):
+        failed = {}
+        func_mock = unittest.mock.Mock(return_value=failed)
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        with unittest.mock.patch('qubes.batch.shutdown_many', coroutine_mock):
+            value = self.call_mgmt_func(b'admin.vm.ShutdownMany', b'dom0',
+                b'30', b'test-vm1 test-template')
+            self.assertIsNone(value)
+            func_mock.assert_called_once_with(self.app,
+                [self.vm, self.template], 30)
+
+            failed[self.vm] = qubes.exc.QubesException('failed')
+            with self.assertRaises(qubes.exc.QubesException) as e:
+                self.call_mgmt_func(b'admin.vm.ShutdownMany', b'dom0', b'',
+                    b'test-vm1')
+            self.assertEqual(str(e.exception),
+                'Failed to shut down: test-vm1 (failed)')
+            func_mock.assert_called_with(self.app, [self.vm], None)
+
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.call_mgmt_func(b'admin.vm.ShutdownMany', b'dom0', b'-1',
+                    b'test-vm1')
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.call_mgmt_func(b'admin.vm.ShutdownMany', b'dom0', b'',
+                    b'no-such-vm')
+            self.assertEqual(func_mock.call_count, 2)
+
+    def test_235_phase_timings(self):
+        value = self.call_mgmt_func(b'admin.vm.PhaseTimings', b'test-vm1')
+        self.assertEqual(value, '')
+
+        timings = qubes.vm.qubesvm.PhaseTimings('start')
+        timings.time = 1500000000
+        timings.phases = [('domain-pre-start', 0, 0.25),
+            ('storage-start', 0.25, 1.5)]
+        timings.handlers['qubes.ext.gui.GUI.on_domain_spawn'] = 0.5
+        timings.total = 2
+        timings.result = 'ok'
+        self.vm.phase_timings.append(timings)
+        value = self.call_mgmt_func(b'admin.vm.PhaseTimings', b'test-vm1')
+        self.assertEqual(value,
+            'start time=1500000000.000000 total=2.000000 result=ok\n'
+            'phase domain-pre-start offset=0.000000 time=0.250000\n'
+            'phase storage-start offset=0.250000 time=1.500000\n'
+            'handler qubes.ext.gui.GUI.on_domain_spawn time=0.500000\n')
+
+        value = self.call_mgmt_func(b'admin.vm.PhaseTimings', b'dom0')
+        self.assertEqual(value, '')
+
+    def test_232_shutdown_many_permission(self):
+        checked = []
+
+        def fire_event(event, pre_event=False, **kwargs):
+            # pylint: disable=unused-argument
+            checked.append((event, kwargs['dest'].name))
+            if event == 'admin-permission:admin.vm.Shutdown' and \
+                    kwargs['dest'] is self.vm:
+                raise qubes.api.PermissionDenied()
+        self.app.domains[0].fire_event = fire_event
+
+        func_mock = unittest.mock.Mock(return_value={})
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.ShutdownMany', b'dom0', b'')
+        with unittest.mock.patch('qubes.batch.shutdown_many', coroutine_mock):
+            with self.assertRaises(qubes.api.PermissionDenied):
+                self.loop.run_until_complete(mgmt_obj.execute(
+                    untrusted_payload=b'test-template test-vm1'))
+        self.assertEqual(checked, [
+            ('admin-permission:admin.vm.ShutdownMany', 'dom0'),
+            ('admin-permission:admin.vm.Shutdown', 'test-template'),
+            ('admin-permission:admin.vm.Shutdown', 'test-vm1'),
+        ])
+        self.assertFalse(func_mock.called)
+
     def test_240_pause(self):
         func_mock = unittest.mock.Mock()
 
@@ -1046,6 +1343,54 @@ class TC_00_VMs(AdminAPITestCase):
                 unittest.mock.call(vm2, 'test-event2', arg1='abc'),
             ])
 
+    def test_272_events_shared(self):
+        dom0_send = unittest.mock.Mock(spec=[])
+        filtered_send = unittest.mock.Mock(spec=[])
+        vm_send = unittest.mock.Mock(spec=[])
+        tasks = []
+        for dest, send_serialized_event, filters in (
+                (b'dom0', dom0_send, []),
+                (b'dom0', filtered_send,
+                    [lambda ev: ev[1] != 'test-event']),
+                (b'test-vm1', vm_send, []),
+                ):
+            self.emitter.fire_event = unittest.mock.Mock(
+                return_value=filters)
+            self.app.domains[0].fire_event = self.emitter.fire_event
+            mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+                b'admin.Events', dest, b'',
+                send_event=unittest.mock.Mock(spec=[]),
+                send_serialized_event=send_serialized_event)
+            tasks.append((mgmt_obj, asyncio.ensure_future(
+                mgmt_obj.execute(untrusted_payload=b''))))
+            self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertIn(self.app, qubes.api.admin.QubesMgmtEventsHub.hubs)
+
+        with unittest.mock.patch.object(qubes.api.QubesDaemonProtocol,
+                'serialize_event',
+                wraps=qubes.api.QubesDaemonProtocol.serialize_event) \
+                as serialize_event:
+            self.vm.fire_event('test-event', arg1='abc')
+            self.template.fire_event('test-event2')
+            self.vm.fire_event('admin-permission:admin.vm.List')
+            self.app.fire_event('test-event3')
+        self.assertEqual(serialize_event.call_count, 3)
+
+        self.assertEqual(dom0_send.mock_calls, [
+            unittest.mock.call(b'1\0test-vm1\0test-event\0arg1\0abc\0\0',
+                None),
+            unittest.mock.call(b'1\0test-template\0test-event2\0\0', None),
+            unittest.mock.call(b'1\0\0test-event3\0\0', None),
+        ])
+        self.assertEqual(filtered_send.mock_calls, dom0_send.mock_calls[1:])
+        self.assertEqual(vm_send.mock_calls, dom0_send.mock_calls[:1])
+
+        for mgmt_obj, task in tasks:
+            mgmt_obj.cancel()
+            self.loop.run_until_complete(task)
+        self.assertNotIn(self.app, qubes.api.admin.QubesMgmtEventsHub.hubs)
+        self.assertEqual(self.vm.fire_event('test-event'), [])
+
     def test_280_feature_list(self):
         self.vm.features['test-feature'] = 'some-value'
         value = self.call_mgmt_func(b'admin.vm.feature.List', b'test-vm1')
@@ -1167,6 +1512,76 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertNotIn('test-feature', self.vm.features)
         self.assertFalse(self.app.save.called)
 
+    def test_322_feature_set_many(self):
+        self.vm.features['test-feature2'] = 'old'
+        value = self.call_mgmt_func(b'admin.vm.feature.SetMany', b'dom0',
+            payload=b'test-vm1 test-feature some-value\n'
+                b'test-vm1 test-feature2 \n'
+                b'test-template test-feature other-value\n')
+        self.assertIsNone(value)
+        self.assertEqual(self.vm.features['test-feature'], 'some-value')
+        self.assertEqual(self.vm.features['test-feature2'], '')
+        self.assertEqual(self.template.features['test-feature'],
+            'other-value')
+        self.app.save.assert_called_once_with()
+
+    def test_323_feature_set_many_invalid(self):
+        for payload in (
+                b'test-vm1 test-feature value\n'
+                    b'test-vm1 test-feature \x02\x03\xffsome-value\n',
+                b'test-vm1 test-feature value\ntest-vm1 test/feature 1\n',
+                b'test-vm1 test-feature value\nno-such-vm test-feature 1\n',
+                ):
+            with self.subTest(payload=payload):
+                with self.assertRaises((qubes.exc.QubesException,
+                        qubes.api.ProtocolError, qubes.api.PermissionDenied,
+                        UnicodeDecodeError)):
+                    self.call_mgmt_func(b'admin.vm.feature.SetMany', b'dom0',
+                        payload=payload)
+                self.assertNotIn('test-feature', self.vm.features)
+        self.assertFalse(self.app.save.called)
+
+    def test_324_feature_set_many_rollback(self):
+        self.vm.features['test-feature2'] = 'old'
+
+        def fail(subject, event, **kwargs):
+            raise qubes.exc.QubesException('failed')
+        self.template.add_handler('domain-feature-set:test-feature3', fail)
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.vm.feature.SetMany', b'dom0',
+                payload=b'test-vm1 test-feature value\n'
+                    b'test-vm1 test-feature2 new\n'
+                    b'test-template test-feature3 value\n')
+        self.assertNotIn('test-feature', self.vm.features)
+        self.assertEqual(self.vm.features['test-feature2'], 'old')
+        self.assertNotIn('test-feature3', self.template.features)
+        self.assertFalse(self.app.save.called)
+
+    def test_325_feature_set_many_permission(self):
+        checked = []
+
+        def fire_event(event, pre_event=False, dest=None, arg=None,
+                value=None):
+            checked.append((event, dest.name, arg, value))
+            if dest.name == 'test-template':
+                raise qubes.api.PermissionDenied()
+        self.app.domains[0].fire_event = fire_event
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.feature.SetMany', b'dom0', b'')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.loop.run_until_complete(mgmt_obj.execute(
+                untrusted_payload=b'test-vm1 test-feature value\n'
+                    b'test-template test-feature other-value\n'))
+        self.assertEqual(checked, [
+            ('admin-permission:admin.vm.feature.SetMany', 'dom0', '', None),
+            ('admin-permission:admin.vm.feature.Set', 'test-vm1',
+                'test-feature', 'value'),
+            ('admin-permission:admin.vm.feature.Set', 'test-template',
+                'test-feature', 'other-value'),
+        ])
+        self.assertNotIn('test-feature', self.vm.features)
+        self.assertFalse(self.app.save.called)
+
     @asyncio.coroutine
     def dummy_coro(self, *args, **kwargs):
         pass
@@ -1417,6 +1832,13 @@ class TC_00_VMs(AdminAPITestCase):
             b'default_kernel')
         self.assertEqual(value, 'default=False type=str 1.0')
 
+    def test_411_property_get_all(self):
+        # actual function tested for admin.vm.property.* already
+        value = self.call_mgmt_func(b'admin.property.GetAll', b'dom0')
+        self.assertIn('default_kernel default=False type=str 1.0\n', value)
+        self.assertEqual(len(value.splitlines()),
+            len(self.app.property_list()))
+
     def test_420_propert_set_str(self):
         # actual function tested for admin.vm.property.* already
         with unittest.mock.patch('qubes.property.__set__') as mock:
@@ -2173,8 +2595,8 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEventFired(self.emitter,
             'admin-permission:' + 'admin.vm.Stats')
         self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
-            unittest.mock.call(None, None, only_vm=None),
-            unittest.mock.call(0, stats1, only_vm=None),
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
         ])
         self.assertEqual(send_event.mock_calls, [
             unittest.mock.call(self.app, 'connection-established'),
@@ -2240,8 +2662,8 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEventFired(self.emitter,
             'admin-permission:' + 'admin.vm.Stats')
         self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
-            unittest.mock.call(None, None, only_vm=self.vm),
-            unittest.mock.call(0, stats1, only_vm=self.vm),
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
         ])
         self.assertEqual(send_event.mock_calls, [
             unittest.mock.call(self.app, 'connection-established'),
@@ -2255,6 +2677,171 @@ class TC_00_VMs(AdminAPITestCase):
                     memory_kb=stats2[2]['memory_kb']),
             ])
 
+    def test_632_vm_stats_shared(self):
+        send_event1 = unittest.mock.Mock(spec=[])
+        send_event2 = unittest.mock.Mock(spec=[])
+
+        stats1 = {
+            1: {
+                'cpu_time': 2849496569205,
+                'cpu_usage': 0,
+                'memory_kb': 303916,
+            },
+            2: {
+                'cpu_time': 2849496569205,
+                'cpu_usage': 0,
+                'memory_kb': 303916,
+            },
+        }
+        stats2 = copy.deepcopy(stats1)
+        stats2[1]['cpu_usage'] = 5
+        stats2[2]['cpu_usage'] = 7
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.side_effect = [
+            (0, stats1), (1, stats2),
+        ]
+        self.app.stats_interval = 1
+        mgmt_obj1 = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'dom0', b'', send_event=send_event1)
+        mgmt_obj2 = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'test-vm1', b'2', send_event=send_event2)
+
+        def cancel_call():
+            mgmt_obj1.cancel()
+            mgmt_obj2.cancel()
+
+        class MockVM(object):
+            def __init__(self, name):
+                self._name = name
+
+            def name(self):
+                return self._name
+
+        loop = asyncio.get_event_loop()
+        self.app.vmm.libvirt_conn.lookupByID.side_effect = lambda xid: {
+            1: MockVM('test-template'),
+            2: MockVM('test-vm1')}[xid]
+        execute_task = asyncio.ensure_future(asyncio.gather(
+            mgmt_obj1.execute(untrusted_payload=b''),
+            mgmt_obj2.execute(untrusted_payload=b'')))
+        loop.call_later(1.1, cancel_call)
+        loop.run_until_complete(execute_task)
+        self.assertEqual(execute_task.result(), [None, None])
+        # both calls share the same samples
+        self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
+        ])
+        self.assertEqual(self.app.vmm.libvirt_conn.lookupByID.mock_calls, [
+            unittest.mock.call(1),
+            unittest.mock.call(2),
+        ])
+        self.assertEqual(send_event1.mock_calls, [
+            unittest.mock.call(self.app, 'connection-established'),
+            unittest.mock.call('test-template', 'vm-stats',
+                cpu_time=stats1[1]['cpu_time'] // 1000000,
+                cpu_usage=stats1[1]['cpu_usage'],
+                memory_kb=stats1[1]['memory_kb']),
+            unittest.mock.call('test-vm1', 'vm-stats',
+                cpu_time=stats1[2]['cpu_time'] // 1000000,
+                cpu_usage=stats1[2]['cpu_usage'],
+                memory_kb=stats1[2]['memory_kb']),
+            unittest.mock.call('test-template', 'vm-stats',
+                cpu_time=stats2[1]['cpu_time'] // 1000000,
+                cpu_usage=stats2[1]['cpu_usage'],
+                memory_kb=stats2[1]['memory_kb']),
+            unittest.mock.call('test-vm1', 'vm-stats',
+                cpu_time=stats2[2]['cpu_time'] // 1000000,
+                cpu_usage=stats2[2]['cpu_usage'],
+                memory_kb=stats2[2]['memory_kb']),
+        ])
+        # only every second sample, only about test-vm1
+        self.assertEqual(send_event2.mock_calls, [
+            unittest.mock.call(self.app, 'connection-established'),
+            unittest.mock.call('test-vm1', 'vm-stats',
+                cpu_time=stats1[2]['cpu_time'] // 1000000,
+                cpu_usage=stats1[2]['cpu_usage'],
+                memory_kb=stats1[2]['memory_kb']),
+        ])
+        self.assertNotIn(self.app, qubes.api.admin.QubesVMStatsSampler.samplers)
+
+    def test_633_vm_stats_domain_start(self):
+        send_event = unittest.mock.Mock(spec=[])
+
+        stats1 = {
+            0: {
+                'cpu_time': 243951379111104 // 8,
+                'cpu_usage': 0,
+                'memory_kb': 3733212,
+            },
+        }
+        stats2 = copy.deepcopy(stats1)
+        stats2[2] = {
+            'cpu_time': 2849496569205,
+            'cpu_usage': 5,
+            'memory_kb': 303916,
+        }
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.side_effect = [
+            (0, stats1), (1, stats2),
+        ]
+        self.app.stats_interval = 1
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'dom0', b'', send_event=send_event)
+
+        def start_vm():
+            self.app.vmm.offline_mode = False
+            self.app.vmm.libvirt_conn.lookupByUUID.return_value.ID\
+                .return_value = 2
+            self.vm.fire_event('domain-start', start_guid=False)
+
+        loop = asyncio.get_event_loop()
+        execute_task = asyncio.ensure_future(
+            mgmt_obj.execute(untrusted_payload=b''))
+        loop.call_later(0.5, start_vm)
+        loop.call_later(1.1, mgmt_obj.cancel)
+        loop.run_until_complete(execute_task)
+        self.assertIsNone(execute_task.result())
+        # name known from the event, no need to ask libvirt
+        self.assertFalse(self.app.vmm.libvirt_conn.lookupByID.called)
+        self.assertEqual(send_event.mock_calls, [
+            unittest.mock.call(self.app, 'connection-established'),
+            unittest.mock.call('dom0', 'vm-stats',
+                cpu_time=stats1[0]['cpu_time'] // 1000000,
+                cpu_usage=stats1[0]['cpu_usage'],
+                memory_kb=stats1[0]['memory_kb']),
+            unittest.mock.call('dom0', 'vm-stats',
+                cpu_time=stats2[0]['cpu_time'] // 1000000,
+                cpu_usage=stats2[0]['cpu_usage'],
+                memory_kb=stats2[0]['memory_kb']),
+            unittest.mock.call('test-vm1', 'vm-stats',
+                cpu_time=stats2[2]['cpu_time'] // 1000000,
+                cpu_usage=stats2[2]['cpu_usage'],
+                memory_kb=stats2[2]['memory_kb']),
+        ])
+
+    def test_634_vm_stats_error(self):
+        send_event = unittest.mock.Mock(spec=[])
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.side_effect = NotImplementedError
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'dom0', b'', send_event=send_event)
+        loop = asyncio.get_event_loop()
+        with self.assertRaises(NotImplementedError):
+            loop.run_until_complete(mgmt_obj.execute(untrusted_payload=b''))
+        self.assertNotIn(self.app, qubes.api.admin.QubesVMStatsSampler.samplers)
+
+    def test_635_vm_stats_invalid_arg(self):
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.Stats', b'dom0', b'0')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.Stats', b'dom0', b'-1')
+        self.assertNotIn(self.app, qubes.api.admin.QubesVMStatsSampler.samplers)
+
     @unittest.mock.patch('qubes.storage.Storage.create')
     def test_640_vm_create_disposable(self, mock_storage):
         mock_storage.side_effect = self.dummy_coro
@@ -2516,6 +3103,108 @@ class TC_00_VMs(AdminAPITestCase):
         with self.assertRaises(qubes.exc.QubesVMNotRunningError):
             self.call_mgmt_func(b'admin.vm.Console', b'test-vm1')
 
+    def test_700_permission_cache(self):
+        calls = []
+
+        def on_permission(subject, event, dest, arg, **kwargs):
+            # pylint: disable=unused-argument
+            calls.append((subject, dest, arg))
+            if arg == 'netvm':
+                raise qubes.api.PermissionDenied()
+        on_permission.ha_cacheable = True
+
+        def call(arg):
+            mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'test-vm1',
+                b'admin.vm.property.Get', b'test-vm1', arg)
+            return self.loop.run_until_complete(
+                mgmt_obj.execute(untrusted_payload=b''))
+
+        self.vm.add_handler('admin-permission:admin.vm.property.Get',
+            on_permission)
+        self.assertEqual(call(b'label'), 'default=False type=label red')
+        self.assertEqual(call(b'label'), 'default=False type=label red')
+        with self.assertRaises(qubes.api.PermissionDenied) as first:
+            call(b'netvm')
+        with self.assertRaises(qubes.api.PermissionDenied) as second:
+            call(b'netvm')
+        self.assertIsNot(first.exception, second.exception)
+        self.assertEqual(calls, [
+            (self.vm, self.vm, 'label'),
+            (self.vm, self.vm, 'netvm'),
+        ])
+        cache = qubes.api.PermissionCache.get(self.app)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # tags may be used by the policy
+        self.template.tags.add('some-tag')
+        call(b'label')
+        self.assertEqual(len(calls), 3)
+
+        # qubes may be used by the policy too
+        self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        call(b'label')
+        call(b'label')
+        self.assertEqual(len(calls), 4)
+
+        # admin.Events calls do not prevent caching
+        subscriber = qubes.api.admin.QubesMgmtEventsSubscriber(None, [],
+            unittest.mock.Mock())
+        qubes.api.admin.QubesMgmtEventsHub.subscribe(self.app, subscriber)
+        try:
+            call(b'label')
+        finally:
+            qubes.api.admin.QubesMgmtEventsHub.unsubscribe(self.app,
+                subscriber)
+        self.assertEqual(len(calls), 4)
+
+        # effects of not cacheable handlers are not cached
+        self.vm.add_handler('admin-permission:admin.vm.property.Get',
+            lambda subject, event, **kwargs: None)
+        call(b'label')
+        call(b'label')
+        self.assertEqual(len(calls), 6)
+        self.assertEqual((cache.hits, cache.misses), (4, 4))
+
+    def test_710_daemon_stats(self):
+        request_stats = qubes.api.RequestStats()
+        request_stats.record(0.002, True)
+        request_stats.record(20, False)
+        event_counts = collections.Counter()
+        self.app.saves = 3
+        self.app.save_time = 0.5
+        self.app.saves_coalesced = 7
+        with unittest.mock.patch.object(qubes.api.QubesDaemonProtocol,
+                    'request_stats', {'admin.vm.List': request_stats}), \
+                unittest.mock.patch.object(qubes.events.Emitter,
+                    'event_counts', event_counts), \
+                unittest.mock.patch.object(qubes.api.QubesDaemonProtocol,
+                    'connections', set()):
+            self.vm.fire_event('test-event')
+            self.vm.fire_event('test-event:arg')
+            value = self.call_mgmt_func(b'admin.daemon.Stats', b'dom0')
+        lines = value.splitlines()
+        self.assertEqual(lines[0], 'connections 0')
+        self.assertRegex(lines[1], r'^tasks \d+$')
+        self.assertEqual(lines[2:], [
+            'events-subscribers 0',
+            'stats-subscribers 0',
+            'permission-cache hits=0 misses=0',
+            'save count=3 time=0.500000 coalesced=7',
+            'method admin.vm.List count=2 errors=1 time=20.002000 '
+            'latency=0.001:0,0.005:1,0.01:0,0.05:0,0.1:0,0.5:0,1:0,5:0,'
+            '10:0,inf:1',
+            'event test-event 2',
+        ])
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.daemon.Stats')
+
+    def test_711_daemon_stats_invalid(self):
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.daemon.Stats', b'test-vm1')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.daemon.Stats', b'dom0', b'arg')
+
     def test_990_vm_unexpected_payload(self):
         methods_with_no_payload = [
             b'admin.vm.List',
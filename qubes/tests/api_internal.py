@@ -18,7 +18,14 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 import asyncio
+import os
+import pstats
+import shutil
+import tempfile
+import time
+
 import qubes.api.internal
+import qubes.profiler
 import qubes.tests
 import qubes.vm.adminvm
 from unittest import mock
@@ -162,3 +169,131 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
             no_qrexec_vm.mock_calls)
         self.assertIn(('resume', (), {}),
             no_qrexec_vm.mock_calls)
+
+    def setup_profile_dir(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        patch = mock.patch.object(qubes.profiler.Profiler, 'output_dir',
+            profile_dir)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return profile_dir
+
+    def profile(self, kind, payload, during_profiling):
+        mgmt_obj = qubes.api.internal.QubesInternalAPI(self.app,
+            b'dom0', b'internal.daemon.Profile', b'dom0', kind)
+        loop = asyncio.get_event_loop()
+        task = asyncio.ensure_future(
+            mgmt_obj.execute(untrusted_payload=payload))
+        loop.run_until_complete(asyncio.sleep(0))
+        during_profiling()
+        return loop.run_until_complete(task)
+
+    def test_002_autostart(self):
+        dom0 = mock.NonCallableMock(spec=qubes.vm.adminvm.AdminVM)
+        autostart_vm = self.create_mockvm()
+        autostart_vm.autostart = True
+        other_vm = self.create_mockvm()
+        other_vm.autostart = False
+
+        domains_dict = {
+            'dom0': dom0,
+            'autostart': autostart_vm,
+            'other': other_vm,
+        }
+        self.addCleanup(domains_dict.clear)
+        self.app.domains = mock.MagicMock(**{
+            '__iter__': lambda _: iter(domains_dict.values()),
+            '__getitem__': lambda _, key: domains_dict[key],
+        })
+        dom0.name = 'dom0'
+
+        func_mock = mock.Mock(return_value={})
+        with mock.patch('qubes.batch.start_many', mock_coro(func_mock)):
+            ret = self.call_mgmt_func(b'internal.Autostart')
+        self.assertIsNone(ret)
+        func_mock.assert_called_once_with(self.app, [autostart_vm])
+
+    def test_003_shutdown_all(self):
+        dom0 = mock.NonCallableMock(spec=qubes.vm.adminvm.AdminVM)
+        dom0.name = 'dom0'
+        vm = self.create_mockvm()
+        domains_dict = {'dom0': dom0, 'test-vm': vm}
+        self.addCleanup(domains_dict.clear)
+        self.app.domains = mock.MagicMock(**{
+            '__iter__': lambda _: iter(domains_dict.values()),
+            '__getitem__': lambda _, key: domains_dict[key],
+        })
+
+        func_mock = mock.Mock(return_value={})
+        with mock.patch('qubes.batch.shutdown_many', mock_coro(func_mock)):
+            ret = self.call_mgmt_func(b'internal.ShutdownAll', b'150')
+        self.assertIsNone(ret)
+        func_mock.assert_called_once_with(self.app, [dom0, vm], 150)
+
+    def test_010_profile_deterministic(self):
+        profile_dir = self.setup_profile_dir()
+
+        def during_profiling():
+            profiler = qubes.api.QubesDaemonProtocol.profiler
+            self.assertIsInstance(profiler,
+                qubes.profiler.DeterministicProfiler)
+            profiler.request_done()
+            self.assertIsNotNone(qubes.api.QubesDaemonProtocol.profiler)
+            profiler.request_done()
+
+        path = self.profile(b'deterministic', b'requests=2', during_profiling)
+        self.assertEqual(os.path.dirname(path), profile_dir)
+        self.assertTrue(path.endswith('.prof'))
+        stats = pstats.Stats(path)
+        self.assertTrue(any(func[2] == 'request_done'
+            for func in stats.stats))  # pylint: disable=no-member
+        self.assertIsNone(qubes.api.QubesDaemonProtocol.profiler)
+
+    def test_011_profile_sampling(self):
+        self.setup_profile_dir()
+
+        def during_profiling():
+            # use some CPU time, so there is something to sample
+            start_time = time.process_time()
+            while time.process_time() - start_time < 0.1:
+                pass
+
+        path = self.profile(b'sampling', b'seconds=1', during_profiling)
+        self.assertTrue(path.endswith('.folded'))
+        with open(path) as samples_file:
+            samples = samples_file.read().splitlines()
+        self.assertTrue(samples)
+        for line in samples:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+            self.assertTrue(stack.startswith('(no request);'))
+        self.assertTrue(any('during_profiling' in line for line in samples))
+        self.assertIsNone(qubes.api.QubesDaemonProtocol.profiler)
+
+    def test_012_profile_invalid(self):
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'internal.daemon.Profile', b'other',
+                b'seconds=1')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'internal.daemon.Profile', b'sampling',
+                b'minutes=1')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'internal.daemon.Profile', b'sampling',
+                b'seconds=0')
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call_mgmt_func(b'internal.daemon.Profile', b'sampling',
+                b'seconds')
+        self.assertIsNone(qubes.api.QubesDaemonProtocol.profiler)
+
+    def test_013_profile_in_progress(self):
+        self.setup_profile_dir()
+
+        def during_profiling():
+            with self.assertRaises(qubes.exc.QubesException):
+                self.call_mgmt_func(b'internal.daemon.Profile',
+                    b'deterministic', b'requests=1')
+            qubes.api.QubesDaemonProtocol.profiler.request_done()
+
+        self.profile(b'deterministic', b'requests=1', during_profiling)
+        self.assertIsNone(qubes.api.QubesDaemonProtocol.profiler)
@@ -20,7 +20,10 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
+import errno
 import os
+import random
 import unittest.mock as mock
 
 import lxml.etree
@@ -252,6 +255,26 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertEventFired(self.app, 'domain-delete',
             kwargs={'vm': self.testvm2})
 
+    def test_009_lookup_miss(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+        self.assertEqual(list(self.vms.qids()), [1, 2])
+
+        with mock.patch.object(self.vms, '_reindex') as mock_reindex:
+            self.assertNotIn('testvm3', self.vms)
+            with self.assertRaises(KeyError):
+                # pylint: disable=pointless-statement
+                self.vms['testvm3']
+            self.assertFalse(mock_reindex.called)
+
+        del self.vms['testvm2']
+        self.assertEqual(list(self.vms.qids()), [1])
+
+        # modified behind our back
+        self.vms._dict[2] = self.testvm2
+        self.assertIs(self.vms['testvm2'], self.testvm2)
+        self.assertEqual(list(self.vms.qids()), [1, 2])
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
@@ -449,6 +472,10 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
             os.unlink('/tmp/qubestest.xml')
         except:
             pass
+        try:
+            os.unlink('/tmp/qubestest.xml.journal')
+        except:
+            pass
         super().tearDown()
 
     def setUp(self):
@@ -567,6 +594,495 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
             with self.assertRaises(qubes.exc.QubesVMInUseError):
                 del self.app.domains[appvm]
 
+    def test_300_dependents_template(self):
+        template2 = self.app.add_new_vm('TemplateVM', name='test-template2',
+            label='green')
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.assertEqual(self.app.domains.get_vms_based_on(self.template),
+            {appvm})
+        self.assertEqual(list(self.template.appvms), [appvm])
+        appvm.template = template2
+        self.assertEqual(self.app.domains.get_vms_based_on(self.template),
+            set())
+        self.assertEqual(self.app.domains.get_vms_based_on(template2),
+            {appvm})
+        self.assertEqual(self.app.domains.check_dependents(), [])
+
+    def test_301_dependents_netvm(self):
+        netvm = self.app.add_new_vm('AppVM', name='test-netvm',
+            template=self.template, provides_network=True, label='red')
+        netvm2 = self.app.add_new_vm('AppVM', name='test-netvm2',
+            template=self.template, provides_network=True, label='red')
+        netvm.netvm = None
+        netvm2.netvm = None
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        appvm.netvm = netvm
+        self.assertEqual(set(netvm.connected_vms), {appvm})
+        self.assertEqual(set(netvm2.connected_vms), set())
+        appvm.netvm = netvm2
+        self.assertEqual(set(netvm.connected_vms), set())
+        self.assertEqual(set(netvm2.connected_vms), {appvm})
+        appvm.netvm = None
+        self.assertEqual(set(netvm2.connected_vms), set())
+        self.assertEqual(self.app.domains.check_dependents(), [])
+
+    def test_302_dependents_default_netvm(self):
+        netvm = self.app.add_new_vm('AppVM', name='test-netvm',
+            template=self.template, provides_network=True, label='red')
+        netvm2 = self.app.add_new_vm('AppVM', name='test-netvm2',
+            template=self.template, provides_network=True, label='red')
+        netvm.netvm = None
+        netvm2.netvm = None
+        self.app.default_netvm = netvm
+        # provides network, but uses default netvm
+        netvm3 = self.app.add_new_vm('AppVM', name='test-netvm3',
+            template=self.template, provides_network=True, label='red')
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.assertEqual(self.app.domains.get_vms_connected_to(netvm),
+            {appvm, netvm3})
+        self.app.default_netvm = netvm2
+        self.assertEqual(self.app.domains.get_vms_connected_to(netvm),
+            set())
+        self.assertEqual(set(netvm2.connected_vms), {netvm3, appvm})
+        self.assertEqual(self.app.domains.check_dependents(), [])
+        appvm.netvm = netvm
+        self.assertEqual(set(netvm.connected_vms), {appvm})
+        del appvm.netvm
+        self.assertEqual(set(netvm.connected_vms), set())
+        self.assertEqual(set(netvm2.connected_vms), {netvm3, appvm})
+        self.assertEqual(self.app.domains.check_dependents(), [])
+
+    def test_303_dependents_delete(self):
+        netvm = self.app.add_new_vm('AppVM', name='test-netvm',
+            template=self.template, provides_network=True, label='red')
+        netvm.netvm = None
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        appvm.netvm = netvm
+        self.assertEqual(set(netvm.connected_vms), {appvm})
+        with mock.patch.object(self.app, 'vmm'):
+            del self.app.domains[appvm]
+        self.assertEqual(set(netvm.connected_vms), set())
+        self.assertEqual(list(self.template.appvms), [netvm])
+        self.assertEqual(self.app.domains.check_dependents(), [])
+
+    def test_304_dependents_load(self):
+        netvm = self.app.add_new_vm('AppVM', name='test-netvm',
+            template=self.template, provides_network=True, label='red')
+        netvm.netvm = None
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        appvm.netvm = netvm
+        # build the indexes before saving
+        self.assertEqual(set(netvm.connected_vms), {appvm})
+        self.app.default_kernel = None
+        self.app.save()
+
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+        self.addCleanup(app.close)
+        self.assertEqual(app.domains.check_dependents(), [])
+        self.assertEqual(set(app.domains['test-netvm'].connected_vms),
+            {app.domains['test-vm']})
+        self.assertEqual(app.domains.get_vms_based_on('test-template'),
+            {app.domains['test-netvm'], app.domains['test-vm']})
+
+    def test_305_check_dependents(self):
+        netvm = self.app.add_new_vm('AppVM', name='test-netvm',
+            template=self.template, provides_network=True, label='red')
+        netvm.netvm = None
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.assertEqual(set(netvm.connected_vms), set())
+        # bypass property-set:netvm event
+        appvm.events_enabled = False
+        appvm.netvm = netvm
+        appvm.events_enabled = True
+        self.assertEqual(len(self.app.domains.check_dependents()), 2)
+        self.app.domains.invalidate_dependents()
+        self.assertEqual(set(netvm.connected_vms), {appvm})
+        self.assertEqual(self.app.domains.check_dependents(), [])
+
+    def test_400_save_coalesce(self):
+        self.app.default_kernel = None
+        self.app.save_delay = 0.01
+        with mock.patch.object(self.app, '_save_store',
+                wraps=self.app._save_store) as mock_save:
+            for _ in range(5):
+                self.app.save()
+            self.assertFalse(mock_save.called)
+            self.loop.run_until_complete(self.app.wait_for_save())
+            mock_save.assert_called_once_with(True)
+            self.assertEqual(self.app.saves_coalesced, 4)
+            self.assertTrue(os.path.exists('/tmp/qubestest.xml'))
+
+            # nothing pending
+            self.loop.run_until_complete(self.app.wait_for_save())
+            self.app.save()
+            self.assertEqual(mock_save.call_count, 1)
+            self.loop.run_until_complete(self.app.wait_for_save())
+            self.assertEqual(mock_save.call_count, 2)
+            self.assertEqual(self.app.saves_coalesced, 4)
+
+    def test_401_save_flush(self):
+        self.app.default_kernel = None
+        self.app.save_delay = 10
+        self.app.save()
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml'))
+        self.app.flush_save()
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml'))
+        self.loop.run_until_complete(
+            asyncio.wait_for(self.app.wait_for_save(), 1))
+
+    def test_402_save_error(self):
+        self.app.save_delay = 0.01
+        with mock.patch.object(self.app, '_save_store',
+                side_effect=OSError('disk full')):
+            self.app.save()
+            with self.assertRaises(OSError):
+                self.loop.run_until_complete(self.app.wait_for_save())
+
+    def test_410_xml_cache(self):
+        self.app.default_kernel = None
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        xpath = '//domain[@id="domain-{}"]/{}'.format(appvm.qid, '{}')
+        xml = self.app.__xml__()
+        self.assertEqual(xml.xpath(xpath.format(
+            'features/feature[@name="test"]')), [])
+        appvm.features['test'] = 'value'
+        xml = self.app.__xml__()
+        self.assertEqual(xml.xpath(xpath.format(
+            'features/feature[@name="test"]'))[0].text, 'value')
+
+        # no event, but still must be noticed
+        self.assertEqual(xml.xpath(xpath.format(
+            'volume-config/volume[@name="private"]'))[0].get('rw'), 'True')
+        appvm.volumes['private'].rw = False
+        xml = self.app.__xml__()
+        self.assertIsNone(xml.xpath(xpath.format(
+            'volume-config/volume[@name="private"]'))[0].get('rw'))
+        self.assertEqual(
+            len(xml.xpath(xpath.format('volume-config'))), 1)
+
+    def load_app(self):
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+        self.addCleanup(app.close)
+        return app
+
+    def test_500_journal(self):
+        self.app.default_kernel = None
+        self.app.use_journal = True
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml.journal'))
+        with open('/tmp/qubestest.xml', 'rb') as fh:
+            xml_data = fh.read()
+
+        appvm.features['test'] = 'value'
+        appvm.tags.add('test-tag')
+        self.app.save()
+        appvm2 = self.app.add_new_vm('AppVM', name='test-vm2',
+            template=self.template, label='red')
+        self.app.default_dispvm = appvm2
+        self.app.save()
+
+        with open('/tmp/qubestest.xml', 'rb') as fh:
+            self.assertEqual(fh.read(), xml_data)
+
+        app = self.load_app()
+        self.assertEqual(app.domains['test-vm'].features['test'], 'value')
+        self.assertIn('test-tag', app.domains['test-vm'].tags)
+        self.assertEqual(app.default_dispvm, app.domains['test-vm2'])
+
+        with mock.patch.object(self.app, 'vmm'):
+            del self.app.default_dispvm
+            del self.app.domains['test-vm2']
+        self.app.save()
+        app = self.load_app()
+        self.assertNotIn('test-vm2', app.domains)
+
+    def test_501_journal_interrupted_append(self):
+        self.app.default_kernel = None
+        self.app.use_journal = True
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        appvm.features['test'] = 'value'
+        self.app.save()
+        size = os.path.getsize('/tmp/qubestest.xml.journal')
+        appvm.features['test2'] = 'value2'
+        appvm2 = self.app.add_new_vm('AppVM', name='test-vm2',
+            template=self.template, label='red')
+        appvm.default_dispvm = appvm2
+        self.app.save()
+
+        # simulate a crash in the middle of writing the last commit
+        with open('/tmp/qubestest.xml.journal', 'r+b') as fh:
+            fh.truncate((size + os.path.getsize(fh.name)) // 2)
+
+        with self.assertLogs('qubes.journal', 'WARNING'):
+            app = self.load_app()
+        vm = app.domains['test-vm']
+        self.assertEqual(vm.features['test'], 'value')
+        # whole commit is lost, not only part of it
+        self.assertNotIn('test2', vm.features)
+        self.assertNotIn('test-vm2', app.domains)
+        self.assertEqual(vm.default_dispvm, None)
+
+        # first save after recovery writes qubes.xml from scratch
+        app.use_journal = True
+        vm.features['test3'] = 'value3'
+        app.save()
+        app = self.load_app()
+        self.assertEqual(app.domains['test-vm'].features['test3'], 'value3')
+
+    def test_502_journal_interrupted_compaction(self):
+        self.app.default_kernel = None
+        self.app.use_journal = True
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        appvm.features['test'] = 'value'
+        self.app.save()
+        with open('/tmp/qubestest.xml.journal', 'rb') as fh:
+            old_journal = fh.read()
+
+        self.app.journal_max_size = 0
+        appvm.features['test'] = 'value2'
+        self.app.save()
+        self.app.save()
+
+        # simulate crash after writing qubes.xml, but before new journal
+        with open('/tmp/qubestest.xml.journal', 'wb') as fh:
+            fh.write(old_journal)
+
+        with self.assertLogs('qubes.journal', 'WARNING'):
+            app = self.load_app()
+        self.assertEqual(app.domains['test-vm'].features['test'], 'value2')
+
+    def test_503_journal_compaction(self):
+        self.app.default_kernel = None
+        self.app.use_journal = True
+        self.app.journal_max_size = 4096
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+
+        @asyncio.coroutine
+        def change_and_save(value):
+            appvm.features['test'] = value
+            self.app.save()
+
+        for i in range(20):
+            self.loop.run_until_complete(change_and_save(str(i) * 200))
+            self.assertLess(os.path.getsize('/tmp/qubestest.xml.journal'),
+                4096 + 1024)
+        # let the last scheduled compaction run
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        app = self.load_app()
+        self.assertEqual(app.domains['test-vm'].features['test'], '19' * 200)
+
+    def test_504_journal_modified_elsewhere(self):
+        self.app.default_kernel = None
+        self.app.use_journal = True
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save(lock=False)
+        self.app.save(lock=False)
+
+        app = self.load_app()
+        app.use_journal = True
+        app.save(lock=False)
+        app.domains['test-vm'].features['test'] = 'value'
+        app.save(lock=False)
+
+        appvm.features['test'] = 'value2'
+        with self.assertRaises(qubes.exc.QubesException):
+            self.app.save(lock=False)
+
+    def test_505_journal_disabled(self):
+        self.app.default_kernel = None
+        self.app.use_journal = True
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        appvm.features['test'] = 'value'
+        self.app.save()
+        self.app.use_journal = False
+        self.app.save()
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+        app = self.load_app()
+        self.assertEqual(app.domains['test-vm'].features['test'], 'value')
+
+    def test_506_journal_append_failed(self):
+        self.app.default_kernel = None
+        self.app.use_journal = True
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        appvm.features['test'] = 'value'
+        self.app.save()
+        with open('/tmp/qubestest.xml.journal', 'rb') as fh:
+            old_journal = fh.read()
+
+        real_write = os.write
+
+        def write(fd, data):
+            if write.called:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            write.called = True
+            return real_write(fd, data[:len(data) // 2])
+        write.called = False
+
+        appvm.features['test'] = 'value2'
+        with mock.patch('os.write', write), \
+                mock.patch.object(self.app, '_save_full',
+                    side_effect=OSError(errno.ENOSPC, 'No space left')):
+            with self.assertLogs('app', 'ERROR'):
+                with self.assertRaises(OSError):
+                    self.app.save()
+        # the incomplete commit is not left for the next one to follow
+        with open('/tmp/qubestest.xml.journal', 'rb') as fh:
+            self.assertEqual(fh.read(), old_journal)
+
+        write.called = False
+        with mock.patch('os.write', write):
+            with self.assertLogs('app', 'ERROR'):
+                self.app.save()
+        appvm.features['test'] = 'value3'
+        self.app.save()
+        app = self.load_app()
+        self.assertEqual(app.domains['test-vm'].features['test'], 'value3')
+
+    def test_600_lazy_load(self):
+        # pylint: disable=protected-access
+        self.app.default_kernel = None
+        self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        xml = lxml.etree.tostring(self.load_app().__xml__())
+
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+            lazy_load=True)
+        self.addCleanup(app.close)
+        appvm = app.domains['test-vm']
+        self.assertEqual(appvm.template, app.domains['test-template'])
+        self.assertTrue(appvm._storage_deferred)
+        self.assertIsNone(appvm._log)
+        self.assertEqual(lxml.etree.tostring(app.__xml__()), xml)
+        self.assertTrue(appvm._storage_deferred)
+
+        self.assertEqual(appvm.volumes['root'].source,
+            app.domains['test-template'].volumes['root'])
+        self.assertFalse(appvm._storage_deferred)
+        self.assertIsNotNone(appvm.storage)
+        self.assertEqual(lxml.etree.tostring(app.__xml__()), xml)
+        self.assertEqual(appvm.log.name, 'vm.test-vm')
+
+    def test_610_cached_defaults_stress(self):
+        # the same random changes are made to self.app and to an app which
+        # caches defaults, and after each one all the cached defaults are
+        # compared with those computed directly
+        app = qubes.Qubes('/tmp/qubestest-cached.xml', load=False,
+            offline_mode=True, cache_defaults=True)
+        self.addCleanup(app.close)
+        app.load_initial_values()
+        app.add_new_vm('TemplateVM', name='test-template', label='green')
+
+        def populate(app):
+            app.default_kernel = None
+            app.add_new_vm('TemplateVM', name='test-template2',
+                label='green')
+            for name in ('test-net1', 'test-net2'):
+                app.add_new_vm('AppVM', name=name, template='test-template',
+                    provides_network=True, label='red')
+            for name in ('test-vm1', 'test-vm2', 'test-vm3'):
+                app.add_new_vm('AppVM', name=name, template='test-template',
+                    label='red')
+            app.add_new_vm('StandaloneVM', name='test-standalone',
+                label='red')
+            app.domains['test-vm1'].template_for_dispvms = True
+            app.add_new_vm('DispVM', name='test-disp', template='test-vm1',
+                label='red')
+
+        populate(self.app)
+        populate(app)
+
+        vms = [vm.name for vm in app.domains]
+        appvms = ['test-vm1', 'test-vm2', 'test-vm3', 'test-net1',
+            'test-net2']
+        netvms = [None, 'test-net1', 'test-net2']
+        changes = [
+            ('vm', vms, 'vcpus', [1, 2, 3]),
+            ('vm', vms, 'memory', [300, 400]),
+            ('vm', vms, 'kernel', [None, 'kernel1', 'kernel2']),
+            ('vm', vms, 'default_user', ['user', 'other']),
+            ('vm', vms, 'qrexec_timeout', [10, 20]),
+            ('vm', vms, 'netvm', netvms),
+            ('vm', vms, 'default_dispvm', [None, 'test-vm1']),
+            ('vm', vms, 'management_dispvm', [None, 'test-vm1']),
+            ('vm', ['test-net1', 'test-net2'], 'provides_network',
+                [False, True]),
+            ('vm', appvms, 'template', ['test-template', 'test-template2']),
+            ('vm', ['test-disp'], 'auto_cleanup', [False, True]),
+            ('feature', vms, 'ipv6', ['', '1']),
+            ('app', None, 'default_netvm', netvms),
+            ('app', None, 'default_kernel', [None, 'kernel1']),
+            ('app', None, 'default_qrexec_timeout', [30, 40]),
+            ('app', None, 'default_dispvm', [None, 'test-vm1']),
+            ('app', None, 'management_dispvm', [None, 'test-vm1']),
+        ]
+
+        def apply(app, kind, name, attr, value):
+            target = app if kind == 'app' else app.domains[name]
+            try:
+                if kind == 'feature':
+                    if value is qubes.property.DEFAULT:
+                        del target.features[attr]
+                    else:
+                        target.features[attr] = value
+                else:
+                    setattr(target, attr, value)
+            except (qubes.exc.QubesException, ValueError, AttributeError,
+                    KeyError) as e:
+                return type(e)
+            return None
+
+        def defaults(app):
+            result = {}
+            for vm in app.domains:
+                for prop in vm.property_list():
+                    if not prop.cache_default:
+                        continue
+                    try:
+                        value = getattr(vm, prop.__name__)
+                    except AttributeError as e:
+                        value = type(e)
+                    if isinstance(value, qubes.vm.BaseVM):
+                        value = value.name
+                    result[vm.name, prop.__name__] = value
+            return result
+
+        rand = random.Random(610)
+        with mock.patch.object(self.app, 'vmm'), \
+                mock.patch.object(app, 'vmm'):
+            self.assertEqual(defaults(app), defaults(self.app))
+            for _ in range(500):
+                kind, names, attr, values = rand.choice(changes)
+                name = rand.choice(names) if names else None
+                value = rand.choice(values + [qubes.property.DEFAULT])
+                self.assertEqual(apply(app, kind, name, attr, value),
+                    apply(self.app, kind, name, attr, value))
+                self.assertEqual(defaults(app), defaults(self.app),
+                    (kind, name, attr, value))
+            # pylint: disable=protected-access
+            self.assertTrue(any(vm._default_cache for vm in app.domains))
+
     @qubes.tests.skipUnlessGit
     def test_900_example_xml_in_doc(self):
         self.assertXMLIsValid(
@@ -0,0 +1,265 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import unittest.mock
+
+import qubes.batch
+import qubes.exc
+import qubes.tests
+
+
+class TestVM(object):
+    def __init__(self, name, started, netvm=None, fail=False):
+        self.name = name
+        self.netvm = netvm
+        self.fail = fail
+        self.log = unittest.mock.Mock()
+        self.running = False
+        self.started = started
+        self.shutdown_delay = 0
+        # time between creating the domain and start() returning
+        self.start_delay = 0
+        self.killed = False
+        self.paused = False
+        self.features = {}
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+    def get_power_state(self):
+        return 'Running' if self.running else 'Halted'
+
+    @asyncio.coroutine
+    def start(self, mem_reservation=None):
+        self.started.append((self.name, mem_reservation))
+        yield from asyncio.sleep(0)
+        if self.fail:
+            raise qubes.exc.QubesException('failed')
+        if mem_reservation is not None:
+            mem_reservation.close(self)
+        yield from asyncio.sleep(self.start_delay)
+        self.running = True
+
+    def is_halted(self):
+        return not self.running
+
+    def is_paused(self):
+        return self.paused
+
+    @asyncio.coroutine
+    def unpause(self):
+        self.started.append((self.name, 'unpause'))
+        self.paused = False
+
+    @asyncio.coroutine
+    def shutdown(self, wait=False, timeout=None):
+        self.started.append((self.name, timeout))
+        if self.fail:
+            raise qubes.exc.QubesException('failed')
+        if self.paused:
+            # would never finish
+            yield from asyncio.sleep(timeout)
+            raise qubes.exc.QubesVMShutdownTimeoutError(self)
+        if timeout is not None and self.shutdown_delay > timeout:
+            yield from asyncio.sleep(timeout)
+            raise qubes.exc.QubesVMShutdownTimeoutError(self)
+        yield from asyncio.sleep(self.shutdown_delay)
+        self.running = False
+
+    @asyncio.coroutine
+    def kill(self):
+        self.killed = True
+        self.running = False
+        self.paused = False
+
+
+class TC_00_StartMany(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.tests.TestEmitter()
+        self.app.events_enabled = True
+        self.started = []
+        self.sys_net = TestVM('sys-net', self.started)
+        self.sys_firewall = TestVM('sys-firewall', self.started,
+            netvm=self.sys_net)
+        self.work = TestVM('work', self.started, netvm=self.sys_firewall)
+        self.personal = TestVM('personal', self.started,
+            netvm=self.sys_firewall)
+        self.vault = TestVM('vault', self.started)
+
+    def test_000_order(self):
+        failed = self.loop.run_until_complete(qubes.batch.start_many(self.app,
+            [self.work, self.vault, self.personal], concurrency=2))
+        self.assertEqual(failed, {})
+        self.assertEqual([name for name, _ in self.started],
+            ['sys-net', 'vault', 'sys-firewall', 'personal', 'work'])
+        # one reservation per group of concurrently started qubes
+        reservations = [reservation for _, reservation in self.started]
+        self.assertIs(reservations[0], reservations[1])
+        self.assertIsNot(reservations[1], reservations[2])
+        self.assertIsNot(reservations[2], reservations[3])
+        self.assertIs(reservations[3], reservations[4])
+        self.assertEqual(reservations[3].vms, [self.personal, self.work])
+        self.assertEventFired(self.app, 'domain-start-many-result',
+            kwargs={'vm': self.work, 'reason': None})
+
+    def test_001_running(self):
+        self.sys_net.running = True
+        self.sys_firewall.running = True
+        failed = self.loop.run_until_complete(qubes.batch.start_many(self.app,
+            [self.work, self.sys_firewall]))
+        self.assertEqual(failed, {})
+        self.assertEqual([name for name, _ in self.started], ['work'])
+
+    def test_002_netvm_failed(self):
+        self.sys_firewall.fail = True
+        failed = self.loop.run_until_complete(qubes.batch.start_many(self.app,
+            [self.work, self.vault]))
+        self.assertEqual(sorted(failed), [self.sys_firewall, self.work])
+        self.assertEqual([name for name, _ in self.started],
+            ['sys-net', 'vault', 'sys-firewall'])
+        self.assertIn('sys-firewall', str(failed[self.work]))
+        self.assertEventFired(self.app, 'domain-start-many-result',
+            kwargs={'vm': self.work, 'reason': str(failed[self.work])})
+        self.assertEqual(qubes.batch.describe_failures(failed),
+            'sys-firewall (failed), work ({})'.format(failed[self.work]))
+
+    def test_003_not_enough_memory(self):
+        with unittest.mock.patch.object(qubes.batch.MemoryReservation,
+                'request', side_effect=qubes.exc.QubesMemoryError(self.vault)):
+            failed = self.loop.run_until_complete(
+                qubes.batch.start_many(self.app, [self.vault, self.sys_net]))
+        self.assertEqual(failed, {})
+        self.assertEqual(self.started,
+            [('sys-net', None), ('vault', None)])
+
+    def test_004_early_failure_releases_memory(self):
+        # personal fails before getting to its memory; the memory reserved
+        # for both is released as soon as work is created, not after work
+        # is fully started
+        self.personal.fail = True
+        self.work.start_delay = 0.1
+        self.sys_net.running = True
+        self.sys_firewall.running = True
+        released = []
+
+        def request(reservation):
+            reservation._client = unittest.mock.Mock(**{
+                'close.side_effect': lambda: released.append(
+                    self.work.running)})
+        with unittest.mock.patch.object(qubes.batch.MemoryReservation,
+                'request', request):
+            failed = self.loop.run_until_complete(qubes.batch.start_many(
+                self.app, [self.personal, self.work]))
+        self.assertEqual(sorted(failed), [self.personal])
+        self.assertEqual(released, [False])
+
+    def test_005_reservation_failed(self):
+        self.app.log = unittest.mock.Mock()
+        with unittest.mock.patch.object(qubes.batch.MemoryReservation,
+                'request', side_effect=IOError('no qmemman')):
+            failed = self.loop.run_until_complete(
+                qubes.batch.start_many(self.app, [self.vault, self.sys_net]))
+        self.assertEqual(failed, {})
+        self.assertEqual(self.started,
+            [('sys-net', None), ('vault', None)])
+        self.assertEventFired(self.app, 'domain-start-many-result',
+            kwargs={'vm': self.vault, 'reason': None})
+        self.assertTrue(self.app.log.warning.called)
+
+    def test_010_reservation(self):
+        reservation = qubes.batch.MemoryReservation(
+            [self.work, self.personal])
+        client = reservation._client = unittest.mock.Mock()
+        reservation.close(self.work)
+        reservation.close(self.work)
+        self.assertFalse(client.close.called)
+        reservation.close(self.personal)
+        client.close.assert_called_once_with()
+        reservation.release()
+        client.close.assert_called_once_with()
+
+
+class TC_01_ShutdownMany(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.tests.TestEmitter()
+        self.app.events_enabled = True
+        self.shut_down = []
+        self.sys_net = TestVM('sys-net', self.shut_down)
+        self.sys_firewall = TestVM('sys-firewall', self.shut_down,
+            netvm=self.sys_net)
+        self.work = TestVM('work', self.shut_down, netvm=self.sys_firewall)
+        self.vault = TestVM('vault', self.shut_down)
+        self.vms = [self.sys_net, self.sys_firewall, self.work, self.vault]
+        for vm in self.vms:
+            vm.running = True
+
+    def test_000_order(self):
+        failed = self.loop.run_until_complete(
+            qubes.batch.shutdown_many(self.app, self.vms, timeout=10))
+        self.assertEqual(failed, {})
+        self.assertEqual([name for name, _ in self.shut_down],
+            ['vault', 'work', 'sys-firewall', 'sys-net'])
+        self.assertTrue(all(vm.is_halted() for vm in self.vms))
+        self.assertFalse(any(vm.killed for vm in self.vms))
+        self.assertEventFired(self.app, 'domain-shutdown-many-result',
+            kwargs={'vm': self.sys_net, 'reason': None})
+
+    def test_001_timeout(self):
+        self.work.shutdown_delay = 1
+        failed = self.loop.run_until_complete(
+            qubes.batch.shutdown_many(self.app, self.vms, timeout=0.1))
+        self.assertEqual(failed, {})
+        self.assertTrue(all(vm.is_halted() for vm in self.vms))
+        self.assertTrue(self.work.killed)
+        # the first wave does not take the time of the next ones
+        self.assertFalse(self.sys_net.killed)
+        self.assertEqual(self.shut_down[-1][0], 'sys-net')
+        self.assertGreater(self.shut_down[-1][1], 0.02)
+
+    def test_002_client_failed(self):
+        self.work.fail = True
+        failed = self.loop.run_until_complete(
+            qubes.batch.shutdown_many(self.app, self.vms))
+        self.assertEqual(sorted(failed),
+            [self.sys_firewall, self.sys_net, self.work])
+        self.assertEqual([name for name, _ in self.shut_down],
+            ['vault', 'work'])
+        self.assertIn('work', str(failed[self.sys_firewall]))
+        self.assertEventFired(self.app, 'domain-shutdown-many-result',
+            kwargs={'vm': self.sys_net, 'reason': str(failed[self.sys_net])})
+
+    def test_003_paused(self):
+        self.work.paused = True
+        self.vault.paused = True
+        with unittest.mock.patch('qubes.vm.dispvm.DispVMPool.is_pooled',
+                lambda vm: vm is self.vault):
+            failed = self.loop.run_until_complete(
+                qubes.batch.shutdown_many(self.app, self.vms, timeout=10))
+        self.assertEqual(failed, {})
+        self.assertEqual(self.shut_down,
+            [('work', 'unpause'), ('work', unittest.mock.ANY),
+                ('sys-firewall', unittest.mock.ANY),
+                ('sys-net', unittest.mock.ANY)])
+        # pooled DispVM is just killed, the other one shut down cleanly
+        self.assertTrue(self.vault.killed)
+        self.assertFalse(self.work.killed)
+        self.assertTrue(all(vm.is_halted() for vm in self.vms))
+        self.assertEventFired(self.app, 'domain-shutdown-many-result',
+            kwargs={'vm': self.vault, 'reason': None})
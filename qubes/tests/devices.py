@@ -166,6 +166,9 @@ class TC_00_DeviceCollection(qubes.tests.QubesTestCase):
         self.collection.update_persistent(self.device, False)
         self.assertEqual(set(), set(self.collection.persistent()))
         self.assertEqual({self.device}, set(self.collection.attached()))
+        self.assertEventFired(self.emitter,
+            'device-persistent-set:testclass',
+            kwargs={'device': self.device, 'persistent': False})
 
     def test_021_update_persistent_to_true(self):
         self.assignment.persistent = False
@@ -181,6 +184,9 @@ class TC_00_DeviceCollection(qubes.tests.QubesTestCase):
         self.collection.update_persistent(self.device, True)
         self.assertEqual({self.device}, set(self.collection.persistent()))
         self.assertEqual({self.device}, set(self.collection.attached()))
+        self.assertEventFired(self.emitter,
+            'device-persistent-set:testclass',
+            kwargs={'device': self.device, 'persistent': True})
 
     def test_022_update_persistent_reject_not_running(self):
         self.assertEqual(set([]), set(self.collection.persistent()))
@@ -18,6 +18,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 import asyncio
+import collections
 
 import qubes.events
 import qubes.tests
@@ -191,3 +192,125 @@ class TC_00_Emitter(qubes.tests.QubesTestCase):
         self.assertEqual(testevent_fired[0], 4)
         emitter.fire_event('testevent')
         self.assertEqual(testevent_fired[0], 4)
+
+    def test_007_class_handler(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        class TestEmitterChild(TestEmitter):
+            pass
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = TestEmitterChild()
+        emitter.events_enabled = True
+
+        # fill the dispatch cache first
+        self.assertEqual(list(emitter.fire_event('testevent')),
+            ['testevent_1'])
+
+        TestEmitter.add_class_handler('test*', on_testevent_2)
+        self.assertEqual(list(emitter.fire_event('testevent')),
+            ['testevent_1', 'testevent_2'])
+        self.assertEqual(list(emitter.fire_event('testevent2')),
+            ['testevent_2'])
+
+        TestEmitter.remove_class_handler('test*', on_testevent_2)
+        self.assertEqual(list(emitter.fire_event('testevent')),
+            ['testevent_1'])
+        self.assertEqual(list(emitter.fire_event('testevent2')), [])
+
+    def test_008_order(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('foo:*')
+            def on_foo_1(self, event):
+                yield 'foo_1'
+
+        class TestEmitterChild(TestEmitter):
+            @qubes.events.handler('foo:bar')
+            def on_foo_2(self, event):
+                yield 'foo_2'
+
+        def on_foo_3(subject, event):
+            yield 'foo_3'
+
+        emitter = TestEmitterChild()
+        emitter.add_handler('*', on_foo_3)
+        emitter.events_enabled = True
+
+        self.assertEqual(list(emitter.fire_event('foo:bar')),
+            ['foo_1', 'foo_2', 'foo_3'])
+        self.assertEqual(list(emitter.fire_event('foo:bar', pre_event=True)),
+            ['foo_3', 'foo_2', 'foo_1'])
+
+        emitter.remove_handler('*', on_foo_3)
+        self.assertEqual(list(emitter.fire_event('foo:bar')),
+            ['foo_1', 'foo_2'])
+
+    def test_009_event_cacheable(self):
+        class TestEmitter(qubes.events.Emitter):
+            pass
+
+        def on_testevent_1(subject, event):
+            yield 'testevent_1'
+        on_testevent_1.ha_cacheable = True
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+
+        # no handlers, nothing worth caching
+        self.assertFalse(emitter.event_cacheable('testevent'))
+
+        TestEmitter.add_class_handler('testevent', on_testevent_1)
+        self.assertTrue(emitter.event_cacheable('testevent'))
+        self.assertFalse(emitter.event_cacheable('otherevent'))
+
+        generation = qubes.events.dispatch_generation
+        TestEmitter.add_class_handler('test*', on_testevent_2)
+        self.assertNotEqual(qubes.events.dispatch_generation, generation)
+        self.assertFalse(emitter.event_cacheable('testevent'))
+        TestEmitter.remove_class_handler('test*', on_testevent_2)
+        self.assertTrue(emitter.event_cacheable('testevent'))
+
+        emitter.add_handler('testevent', on_testevent_2)
+        self.assertFalse(emitter.event_cacheable('testevent'))
+        emitter.remove_handler('testevent', on_testevent_2)
+
+        emitter.events_enabled = False
+        self.assertFalse(emitter.event_cacheable('testevent'))
+        TestEmitter.remove_class_handler('testevent', on_testevent_1)
+
+    def test_010_handler_timings(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_2(self, event):
+                yield from asyncio.sleep(0.01)
+                return ['testevent_2']
+
+        loop = asyncio.get_event_loop()
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+
+        loop.run_until_complete(emitter.fire_event_async('testevent'))
+        self.assertIsNone(emitter.handler_timings)
+
+        emitter.handler_timings = collections.Counter()
+        effect = loop.run_until_complete(emitter.fire_event_async('testevent'))
+        self.assertCountEqual(effect, ['testevent_1', 'testevent_2'])
+        prefix = __name__ + '.TC_00_Emitter.test_010_handler_timings.' \
+            '<locals>.TestEmitter.'
+        self.assertCountEqual(emitter.handler_timings,
+            [prefix + 'on_testevent_1', prefix + 'on_testevent_2'])
+        self.assertGreaterEqual(
+            emitter.handler_timings[prefix + 'on_testevent_2'], 0.01)
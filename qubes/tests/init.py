@@ -20,8 +20,10 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import gc
 import unittest
 import uuid
+import weakref
 
 import lxml.etree
 
@@ -234,6 +236,23 @@ class TestHolder(qubes.tests.TestEmitter, qubes.PropertyHolder):
     testprop4 = qubes.property('testprop4', order=3)
 
 
+class StagedTestHolder(qubes.tests.TestEmitter, qubes.PropertyHolder):
+    testprop1 = qubes.property('testprop1', load_stage=2)
+    testprop2 = qubes.property('testprop2', load_stage=4)
+    testprop3 = qubes.property('testprop3', load_stage=4)
+
+
+class CachedTestHolder(qubes.tests.TestEmitter, qubes.PropertyHolder):
+    parent = qubes.property('parent', default=None)
+    base = qubes.property('base', default=1)
+    derived = qubes.property('derived', cache_default=True,
+        default=(lambda self: self.base +
+            (self.parent.derived if self.parent is not None else 0)))
+    uncached = qubes.property('uncached', default=(lambda self: self.base))
+    derived_uncached = qubes.property('derived_uncached', cache_default=True,
+        default=(lambda self: self.uncached * 10))
+
+
 class TC_20_PropertyHolder(qubes.tests.QubesTestCase):
     def setUp(self):
         super().setUp()
@@ -315,10 +334,116 @@ class TC_20_PropertyHolder(qubes.tests.QubesTestCase):
         with self.assertRaises(AttributeError):
             self.holder.property_get_default('testprop1'),
 
+    def test_008_load_properties_stages(self):
+        xml = lxml.etree.XML('''
+<qubes version="3">
+    <properties>
+        <property name="testprop2">testvalue2</property>
+        <property name="testprop1">testvalue1</property>
+    </properties>
+</qubes>
+        ''')
+        holder = StagedTestHolder(xml)
+
+        holder.load_properties(load_stage=2)
+        self.assertEqual(holder.testprop1, 'testvalue1')
+        self.assertTrue(holder.property_is_default('testprop2'))
+
+        holder.load_properties(load_stage=4)
+        self.assertEqual(holder.testprop2, 'testvalue2')
+        self.assertTrue(holder.property_is_default('testprop3'))
+
+        # modified XML is used only after re-indexing
+        lxml.etree.SubElement(xml.find('properties'), 'property',
+            name='testprop3').text = 'testvalue3'
+        holder.load_properties(load_stage=4)
+        self.assertTrue(holder.property_is_default('testprop3'))
+        holder._index_xml_properties()  # pylint: disable=protected-access
+        holder.load_properties(load_stage=4)
+        self.assertEqual(holder.testprop3, 'testvalue3')
+
+    def test_009_load_properties_not_applicable(self):
+        xml = lxml.etree.XML('''
+<qubes version="3">
+    <properties>
+        <property name="testprop4">testvalue4</property>
+    </properties>
+</qubes>
+        ''')
+        with self.assertRaises(TypeError):
+            StagedTestHolder(xml)
+
     @unittest.skip('test not implemented')
     def test_010_property_require(self):
         pass
 
+    def test_020_cached_default(self):
+        # pylint: disable=protected-access
+        parent = CachedTestHolder(None)
+        holder = CachedTestHolder(None)
+        holder.parent = parent
+        self.assertEqual(holder.derived, 2)
+        self.assertIsNone(holder._default_cache)
+
+        parent.enable_default_cache()
+        holder.enable_default_cache()
+        self.assertEqual(holder.derived, 2)
+        self.assertEqual(holder._default_cache, {'derived': 2})
+        self.assertEqual(parent._default_cache, {'derived': 1})
+
+        # through parent's cached default
+        parent.base = 5
+        self.assertEqual(holder._default_cache, {})
+        self.assertEqual(holder.derived, 6)
+        del parent.base
+        self.assertEqual(holder.derived, 2)
+        holder.base = 3
+        self.assertEqual(holder.derived, 4)
+        holder.parent = None
+        self.assertEqual(holder.derived, 3)
+        holder.derived = 7
+        self.assertEqual(holder.derived, 7)
+        del holder.derived
+        self.assertEqual(holder.derived, 3)
+
+    def test_021_cached_default_uncacheable(self):
+        # pylint: disable=protected-access
+        holder = CachedTestHolder(None)
+        holder.enable_default_cache()
+        self.assertEqual(holder.derived_uncached, 10)
+        self.assertNotIn('derived_uncached', holder._default_cache)
+        holder.uncached = 2
+        self.assertEqual(holder.derived_uncached, 20)
+        self.assertIn('derived_uncached', holder._default_cache)
+        del holder.uncached
+        self.assertEqual(holder.derived_uncached, 10)
+
+    def test_022_cached_default_dependent_released(self):
+        # pylint: disable=protected-access
+        parent = CachedTestHolder(None)
+        parent.enable_default_cache()
+        holder = CachedTestHolder(None)
+        holder.enable_default_cache()
+        holder.parent = parent
+        self.assertEqual(holder.derived, 2)
+        self.assertEqual(len(parent._default_dependents['derived']), 1)
+
+        # holder is not kept alive by what it read
+        holder_ref = weakref.ref(holder)
+        del holder
+        gc.collect()
+        self.assertIsNone(holder_ref())
+        self.assertEqual(len(parent._default_dependents['derived']), 0)
+
+        # closed holder is skipped on invalidation
+        holder = CachedTestHolder(None)
+        holder.enable_default_cache()
+        holder.parent = parent
+        self.assertEqual(holder.derived, 2)
+        holder.close()
+        parent.base = 3
+        self.assertEqual(parent.derived, 3)
+
 
 class TestVM(qubes.vm.BaseVM):
     qid = qubes.property('qid', type=int)
@@ -445,6 +570,34 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertEventFired(self.app, 'domain-delete',
             kwargs={'vm': self.testvm2})
 
+    def test_009_rename(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+
+        self.testvm1.name = 'testvm3'
+
+        self.assertIs(self.vms['testvm3'], self.testvm1)
+        self.assertIn('testvm3', self.vms)
+        self.assertNotIn('testvm1', self.vms)
+        with self.assertRaises(KeyError):
+            self.vms['testvm1']
+        self.assertEqual(list(self.vms), [self.testvm2, self.testvm1])
+
+    def test_010_getitem_after_delitem(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+        self.assertEqual(list(self.vms), [self.testvm1, self.testvm2])
+
+        del self.vms['testvm1']
+
+        self.assertNotIn('testvm1', self.vms)
+        self.assertNotIn(1, self.vms)
+        self.assertNotIn(self.testvm1, self.vms)
+        with self.assertRaises(KeyError):
+            self.vms['testvm1']
+        self.assertEqual(list(self.vms), [self.testvm2])
+        self.assertEqual(list(self.vms.qids()), [2])
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
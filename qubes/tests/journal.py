@@ -0,0 +1,157 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+
+import lxml.etree
+
+import qubes
+import qubes.exc
+import qubes.journal
+import qubes.tests
+
+
+class TC_00_Fragments(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = lxml.etree.XML('''
+<qubes>
+    <labels><label id="label-1" color="#cc0000">red</label></labels>
+    <properties><property name="clockvm">vm1</property></properties>
+    <domains>
+        <domain id="domain-1" class="AppVM"><properties/></domain>
+        <domain id="domain-2" class="AppVM"><properties/></domain>
+    </domains>
+</qubes>''')
+
+    def test_000_fragments(self):
+        fragments = qubes.journal.fragments(self.root)
+        self.assertEqual(set(fragments), {
+            'labels',
+            'properties',
+            "domains/domain[@id='domain-1']",
+            "domains/domain[@id='domain-2']",
+        })
+        self.assertEqual(fragments["domains/domain[@id='domain-2']"],
+            '<domain id="domain-2" class="AppVM"><properties/></domain>')
+
+    def test_001_diff(self):
+        old = qubes.journal.fragments(self.root)
+        self.assertIsNone(qubes.journal.diff(old, old))
+
+        domains = self.root.find('domains')
+        domains.remove(domains[0])
+        domains[0].set('class', 'TemplateVM')
+        self.assertEqual(
+            qubes.journal.diff(old, qubes.journal.fragments(self.root)), {
+                'set': {"domains/domain[@id='domain-2']":
+                    '<domain id="domain-2" class="TemplateVM">'
+                    '<properties/></domain>'},
+                'del': ["domains/domain[@id='domain-1']"],
+            })
+
+    def test_002_apply(self):
+        old = qubes.journal.fragments(self.root)
+        new_root = lxml.etree.XML(lxml.etree.tostring(self.root))
+        domains = new_root.find('domains')
+        domains.remove(domains[0])
+        domains[0].set('class', 'TemplateVM')
+        lxml.etree.SubElement(domains, 'domain', id='domain-3')
+        new_root.find('properties').clear()
+        new = qubes.journal.fragments(new_root)
+
+        qubes.journal.apply(self.root, [qubes.journal.diff(old, new)])
+        self.assertEqual(qubes.journal.fragments(self.root), new)
+
+    def test_003_fragments_cache(self):
+        cache = {}
+        fragments = qubes.journal.fragments(self.root, cache)
+        self.assertEqual(qubes.journal.fragments(self.root, cache), fragments)
+
+        domain = self.root.find('domains')[0]
+        domain.append(lxml.etree.Element('features'))
+        fragments = qubes.journal.fragments(self.root, cache)
+        self.assertEqual(fragments["domains/domain[@id='domain-1']"],
+            '<domain id="domain-1" class="AppVM"><properties/><features/>'
+            '</domain>')
+
+        self.root.find('domains').remove(domain)
+        qubes.journal.fragments(self.root, cache)
+        self.assertNotIn("domains/domain[@id='domain-1']", cache)
+
+
+class TC_10_Journal(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.journal = qubes.journal.Journal(
+            qubes.journal.journal_path(os.path.join(self.tmpdir, 'qubes.xml')))
+        self.addCleanup(self.journal.close)
+
+    def test_000_missing(self):
+        self.assertEqual(self.journal.read('base'), [])
+        self.assertIsNone(self.journal.identity())
+
+    def test_001_append_read(self):
+        self.journal.reset('base')
+        self.journal.append({'set': {'labels': '<labels/>'}})
+        self.journal.append({'del': ['properties']})
+        self.assertEqual(self.journal.size, os.path.getsize(self.journal.path))
+        self.assertEqual(self.journal.read('base'), [
+            {'set': {'labels': '<labels/>'}},
+            {'del': ['properties']},
+        ])
+
+    def test_002_stale(self):
+        self.journal.reset('base')
+        self.journal.append({'del': ['properties']})
+        with self.assertLogs('qubes.journal', 'WARNING'):
+            self.assertEqual(self.journal.read('other-base'), [])
+
+    def test_003_reset(self):
+        self.journal.reset('base')
+        self.journal.append({'del': ['properties']})
+        identity = self.journal.identity()
+        self.journal.reset('new-base')
+        self.assertNotEqual(self.journal.identity(), identity)
+        self.assertEqual(self.journal.read('new-base'), [])
+
+    def test_004_interrupted_append(self):
+        self.journal.reset('base')
+        self.journal.append({'del': ['properties']})
+        with open(self.journal.path, 'ab') as fh:
+            fh.write(b'{"del":["lab')
+        with self.assertLogs('qubes.journal', 'WARNING'):
+            self.assertEqual(self.journal.read('base'),
+                [{'del': ['properties']}])
+
+    def test_005_corrupted(self):
+        self.journal.reset('base')
+        with open(self.journal.path, 'ab') as fh:
+            fh.write(b'{"del":["lab\n')
+        self.journal.append({'del': ['properties']})
+        with self.assertRaises(qubes.exc.QubesException):
+            self.journal.read('base')
+
+    def test_006_remove(self):
+        self.journal.reset('base')
+        self.journal.remove()
+        self.assertFalse(os.path.exists(self.journal.path))
+        self.journal.remove()
@@ -168,3 +168,188 @@ class TC_00_DispVM(qubes.tests.QubesTestCase):
                 self.app.add_new_vm(qubes.vm.dispvm.DispVM,
                     name='test-dispvm', template=self.appvm)
             self.assertFalse(mock_domains.get_new_unused_dispid.called)
+
+    def mock_domains(self):
+        orig_getitem = self.app.domains.__getitem__
+        orig_setitem = self.app.domains.__setitem__
+        orig_contains = self.app.domains.__contains__
+        patch = mock.patch.object(self.app, 'domains', wraps=self.app.domains)
+        mock_domains = patch.start()
+        self.addCleanup(patch.stop)
+        mock_domains.configure_mock(**{
+            'get_new_unused_dispid': mock.Mock(side_effect=[42, 43]),
+            '__getitem__.side_effect': orig_getitem,
+            '__setitem__.side_effect': orig_setitem,
+            '__contains__.side_effect': orig_contains,
+        })
+
+    @mock.patch('os.symlink')
+    @mock.patch('os.makedirs')
+    @mock.patch('qubes.storage.Storage')
+    def test_020_pool_claim(self, mock_storage, mock_makedirs, mock_symlink):
+        mock_storage.return_value.create.side_effect = self.mock_coro
+        self.appvm.template_for_dispvms = True
+        self.addCleanup(qubes.vm.dispvm.DispVMPool.pools.clear)
+        with mock.patch.object(qubes.vm.dispvm.DispVMPool, 'refill') \
+                as mock_refill:
+            self.appvm.features['dispvm-pool-size'] = '1'
+            mock_refill.assert_called_once_with()
+        pool = qubes.vm.dispvm.DispVMPool.pools[self.appvm]
+        self.mock_domains()
+
+        with mock.patch.object(qubes.vm.dispvm.DispVM, 'start',
+                    side_effect=self.mock_coro) as mock_start, \
+                mock.patch.object(qubes.vm.dispvm.DispVM, 'pause',
+                    side_effect=self.mock_coro) as mock_pause:
+            self.loop.run_until_complete(pool._refill())
+            mock_start.assert_called_once_with()
+            mock_pause.assert_called_once_with()
+        self.assertEqual(len(pool.vms), 1)
+        pooled = pool.vms[0]
+        self.assertEqual(pooled.name, 'disp42')
+        self.assertTrue(pooled.features['dispvm-pooled'])
+
+        @asyncio.coroutine
+        def unpause():
+            # tagged before it can do anything
+            self.assertIn('created-by-test', pooled.tags)
+
+        with mock.patch.object(qubes.vm.dispvm.DispVMPool, 'refill') \
+                as mock_refill, \
+                mock.patch.object(qubes.vm.dispvm.DispVM, 'is_paused',
+                    return_value=True), \
+                mock.patch.object(qubes.vm.dispvm.DispVM, 'unpause',
+                    side_effect=unpause) as mock_unpause:
+            dispvm = self.loop.run_until_complete(
+                qubes.vm.dispvm.DispVM.from_appvm(self.appvm,
+                    tags=['created-by-test']))
+            self.assertIs(dispvm, pooled)
+            mock_unpause.assert_called_once_with()
+            self.assertNotIn('dispvm-pooled', dispvm.features)
+            self.assertEqual((pool.hits, pool.misses), (1, 0))
+            mock_refill.assert_called_once_with()
+
+            # pool is empty now, a new qube is created instead
+            dispvm = self.loop.run_until_complete(
+                qubes.vm.dispvm.DispVM.from_appvm(self.appvm,
+                    tags=['created-by-test']))
+            self.assertEqual(dispvm.name, 'disp43')
+            self.assertIn('created-by-test', dispvm.tags)
+            self.assertEqual(mock_unpause.call_count, 1)
+            self.assertEqual((pool.hits, pool.misses), (1, 1))
+
+    @mock.patch('os.symlink')
+    @mock.patch('os.makedirs')
+    @mock.patch('qubes.storage.Storage')
+    def test_021_pool_memory_shortage(self, mock_storage, mock_makedirs,
+            mock_symlink):
+        mock_storage.return_value.create.side_effect = self.mock_coro
+        self.appvm.template_for_dispvms = True
+        self.appvm.features['dispvm-pool-size'] = '0'
+        self.app.events_enabled = True
+        # recorded events reference the qubes
+        self.addCleanup(self.app.fired_events.clear)
+        self.addCleanup(qubes.vm.dispvm.DispVMPool.pools.clear)
+        self.mock_domains()
+        pool = qubes.vm.dispvm.DispVMPool.get(self.appvm)
+        pooled = self.loop.run_until_complete(
+            qubes.vm.dispvm.DispVM.from_appvm(self.appvm))
+        pool.vms.append(pooled)
+
+        with mock.patch.object(qubes.vm.dispvm.DispVM, 'cleanup',
+                side_effect=self.mock_coro) as mock_cleanup:
+            # qube being prepared for the pool does not evict others
+            pooled.features['dispvm-pooled'] = True
+            effects = self.loop.run_until_complete(
+                self.app.fire_event_async('memory-shortage', vm=pooled))
+            self.assertEqual(effects, [])
+            self.assertFalse(mock_cleanup.called)
+
+            effects = self.loop.run_until_complete(
+                self.app.fire_event_async('memory-shortage', vm=self.appvm))
+            self.assertEqual(effects, [True])
+            mock_cleanup.assert_called_once_with()
+            self.assertEqual(pool.vms, [])
+
+        pool.forget()
+        self.assertNotIn(self.appvm, qubes.vm.dispvm.DispVMPool.pools)
+        self.assertEqual(self.loop.run_until_complete(
+            self.app.fire_event_async('memory-shortage', vm=self.appvm)), [])
+
+    def test_022_pool_recycle(self):
+        self.appvm.template_for_dispvms = True
+        self.app.events_enabled = True
+        # recorded events reference the qubes
+        self.addCleanup(self.app.fired_events.clear)
+        self.addCleanup(qubes.vm.dispvm.DispVMPool.pools.clear)
+        with mock.patch.object(qubes.vm.dispvm.DispVMPool, 'refill'):
+            self.appvm.features['dispvm-pool-size'] = '1'
+        pool = qubes.vm.dispvm.DispVMPool.pools[self.appvm]
+        pooled = mock.Mock(**{'cleanup.side_effect': self.mock_coro})
+        pool.vms.append(pooled)
+
+        with mock.patch.object(qubes.vm.dispvm.DispVMPool, 'refill') \
+                as mock_refill:
+            self.appvm.features['service.example'] = '1'
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.assertEqual(pool.vms, [])
+            pooled.cleanup.assert_called_once_with()
+            mock_refill.assert_called_once_with()
+
+            # setting the same value does not change anything
+            self.appvm.features['service.example'] = '1'
+            self.assertEqual(mock_refill.call_count, 1)
+
+            self.appvm.memory = 500
+            self.assertEqual(mock_refill.call_count, 2)
+
+        # qube prepared with the old settings is not kept
+        prepared = [
+            mock.Mock(**{'cleanup.side_effect': self.mock_coro}),
+            mock.Mock(**{'cleanup.side_effect': self.mock_coro}),
+        ]
+        @asyncio.coroutine
+        def prepare():
+            vm = prepared[prepare.calls]
+            if not prepare.calls:
+                self.appvm.vcpus = 3
+            prepare.calls += 1
+            return vm
+        prepare.calls = 0
+        with mock.patch.object(qubes.vm.dispvm.DispVMPool, 'refill'), \
+                mock.patch.object(pool, 'prepare', prepare):
+            self.loop.run_until_complete(pool._refill())
+        prepared[0].cleanup.assert_called_once_with()
+        self.assertEqual(pool.vms, [prepared[1]])
+
+        pool.vms.clear()
+        self.app.fire_event('domain-delete', vm=self.appvm)
+        self.assertNotIn(self.appvm, qubes.vm.dispvm.DispVMPool.pools)
+
+    def test_023_pool_recycle_events(self):
+        self.appvm.template_for_dispvms = True
+        self.app.events_enabled = True
+        # recorded events reference the qubes
+        self.addCleanup(self.app.fired_events.clear)
+        self.addCleanup(qubes.vm.dispvm.DispVMPool.pools.clear)
+        with mock.patch.object(qubes.vm.dispvm.DispVMPool, 'refill'):
+            self.appvm.features['dispvm-pool-size'] = '1'
+        self.template.events_enabled = True
+
+        with mock.patch.object(qubes.vm.dispvm.DispVMPool, 'recycle') \
+                as mock_recycle:
+            self.appvm.tags.add('some-tag')
+            self.assertEqual(mock_recycle.call_count, 1)
+            self.appvm.fire_event('firewall-changed')
+            self.assertEqual(mock_recycle.call_count, 2)
+            # root volume committed
+            self.loop.run_until_complete(
+                self.template.fire_event_async('domain-shutdown'))
+            self.assertEqual(mock_recycle.call_count, 3)
+            self.app.fire_event('property-set:default_netvm',
+                name='default_netvm', newvalue=None, oldvalue=self.appvm)
+            self.assertEqual(mock_recycle.call_count, 4)
+            # not inherited by DispVMs
+            self.app.fire_event('property-set:clockvm',
+                name='clockvm', newvalue=None, oldvalue=self.appvm)
+            self.assertEqual(mock_recycle.call_count, 4)
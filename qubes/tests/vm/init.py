@@ -48,6 +48,11 @@ class TestVM(qubes.vm.BaseVM):
     testlabel = qubes.property('testlabel')
     defaultprop = qubes.property('defaultprop', default='defaultvalue')
 
+    def is_running(self):
+        # asked by extensions, if they are registered by other tests
+        # pylint: disable=no-self-use
+        return False
+
 class TC_10_BaseVM(qubes.tests.QubesTestCase):
     def setUp(self):
         super().setUp()
@@ -146,6 +151,40 @@ class TC_10_BaseVM(qubes.tests.QubesTestCase):
         xml = vm.__xml__()
         self.assertNotIn('nxproperty', xml)
 
+    def test_003_xml_cache(self):
+        vm = TestVM(TestApp(), None, qid=1, name='testvm')
+        vm.events_enabled = True
+        xml = vm.__xml__()
+        self.assertIs(vm.__xml__(), xml)
+
+        vm.testprop = 'testvalue'
+        xml = vm.__xml__()
+        self.assertEqual(xml.xpath('./properties/property[@name="testprop"]')
+            [0].text, 'testvalue')
+        self.assertIs(vm.__xml__(), xml)
+
+        vm.features['testfeature'] = 'aqq'
+        xml = vm.__xml__()
+        self.assertEqual(xml.xpath('./features/feature')[0].get('name'),
+            'testfeature')
+        self.assertIs(vm.__xml__(), xml)
+
+        vm.tags.add('testtag')
+        xml = vm.__xml__()
+        self.assertEqual(xml.xpath('./tags/tag')[0].get('name'), 'testtag')
+
+        del vm.testprop
+        self.assertEqual(
+            vm.__xml__().xpath('./properties/property[@name="testprop"]'), [])
+
+    def test_004_xml_no_cache_without_events(self):
+        vm = TestVM(TestApp(), None, qid=1, name='testvm')
+        xml = vm.__xml__()
+        vm.testprop = 'testvalue'
+        self.assertIsNot(vm.__xml__(), xml)
+        self.assertEqual(vm.__xml__().xpath(
+            './properties/property[@name="testprop"]')[0].text, 'testvalue')
+
 
 class TC_20_Tags(qubes.tests.QubesTestCase):
     def setUp(self):
@@ -19,6 +19,7 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
+import asyncio
 import base64
 import os
 import tempfile
@@ -32,6 +33,7 @@ import unittest.mock
 import shutil
 
 import qubes
+import qubes.events
 import qubes.exc
 import qubes.config
 import qubes.vm
@@ -1463,3 +1465,222 @@ class TC_90_QubesVM(QubesVMTestsMixin, qubes.tests.QubesTestCase):
                     lambda _: True):
                 netvm.create_qdb_entries()
             self.assertEqual(test_qubesdb.data, expected)
+
+    def _mock_start_phases(self, vm, phases):
+        @asyncio.coroutine
+        def storage_start():
+            phases.append('storage-start')
+            yield from asyncio.sleep(0.01)
+            phases.append('storage-started')
+
+        @asyncio.coroutine
+        def mock_coro(phase):
+            phases.append(phase)
+
+        def update_libvirt_domain():
+            phases.append('define')
+            vm._libvirt_domain = unittest.mock.Mock(**{
+                'createWithFlags.side_effect':
+                    qubes.exc.QubesException('create failed')})
+
+        vm.storage = unittest.mock.Mock(**{
+            'verify.side_effect': lambda: mock_coro('verify'),
+            'start.side_effect': storage_start,
+            'stop.side_effect': lambda: mock_coro('storage-stop'),
+        })
+        class StartupLock:
+            def __iter__(self):
+                yield from ()
+                return unittest.mock.MagicMock()
+
+            def locked(self):
+                return False
+
+        patches = [
+            # 'with (yield from lock)' does not work on Python >= 3.9
+            unittest.mock.patch.object(vm, 'startup_lock', StartupLock()),
+            unittest.mock.patch.object(vm, '_ensure_shutdown_handled',
+                lambda: mock_coro('shutdown-handled')),
+            unittest.mock.patch.object(vm, 'get_power_state',
+                return_value='Halted'),
+            unittest.mock.patch.object(vm, '_update_libvirt_domain',
+                side_effect=update_libvirt_domain),
+            unittest.mock.patch('libvirt.VIR_DOMAIN_START_PAUSED', 1,
+                create=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # memory-shortage event references the qube
+        self.addCleanup(self.app.fired_events.clear)
+
+    def test_700_start_phases(self):
+        vm = self.get_vm(virt_mode='hvm')
+        phases = []
+        self._mock_start_phases(vm, phases)
+        qmemman_client = unittest.mock.Mock()
+        with unittest.mock.patch.object(vm, 'request_memory',
+                return_value=qmemman_client):
+            with self.assertRaises(qubes.exc.QubesException):
+                self.loop.run_until_complete(vm.start())
+        # libvirt domain is defined while volumes are being started
+        self.assertLess(phases.index('storage-start'), phases.index('define'))
+        self.assertLess(phases.index('define'),
+            phases.index('storage-started'))
+        self.assertEqual(phases[1], 'verify')
+        self.assertEqual(phases[-1], 'storage-stop')
+        qmemman_client.close.assert_called_once_with()
+
+    def test_701_start_no_memory(self):
+        vm = self.get_vm(virt_mode='hvm')
+        phases = []
+        self._mock_start_phases(vm, phases)
+        with unittest.mock.patch.object(vm, 'request_memory',
+                side_effect=qubes.exc.QubesMemoryError(vm)):
+            with self.assertRaises(qubes.exc.QubesMemoryError):
+                self.loop.run_until_complete(vm.start())
+        # volumes were started concurrently, so they need to be stopped
+        self.assertEqual(phases[-1], 'storage-stop')
+        self.assertIsNotNone(vm._libvirt_domain)
+        vm._libvirt_domain.createWithFlags.assert_not_called()
+
+    def test_702_start_timings(self):
+        vm = self.get_vm(virt_mode='hvm')
+        vm.events_enabled = True
+        self._mock_start_phases(vm, [])
+        handler = unittest.mock.Mock(return_value=None)
+        vm.add_handler('domain-start-timings', handler)
+
+        def on_domain_pre_start(subject, event, **kwargs):
+            # pylint: disable=unused-argument
+            pass
+        vm.add_handler('domain-pre-start', on_domain_pre_start)
+        with unittest.mock.patch.object(vm, 'request_memory'):
+            with self.assertRaises(qubes.exc.QubesException):
+                self.loop.run_until_complete(vm.start())
+        self.assertEqual(len(vm.phase_timings), 1)
+        timings = vm.phase_timings[0]
+        self.assertEqual(timings.action, 'start')
+        self.assertEqual(timings.result, 'QubesException')
+        names = [name for name, _, _ in timings.phases]
+        self.assertEqual(names[:2], ['previous-shutdown', 'domain-pre-start'])
+        self.assertCountEqual(names[2:4], ['storage-verify', 'netvm'])
+        self.assertCountEqual(names[4:], ['memory', 'storage-start', 'define'])
+        durations = {name: duration for name, _, duration in timings.phases}
+        self.assertGreaterEqual(durations['storage-start'], 0.01)
+        self.assertGreaterEqual(timings.total, 0.01)
+        self.assertIn(qubes.events.handler_name(on_domain_pre_start),
+            timings.handlers)
+        self.assertIsNone(vm.handler_timings)
+
+        handler.assert_called_once_with(vm, 'domain-start-timings',
+            result='QubesException', total=unittest.mock.ANY,
+            phases=unittest.mock.ANY, handlers=unittest.mock.ANY)
+        phases = handler.call_args[1]['phases'].split(',')
+        self.assertEqual(phases[0].split('=')[0], 'previous-shutdown')
+        self.assertEqual(len(phases), 7)
+
+    def test_703_shutdown_timings(self):
+        vm = self.get_vm()
+        vm._libvirt_domain = unittest.mock.Mock()
+        with unittest.mock.patch.object(vm, 'is_halted', return_value=False):
+            self.loop.run_until_complete(vm.shutdown())
+        self.assertEqual(len(vm.phase_timings), 1)
+        timings = vm.phase_timings[0]
+        self.assertEqual(timings.action, 'shutdown')
+        self.assertEqual(timings.result, 'ok')
+        self.assertEqual([name for name, _, _ in timings.phases],
+            ['domain-pre-shutdown', 'libvirt-shutdown'])
+        vm._libvirt_domain.shutdown.assert_called_once_with()
+
+        for _ in range(qubes.vm.qubesvm.PHASE_TIMINGS_HISTORY):
+            with unittest.mock.patch.object(vm, 'is_halted',
+                    return_value=False):
+                self.loop.run_until_complete(vm.shutdown())
+        self.assertEqual(len(vm.phase_timings),
+            qubes.vm.qubesvm.PHASE_TIMINGS_HISTORY)
+        self.assertIsNot(vm.phase_timings[0], timings)
+
+    def test_705_start_reservation_closed(self):
+        vm = self.get_vm(virt_mode='hvm')
+        phases = []
+        self._mock_start_phases(vm, phases)
+        reservation = unittest.mock.Mock()
+        with unittest.mock.patch.object(vm, 'request_memory') as request:
+            # fails before getting to the memory
+            vm.storage.verify.side_effect = qubes.exc.QubesException('bad')
+            with self.assertRaises(qubes.exc.QubesException):
+                self.loop.run_until_complete(
+                    vm.start(mem_reservation=reservation))
+            reservation.close.assert_called_once_with(vm)
+
+            # gets to creating the domain
+            reservation.reset_mock()
+            vm.storage.verify.side_effect = lambda: asyncio.sleep(0)
+            with self.assertRaises(qubes.exc.QubesException):
+                self.loop.run_until_complete(
+                    vm.start(mem_reservation=reservation))
+            reservation.close.assert_called_with(vm)
+            self.assertFalse(request.called)
+
+            # already running
+            reservation.reset_mock()
+            with unittest.mock.patch.object(vm, 'get_power_state',
+                    return_value='Running'):
+                self.loop.run_until_complete(
+                    vm.start(mem_reservation=reservation))
+            reservation.close.assert_called_once_with(vm)
+
+    def test_706_timings_concurrent(self):
+        vm = self.get_vm()
+        self._mock_start_phases(vm, [])
+        vm._libvirt_domain = unittest.mock.Mock()
+        blocker = self.loop.create_future()
+
+        @asyncio.coroutine
+        def start_locked(*args):
+            # pylint: disable=unused-argument
+            yield from blocker
+
+        with unittest.mock.patch.object(vm, '_start_locked', start_locked), \
+                unittest.mock.patch.object(vm, 'is_halted',
+                    return_value=False):
+            start = asyncio.ensure_future(vm.start())
+            self.loop.run_until_complete(asyncio.sleep(0))
+            start_handlers = vm.handler_timings
+            self.assertIsNotNone(start_handlers)
+
+            # does not take over (nor reset) handler timings of the start
+            self.loop.run_until_complete(vm.shutdown())
+            self.assertIs(vm.handler_timings, start_handlers)
+
+            start.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                self.loop.run_until_complete(start)
+        self.assertIsNone(vm.handler_timings)
+
+    def test_707_start_reservation_locked(self):
+        vm = self.get_vm(virt_mode='hvm')
+        self._mock_start_phases(vm, [])
+        reservation = unittest.mock.Mock()
+        closed_before_lock = []
+
+        class StartupLock:
+            def __iter__(self):
+                # someone else holds it, maybe waiting for the reservation
+                closed_before_lock.append(reservation.close.called)
+                yield from ()
+                return unittest.mock.MagicMock()
+
+            def locked(self):
+                return True
+
+        with unittest.mock.patch.object(vm, 'startup_lock', StartupLock()), \
+                unittest.mock.patch.object(vm, 'request_memory') as request:
+            with self.assertRaises(qubes.exc.QubesException):
+                self.loop.run_until_complete(
+                    vm.start(mem_reservation=reservation))
+        self.assertEqual(closed_before_lock, [True])
+        reservation.close.assert_called_once_with(vm)
+        # memory requested on its own instead
+        request.assert_called_once_with(None)
@@ -358,8 +358,12 @@ class QubesArgumentParser(argparse.ArgumentParser):
 
         if self._want_app and not self._want_app_no_instance:
             self.set_qubes_verbosity(namespace)
+            # --lazy-load and --cache-defaults are added by tools, which
+            # want them
             namespace.app = qubes.Qubes(namespace.app,
-                offline_mode=namespace.offline_mode)
+                offline_mode=namespace.offline_mode,
+                lazy_load=getattr(namespace, 'lazy_load', False),
+                cache_defaults=getattr(namespace, 'cache_defaults', False))
 
         if self._want_force_root:
             self.dont_run_as_root(namespace)
@@ -12,7 +12,9 @@ import qubes.api.admin
 import qubes.api.internal
 import qubes.api.misc
 import qubes.log
+import qubes.profiler
 import qubes.utils
+import qubes.vm.dispvm
 import qubes.vm.qubesvm
 
 def sighandler(loop, signame, servers):
@@ -25,6 +27,24 @@ parser = qubes.tools.QubesArgumentParser(description='Qubes OS daemon')
 parser.add_argument('--debug', action='store_true', default=False,
     help='Enable verbose error logging (all exceptions with full '
          'tracebacks) and also send tracebacks to Admin API clients')
+parser.add_argument('--save-delay', metavar='SECONDS', type=float,
+    default=0.01,
+    help='Write qubes.xml at most this long after a change, merging all '
+         'changes made in the meantime into one write (default: '
+         '%(default)s)')
+parser.add_argument('--journal', action='store_true', default=False,
+    help='Save changes by appending them to a journal next to qubes.xml, '
+         'instead of rewriting the whole file each time')
+parser.add_argument('--lazy-load', action='store_true', default=False,
+    help='Set up storage and log file of each qube on its first use, '
+         'instead of at startup')
+parser.add_argument('--cache-defaults', action='store_true', default=False,
+    help='Keep default values of properties until something they depend on '
+         'changes, instead of computing them on each read')
+parser.add_argument('--profile-dir', metavar='DIR',
+    default=qubes.profiler.Profiler.output_dir,
+    help='Write results of profiling requested with internal.daemon.Profile '
+         'to this directory (default: %(default)s)')
 
 def main(args=None):
     loop = asyncio.get_event_loop()
@@ -36,6 +56,9 @@ def main(args=None):
         raise
 
     args.app.register_event_handlers()
+    args.app.save_delay = args.save_delay
+    args.app.use_journal = args.journal
+    qubes.profiler.Profiler.output_dir = args.profile_dir
 
     if args.debug:
         qubes.log.enable_debug()
@@ -46,6 +69,8 @@ def main(args=None):
         qubes.api.misc.QubesMiscAPI,
         app=args.app, debug=args.debug))
 
+    qubes.vm.dispvm.DispVMPool.refill_all(args.app)
+
     socknames = []
     for server in servers:
         for sock in server.sockets:
@@ -71,6 +96,7 @@ def main(args=None):
                     'socket {} got unlinked sometime before shutdown'.format(
                         sockname))
     finally:
+        args.app.flush_save()
         loop.close()
 
 if __name__ == '__main__':
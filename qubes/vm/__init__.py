@@ -207,6 +207,9 @@ class BaseVM(qubes.PropertyHolder):
         self._qdb_watch_paths = set()
         self._qdb_connection_watch = None
 
+        # cached result of __xml__(), see invalidate_xml()
+        self._xml_cache = None
+
         # self.app must be set before super().__init__, because some property
         # setters need working .app attribute
         #: mother :py:class:`qubes.Qubes` object
@@ -214,6 +217,9 @@ class BaseVM(qubes.PropertyHolder):
 
         super(BaseVM, self).__init__(xml, **kwargs)
 
+        if getattr(app, 'cache_defaults', False):
+            self.enable_default_cache()
+
         #: dictionary of features of this qube
         self.features = qubes.features.Features(self, features)
 
@@ -224,8 +230,7 @@ class BaseVM(qubes.PropertyHolder):
         #: user-specified tags
         self.tags = Tags(self, tags or ())
 
-        #: logger instance for logging messages related to this VM
-        self.log = None
+        self._log = None
 
         #: storage volumes
         self.volumes = {}
@@ -256,16 +261,19 @@ class BaseVM(qubes.PropertyHolder):
         if self.xml is None:
             return
 
+        # iterfind() is much cheaper than xpath(), which compiles the
+        # expression on each call, and this runs for every qube on load
+
         # features
-        for node in self.xml.xpath('./features/feature'):
+        for node in self.xml.iterfind('features/feature'):
             self.features[node.get('name')] = node.text
 
         # devices (pci, usb, ...)
-        for parent in self.xml.xpath('./devices'):
+        for parent in self.xml.iterfind('devices'):
             devclass = parent.get('class')
-            for node in parent.xpath('./device'):
+            for node in parent.iterfind('device'):
                 options = {}
-                for option in node.xpath('./option'):
+                for option in node.iterfind('option'):
                     options[option.get('name')] = option.text
 
                 device_assignment = qubes.devices.DeviceAssignment(
@@ -277,7 +285,7 @@ class BaseVM(qubes.PropertyHolder):
                 self.devices[devclass].load_persistent(device_assignment)
 
         # tags
-        for node in self.xml.xpath('./tags/tag'):
+        for node in self.xml.iterfind('tags/tag'):
             self.tags.add(node.get('name'))
 
         # SEE:1815 firewall, policy.
@@ -286,7 +294,62 @@ class BaseVM(qubes.PropertyHolder):
         '''Initialise logger for this domain.'''
         self.log = qubes.log.get_vm_logger(self.name)
 
+    @property
+    def log(self):
+        '''logger instance for logging messages related to this VM
+
+        Initialised on first use, if not done by :py:meth:`init_log` (see
+        :py:attr:`qubes.Qubes.lazy_load`).
+        '''
+        if self._log is None and hasattr(self, 'name'):
+            self.init_log()
+        return self._log
+
+    @log.setter
+    def log(self, value):
+        self._log = value
+
+    @qubes.events.handler('property-set:template', 'property-set:netvm',
+        'property-del:netvm')
+    def on_property_set_dependency(self, event, name, newvalue=None,
+            oldvalue=None):
+        '''Keep reverse dependency indexes of :py:attr:`app.domains` current
+
+        ``property-del:netvm`` is also fired for qubes using default netvm,
+        when the default changes.
+        '''
+        # pylint: disable=unused-argument
+        domains = getattr(self.app, 'domains', None)
+        if isinstance(domains, qubes.app.VMCollection):
+            domains.update_dependents(self, name)
+
+    @qubes.events.handler('property-set:*', 'property-del:*',
+        'domain-feature-set:*', 'domain-feature-delete:*',
+        'domain-tag-add:*', 'domain-tag-delete:*',
+        'device-attach:*', 'device-detach:*', 'device-persistent-set:*')
+    def on_xml_changed(self, event, **kwargs):
+        '''Drop cached XML serialisation, after something in it has changed'''
+        # pylint: disable=unused-argument
+        self.invalidate_xml()
+
+    def invalidate_xml(self):
+        '''Drop cached result of :py:meth:`__xml__`
+
+        Changes of properties, features, tags and device assignments do this
+        automatically (through events). Call it after changing anything
+        serialised to :file:`qubes.xml` in other way.
+        '''
+        self._xml_cache = None
+
     def __xml__(self):
+        # Serialising all the qubes on each app.save() is expensive, while
+        # usually only a few of them have changed. Without events, we would
+        # not know about changes, so do not cache then.
+        if self._xml_cache is None or not self.events_enabled:
+            self._xml_cache = self._xml_build()
+        return self._xml_cache
+
+    def _xml_build(self):
         element = lxml.etree.Element('domain')
         element.set('id', 'domain-' + str(self.qid))
         element.set('class', self.__class__.__name__)
@@ -48,6 +48,7 @@ class AdminVM(qubes.vm.BaseVM):
         load_stage=4,
         allow_none=True,
         default=(lambda self: self.app.default_dispvm),
+        cache_default=True,
         doc='Default VM to be used as Disposable VM for service calls.')
 
     include_in_backups = qubes.property('include_in_backups',
@@ -102,9 +102,11 @@ class AppVM(qubes.vm.qubesvm.QubesVM):
         ''' Returns a generator containing all Disposable VMs based on the
         current AppVM.
         '''
-        for vm in self.app.domains:
-            if hasattr(vm, 'template') and vm.template is self:
-                yield vm
+        domains = self.app.domains
+        if isinstance(domains, qubes.app.VMCollection):
+            return iter(domains.get_dependents(self, 'template'))
+        return (vm for vm in domains
+            if hasattr(vm, 'template') and vm.template is self)
 
     @qubes.events.handler('domain-load')
     def on_domain_loaded(self, event):
@@ -143,3 +145,37 @@ class AppVM(qubes.vm.qubesvm.QubesVM):
                 config = conf.copy()
                 self.volume_config[volume_name] = config
                 self.storage.init_volume(volume_name, config)
+
+    @qubes.events.handler('domain-feature-set:dispvm-pool-size',
+        'domain-feature-delete:dispvm-pool-size',
+        'property-set:template_for_dispvms',
+        'property-del:template_for_dispvms')
+    def on_dispvm_pool_size_changed(self, event, **kwargs):
+        ''' Fill or shrink the pool of DispVMs based on this qube.
+        '''  # pylint: disable=unused-argument
+        # imported here, as qubes.vm.dispvm imports this module
+        import qubes.vm.dispvm  # pylint: disable=redefined-outer-name
+        pools = qubes.vm.dispvm.DispVMPool
+        if self in pools.pools or pools.configured_size(self):
+            pools.get(self).refill()
+
+    @qubes.events.handler('domain-feature-set:*', 'domain-feature-delete:*',
+        'property-set:*', 'property-del:*',
+        'domain-tag-add:*', 'domain-tag-delete:*', 'firewall-changed',
+        'domain-shutdown', 'domain-volume-import-end')
+    def on_dispvm_pool_template_changed(self, event, name=None, feature=None,
+            **kwargs):
+        ''' Replace qubes in the pool of DispVMs based on this qube, as they
+        were started with the old settings (or volumes, committed on
+        shutdown).
+        '''  # pylint: disable=unused-argument
+        if name == 'template_for_dispvms' or feature == 'dispvm-pool-size':
+            # handled by on_dispvm_pool_size_changed
+            return
+        newvalue = kwargs.get('newvalue', kwargs.get('value'))
+        if 'oldvalue' in kwargs and newvalue == kwargs['oldvalue']:
+            return
+        import qubes.vm.dispvm  # pylint: disable=redefined-outer-name
+        pool = qubes.vm.dispvm.DispVMPool.pools.get(self)
+        if pool is not None:
+            pool.recycle()
@@ -21,6 +21,7 @@
 ''' A disposable vm implementation '''
 
 import asyncio
+import time
 
 import qubes.vm.qubesvm
 import qubes.vm.appvm
@@ -43,12 +44,14 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
 
     include_in_backups = qubes.property('include_in_backups', type=bool,
         default=(lambda self: not self.auto_cleanup),
+        cache_default=True,
         doc='If this domain is to be included in default backup.')
 
     default_dispvm = qubes.VMProperty('default_dispvm',
         load_stage=4,
         allow_none=True,
         default=(lambda self: self.template),
+        cache_default=True,
         doc='Default VM to be used as Disposable VM for service calls.')
 
     def __init__(self, app, xml, *args, **kwargs):
@@ -157,33 +160,62 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
 
     @classmethod
     @asyncio.coroutine
-    def from_appvm(cls, appvm, **kwargs):
+    def from_appvm(cls, appvm, tags=(), **kwargs):
         '''Create a new instance from given AppVM
 
         :param qubes.vm.appvm.AppVM appvm: template from which the VM should \
             be created
+        :param tags: tags added to the new VM before it is started
         :returns: new disposable vm
 
         *kwargs* are passed to the newly created VM
 
         >>> import qubes.vm.dispvm.DispVM
-        >>> dispvm = qubes.vm.dispvm.DispVM.from_appvm(appvm).start()
+        >>> dispvm = yield from qubes.vm.dispvm.DispVM.from_appvm(appvm)
+        >>> if dispvm.is_halted():
+        ...     yield from dispvm.start()
         >>> dispvm.run_service('qubes.VMShell', input='firefox')
-        >>> dispvm.cleanup()
+        >>> yield from dispvm.cleanup()
 
         This method modifies :file:`qubes.xml` file.
-        The qube returned is not started.
+        The qube returned is not started, unless it was taken from
+        :py:class:`DispVMPool` (only when there are no *kwargs*) - then it is
+        already running.
         '''
         if not appvm.template_for_dispvms:
             raise qubes.exc.QubesException(
                 'Refusing to create DispVM out of this AppVM, because '
                 'template_for_dispvms=False')
+
+        if kwargs or not DispVMPool.configured_size(appvm):
+            return (yield from cls._create(appvm, tags=tags, **kwargs))
+
+        pool = DispVMPool.get(appvm)
+        start_time = time.monotonic()
+        dispvm = yield from pool.claim(tags=tags)
+        if dispvm is not None:
+            appvm.app.save()
+            pool.hits += 1
+            pool.hit_time += time.monotonic() - start_time
+            return dispvm
+
+        dispvm = yield from cls._create(appvm, tags=tags)
+        pool.misses += 1
+        pool.miss_time += time.monotonic() - start_time
+        return dispvm
+
+    @classmethod
+    @asyncio.coroutine
+    def _create(cls, appvm, tags=(), **kwargs):
+        '''Create a new instance from given AppVM, bypassing the pool'''
         app = appvm.app
         dispvm = app.add_new_vm(
             cls,
             template=appvm,
             auto_cleanup=True,
             **kwargs)
+        for tag in tags:
+            dispvm.tags.add(tag)
         yield from dispvm.create_on_disk()
         app.save()
         return dispvm
@@ -226,3 +258,264 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
     def create_qdb_entries(self):
         super().create_qdb_entries()
         self.untrusted_qdb.write('/qubes-vm-persistence', 'none')
+
+
+class DispVMPool:
+    '''Disposable qubes created and started in advance
+
+    Size of the pool is set with ``dispvm-pool-size`` feature of the AppVM
+    they are based on. Qubes waiting in the pool are paused and have
+    ``dispvm-pooled`` feature set. When one is claimed by
+    :py:meth:`DispVM.from_appvm`, it is unpaused and a replacement is prepared
+    in the background.
+
+    Qubes in the pool get their memory from qmemman as any other started
+    qube. When some other qube cannot be started for lack of memory, they are
+    killed (see ``memory-shortage`` event of :py:class:`qubes.Qubes`), and the
+    pool is filled again on the next claim.
+
+    Pooled qubes are started with the AppVM and its template as they were at
+    the time, so they are replaced (see :py:meth:`recycle`) whenever any of
+    these changes:
+
+    - properties, features, tags or firewall of the AppVM,
+    - volumes of the AppVM or its template, which is assumed after they shut
+      down or a volume is imported,
+    - global properties listed in :py:attr:`app_properties`.
+
+    Changes not noticed, after which pooled qubes may be out of date until
+    the pool is refilled: volumes reverted to an older revision, files of a
+    kernel updated in place, other global properties, and anything done to
+    the pooled qubes directly.
+    '''
+
+    #: global properties, which pooled qubes may inherit
+    app_properties = ('default_netvm', 'default_kernel')
+
+    #: pools, by AppVM the qubes are based on
+    pools = {}
+
+    def __init__(self, template):
+        self.template = template
+        #: paused qubes, ready to be claimed
+        self.vms = []
+        self.refill_task = None
+        #: incremented by :py:meth:`recycle`, to not keep qubes prepared before
+        self.generation = 0
+        #: number of claims served from the pool
+        self.hits = 0
+        #: number of claims for which a new qube had to be created
+        self.misses = 0
+        #: total time of claims served from the pool, in seconds
+        self.hit_time = 0.0
+        #: total time of claims for which a new qube had to be created
+        self.miss_time = 0.0
+
+    @staticmethod
+    def configured_size(template):
+        '''Size of the pool of qubes based on *template*'''
+        if not getattr(template, 'template_for_dispvms', False):
+            return 0
+        try:
+            return max(0, int(template.features.get('dispvm-pool-size', 0)))
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def is_pooled(vm):
+        '''Check whether *vm* is waiting in a pool'''
+        return isinstance(vm, DispVM) \
+            and bool(vm.features.get('dispvm-pooled', False))
+
+    @classmethod
+    def get(cls, template):
+        '''Get pool of qubes based on *template*, creating it if needed'''
+        try:
+            return cls.pools[template]
+        except KeyError:
+            pass
+        pool = cls.pools[template] = cls(template)
+        if not any(other.template.app is template.app
+                for other in cls.pools.values() if other is not pool):
+            template.app.add_handler('memory-shortage',
+                cls.on_memory_shortage)
+            template.app.add_handler('domain-delete', cls.on_domain_delete)
+            for name in cls.app_properties:
+                template.app.add_handler('property-set:' + name,
+                    cls.on_app_property_changed)
+                template.app.add_handler('property-del:' + name,
+                    cls.on_app_property_changed)
+        return pool
+
+    @classmethod
+    def recycle_based_on(cls, vm):
+        '''Replace qubes in pools based on *vm*, either directly or through
+        its template'''
+        for pool in list(cls.pools.values()):
+            if vm in (pool.template, pool.template.template):
+                pool.recycle()
+
+    @classmethod
+    def refill_all(cls, app):
+        '''Take over qubes left in pools by previous :program:`qubesd`
+        instance, and fill all the pools'''
+        for vm in list(app.domains):
+            if not cls.is_pooled(vm):
+                continue
+            if vm.is_paused() and cls.configured_size(vm.template):
+                cls.get(vm.template).vms.append(vm)
+            else:
+                asyncio.ensure_future(vm.cleanup())
+
+        for vm in app.domains:
+            if cls.configured_size(vm):
+                cls.get(vm).refill()
+
+    @asyncio.coroutine
+    def claim(self, tags=()):
+        '''Take a qube out of the pool and unpause it
+
+        This method is a coroutine.
+
+        :param tags: tags added to the qube before it is unpaused
+        :returns: running qube, or :py:obj:`None` if the pool is empty
+        '''
+        self.refill()
+        while self.vms:
+            vm = self.vms.pop(0)
+            # it may have been killed in the meantime
+            if vm not in self.template.app.domains or not vm.is_paused():
+                continue
+            del vm.features['dispvm-pooled']
+            for tag in tags:
+                vm.tags.add(tag)
+            try:
+                yield from vm.unpause()
+            except qubes.exc.QubesException:
+                vm.log.exception('failed to unpause DispVM from the pool')
+                yield from vm.cleanup()
+                continue
+            return vm
+        return None
+
+    def refill(self):
+        '''Bring the pool to its configured size, in the background'''
+        if self.refill_task is None or self.refill_task.done():
+            self.refill_task = asyncio.ensure_future(self._refill())
+
+    def recycle(self):
+        '''Replace all qubes in the pool, in the background
+
+        Called when the AppVM changes, as the qubes waiting in the pool would
+        not pick that up.
+        '''
+        self.generation += 1
+        vms, self.vms = self.vms, []
+        for vm in vms:
+            asyncio.ensure_future(vm.cleanup())
+        self.refill()
+
+    @asyncio.coroutine
+    def _refill(self):
+        while len(self.vms) > self.configured_size(self.template):
+            yield from self.vms.pop().cleanup()
+
+        while len(self.vms) < self.configured_size(self.template):
+            if self.pools.get(self.template) is not self:
+                # AppVM removed
+                return
+            generation = self.generation
+            try:
+                vm = yield from self.prepare()
+            except qubes.exc.QubesMemoryError:
+                self.template.log.info(
+                    'Not enough memory to fill pool of DispVMs')
+                break
+            except Exception:  # pylint: disable=broad-except
+                self.template.log.exception(
+                    'Failed to prepare DispVM for the pool')
+                break
+            if generation != self.generation:
+                # recycled while being prepared
+                yield from vm.cleanup()
+                continue
+            self.vms.append(vm)
+
+        if not self.vms and not self.configured_size(self.template):
+            self.forget()
+
+    @asyncio.coroutine
+    def prepare(self):
+        '''Create, start and pause a new qube for the pool
+
+        This method is a coroutine.
+        '''
+        vm = yield from DispVM._create(self.template)
+        vm.features['dispvm-pooled'] = True
+        self.template.app.save()
+        # if starting fails, DispVM removes itself
+        yield from vm.start()
+        try:
+            yield from vm.pause()
+        except:
+            yield from vm.cleanup()
+            raise
+        return vm
+
+    def forget(self):
+        '''Drop the empty pool'''
+        del self.pools[self.template]
+        app = self.template.app
+        if not any(pool.template.app is app for pool in self.pools.values()):
+            app.remove_handler('memory-shortage', self.on_memory_shortage)
+            app.remove_handler('domain-delete', self.on_domain_delete)
+            for name in self.app_properties:
+                app.remove_handler('property-set:' + name,
+                    self.on_app_property_changed)
+                app.remove_handler('property-del:' + name,
+                    self.on_app_property_changed)
+
+    @classmethod
+    def on_app_property_changed(cls, app, event, **kwargs):
+        '''Replace qubes in all pools, which may inherit changed global
+        property'''
+        # pylint: disable=unused-argument
+        for pool in list(cls.pools.values()):
+            if pool.template.app is app:
+                pool.recycle()
+
+    @classmethod
+    def on_domain_delete(cls, app, event, vm):
+        '''Drop the pool of qubes based on removed *vm*'''
+        # pylint: disable=unused-argument
+        pool = cls.pools.get(vm)
+        if pool is None:
+            return
+        # pooled qubes would keep their AppVM in use, so there are none left
+        # other than those still being prepared; refill will drop them
+        pool.generation += 1
+        pool.vms.clear()
+        pool.forget()
+
+    @classmethod
+    @asyncio.coroutine
+    def on_memory_shortage(cls, app, event, vm):
+        '''Kill qubes waiting in pools, to let *vm* start'''
+        # pylint: disable=unused-argument
+        if cls.is_pooled(vm):
+            # do not make room for one pooled qube by killing others
+            return None
+
+        vms = [pooled for pool in cls.pools.values()
+            if pool.template.app is app
+            for pooled in pool.vms]
+        if not vms:
+            return None
+        for pool in cls.pools.values():
+            if pool.template.app is app:
+                pool.vms.clear()
+        for pooled in vms:
+            pooled.log.info('Killing pooled DispVM to free memory for %s',
+                vm.name)
+            yield from pooled.cleanup()
+        return [True]
@@ -100,15 +100,18 @@ class NetVMMixin(qubes.events.Emitter):
 
     ip = qubes.property('ip', type=ipaddress.IPv4Address,
         default=_default_ip,
+        cache_default=True,
         doc='IP address of this domain.')
 
     ip6 = qubes.property('ip6', type=ipaddress.IPv6Address,
         default=_default_ip6,
+        cache_default=True,
         doc='IPv6 address of this domain.')
 
     # CORE2: swallowed uses_default_netvm
     netvm = qubes.VMProperty('netvm', load_stage=4, allow_none=True,
         default=(lambda self: self.app.default_netvm),
+        cache_default=True,
         setter=_setter_netvm,
         doc='''VM that provides network connection to this domain. When
             `None`, machine is disconnected. When absent, domain uses default
@@ -216,9 +219,10 @@ class NetVMMixin(qubes.events.Emitter):
         ''' Return a generator containing all domains connected to the current
             NetVM.
         '''
-        for vm in self.app.domains:
-            if getattr(vm, 'netvm', None) is self:
-                yield vm
+        domains = self.app.domains
+        if isinstance(domains, qubes.app.VMCollection):
+            return iter(domains.get_dependents(self, 'netvm'))
+        return (vm for vm in domains if getattr(vm, 'netvm', None) is self)
 
     #
     # used in both
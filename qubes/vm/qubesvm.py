@@ -24,12 +24,14 @@ from __future__ import absolute_import
 
 import asyncio
 import base64
+import collections
 import grp
 import os
 import os.path
 import shutil
 import string
 import subprocess
+import time
 import uuid
 import warnings
 
@@ -59,6 +61,75 @@ except ImportError:
 MEM_OVERHEAD_BASE = (3 + 1) * 1024 * 1024
 MEM_OVERHEAD_PER_VCPU = 3 * 1024 * 1024 / 2
 
+#: number of starts and shutdowns of each qube kept in
+#: :py:attr:`QubesVM.phase_timings`
+PHASE_TIMINGS_HISTORY = 16
+
+
+def _raise_first_exception(results):
+    '''Raise first exception from results of :py:func:`asyncio.gather`
+    called with *return_exceptions*'''
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+class PhaseTimings(object):
+    '''Time spent in each phase of start or shutdown of a domain
+
+    Phases done one after another are recorded with :py:meth:`mark`, as
+    lasting since the end of the previous phase. Phases done concurrently
+    are run through :py:meth:`timed`.
+
+    :param str action: ``'start'`` or ``'shutdown'``
+    '''
+
+    def __init__(self, action):
+        self.action = action
+        #: wall clock time of the beginning
+        self.time = time.time()
+        self._started = self._last = time.monotonic()
+        #: list of (name, offset, duration) of phases, in seconds; after
+        #: :py:meth:`finish`, in order of their beginning
+        self.phases = []
+        #: time spent in event handlers, by handler name (see
+        #: :py:attr:`qubes.events.Emitter.handler_timings`); recorded only
+        #: while holding :py:attr:`QubesVM.startup_lock`
+        self.handlers = collections.Counter()
+        #: duration of the whole action, after :py:meth:`finish`
+        self.total = None
+        #: ``'ok'`` or name of the exception the action failed with
+        self.result = None
+
+    def mark(self, name):
+        '''Record end of phase *name*'''
+        now = time.monotonic()
+        self.phases.append((name, self._last - self._started, now - self._last))
+        self._last = now
+
+    @asyncio.coroutine
+    def timed(self, name, coro):
+        '''Run *coro*, recording it as phase *name*
+
+        This method is a coroutine.
+        '''
+        start = time.monotonic()
+        try:
+            return (yield from coro)
+        finally:
+            now = time.monotonic()
+            self.phases.append((name, start - self._started, now - start))
+            self._last = max(self._last, now)
+
+    def finish(self, exc=None):
+        '''Record end of the action
+
+        :param Exception exc: exception the action failed with, if any
+        '''
+        self.total = time.monotonic() - self._started
+        self.phases.sort(key=lambda phase: phase[1])
+        self.result = 'ok' if exc is None else type(exc).__name__
+
 
 def _setter_kernel(self, prop, value):
     ''' Helper for setting the domain kernel and running sanity checks on it.
@@ -250,6 +321,23 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
             *other arguments are as in :py:meth:`start`*
 
+        .. event:: domain-start-timings \
+                (subject, event, result, total, phases, handlers)
+
+            Fired at the end of :py:meth:`start` method, whether it succeeded
+            or not, after the timings were added to :py:attr:`phase_timings`.
+
+            Handler for this event can be asynchronous (a coroutine).
+
+            :param subject: Event emitter (the qube object)
+            :param event: Event name (``'domain-start-timings'``)
+            :param result: ``'ok'`` or name of the exception start failed with
+            :param total: Duration of the start, in seconds
+            :param phases: Comma separated ``name=seconds`` pairs, for each \
+                phase of the start, in order of their beginning
+            :param handlers: Comma separated ``name=seconds`` pairs, for each \
+                handler of events fired during the start
+
         .. event:: domain-paused (subject, event)
 
             Fired when the domain has been paused.
@@ -305,6 +393,14 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             :param event: Event name (``'domain-pre-shutdown'``)
             :param force: If the shutdown is to be forceful
 
+        .. event:: domain-shutdown-timings \
+                (subject, event, result, total, phases, handlers)
+
+            Fired at the end of :py:meth:`shutdown` method, whether it
+            succeeded or not. Arguments are as in ``domain-start-timings``.
+
+            Handler for this event can be asynchronous (a coroutine).
+
         .. event:: domain-cmd-pre-run (subject, event, start_guid)
 
             Fired at the beginning of :py:meth:`run_service` method.
@@ -516,6 +612,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         default=_default_with_template('memory', lambda self:
             qubes.config.defaults[
                 'hvm_memory' if self.virt_mode == 'hvm' else 'memory']),
+        cache_default=True,
         doc='Memory currently available for this VM. TemplateBasedVMs use its '
             'template\'s value by default.')
 
@@ -536,6 +633,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         type=int,
         setter=_setter_positive_int,
         default=_default_with_template('vcpus', 2),
+        cache_default=True,
         doc='Number of virtual CPUs for a qube. TemplateBasedVMs use its '
             'template\'s value by default.')
 
@@ -544,6 +642,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         setter=_setter_kernel,
         default=_default_with_template('kernel',
             lambda self: self.app.default_kernel),
+        cache_default=True,
         doc='Kernel used by this domain. TemplateBasedVMs use its '
             'template\'s value by default.')
 
@@ -564,6 +663,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     default_user = qubes.property('default_user', type=str,
         # pylint: disable=no-member
         default=_default_with_template('default_user', 'user'),
+        cache_default=True,
         setter=_setter_default_user,
         doc='Default user to start applications as. TemplateBasedVMs use its '
             'template\'s value by default.')
@@ -580,6 +680,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     qrexec_timeout = qubes.property('qrexec_timeout', type=int,
         default=_default_with_template('qrexec_timeout',
             lambda self: self.app.default_qrexec_timeout),
+        cache_default=True,
         setter=_setter_positive_int,
         doc='''Time in seconds after which qrexec connection attempt is deemed
             failed. Operating system inside VM should be able to boot in this
@@ -588,6 +689,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     shutdown_timeout = qubes.property('shutdown_timeout', type=int,
         default=_default_with_template('shutdown_timeout',
             lambda self: self.app.default_shutdown_timeout),
+        cache_default=True,
         setter=_setter_positive_int,
         doc='''Time in seconds for shutdown of the VM, after which VM may be
             forcefully powered off. Operating system inside VM should be
@@ -611,6 +713,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         load_stage=4,
         allow_none=True,
         default=(lambda self: self.app.default_dispvm),
+        cache_default=True,
         doc='Default VM to be used as Disposable VM for service calls.')
 
     management_dispvm = qubes.VMProperty('management_dispvm',
@@ -618,6 +721,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         allow_none=True,
         default=_default_with_template('management_dispvm',
             (lambda self: self.app.management_dispvm)),
+        cache_default=True,
         doc='Default DVM template for Disposable VM for managing this VM.')
 
     updateable = qubes.property('updateable',
@@ -723,6 +827,44 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             if block_dev is not None:
                 yield block_dev
 
+    @property
+    def storage(self):
+        '''Storage manager (:py:class:`qubes.storage.Storage`)
+
+        With :py:attr:`qubes.Qubes.lazy_load`, qubes loaded from
+        :file:`qubes.xml` get it (and :py:attr:`volumes`) on first use.
+        '''
+        if self._storage_deferred:
+            self._storage_deferred = False
+            self._storage = qubes.storage.Storage(self)
+        return self._storage
+
+    @storage.setter
+    def storage(self, value):
+        self._storage_deferred = False
+        self._storage = value
+
+    @storage.deleter
+    def storage(self):
+        self._storage_deferred = False
+        del self._storage
+
+    @property
+    def volumes(self):
+        '''Storage volumes, by name'''
+        if self._storage_deferred:
+            # pylint: disable=pointless-statement
+            self.storage
+        return self._volumes
+
+    @volumes.setter
+    def volumes(self, value):
+        self._volumes = value
+
+    @volumes.deleter
+    def volumes(self):
+        del self._volumes
+
     @property
     def untrusted_qdb(self):
         '''QubesDB handle for this domain.'''
@@ -772,7 +914,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         if hasattr(self, 'volume_config'):
             if xml is not None:
-                for node in xml.xpath('volume-config/volume'):
+                for node in xml.iterfind('volume-config/volume'):
                     name = node.get('name')
                     assert name
                     for key, value in node.items():
@@ -802,6 +944,10 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         self._libvirt_domain = None
         self._qdb_connection = None
 
+        # cached <volume-config> element and volume configs it was built from
+        self._volume_config_xml = None
+        self._volume_config_cache = None
+
         # We assume a fully halted VM here. The 'domain-init' handler will
         # check if the VM is already running.
         self._domain_stopped_event_received = True
@@ -813,6 +959,9 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         # start(). This should not be accessed anywhere else.
         self._domain_stopped_lock = asyncio.Lock()
 
+        #: :py:class:`PhaseTimings` of recent starts and shutdowns
+        self.phase_timings = collections.deque(maxlen=PHASE_TIMINGS_HISTORY)
+
         if xml is None:
             # we are creating new VM and attributes came through kwargs
             assert hasattr(self, 'qid')
@@ -854,11 +1003,33 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         element = super(QubesVM, self).__xml__()
         # pylint: enable=no-member
 
-        if hasattr(self, 'volumes'):
-            volume_config_node = lxml.etree.Element('volume-config')
-            for volume in self.volumes.values():
-                volume_config_node.append(volume.__xml__())
-            element.append(volume_config_node)
+        if self._storage_deferred:
+            # storage was not used since loading, so volumes are as they
+            # were loaded; do not set it up just to serialise them
+            if self._volume_config_xml is None:
+                volume_config_node = lxml.etree.Element('volume-config')
+                for node in self.xml.iterfind('volume-config/volume'):
+                    volume_config_node.append(
+                        lxml.etree.Element('volume', node.attrib))
+                self._volume_config_xml = volume_config_node
+        elif not hasattr(self, 'volumes'):
+            return element
+        else:
+            # volumes change without events (resize, revisions_to_keep, ...),
+            # so compare their configs, which is cheaper than serialising
+            # them
+            configs = [volume.config for volume in self.volumes.values()]
+            if self._volume_config_xml is None \
+                    or configs != self._volume_config_cache:
+                volume_config_node = lxml.etree.Element('volume-config')
+                for volume in self.volumes.values():
+                    volume_config_node.append(volume.__xml__())
+                self._volume_config_xml = volume_config_node
+                self._volume_config_cache = configs
+
+        for node in element.findall('volume-config'):
+            element.remove(node)
+        element.append(self._volume_config_xml)
 
         return element
 
@@ -875,8 +1046,13 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         # Initialize VM image storage class;
         # it might be already initialized by a recursive call from a child VM
-        if self.storage is None:
-            self.storage = qubes.storage.Storage(self)
+        if self._storage is None and not self._storage_deferred:
+            if event == 'domain-load' \
+                    and getattr(self.app, 'lazy_load', False):
+                # see storage property
+                self._storage_deferred = True
+            else:
+                self.storage = qubes.storage.Storage(self)
 
         if not self.app.vmm.offline_mode and self.is_running():
             self.start_qdb_watch()
@@ -999,121 +1175,225 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
     @asyncio.coroutine
     def start(self, start_guid=True, notify_function=None,
-            mem_required=None):
+            mem_required=None, mem_reservation=None):
         '''Start domain
 
         :param bool start_guid: FIXME
         :param collections.Callable notify_function: FIXME
         :param int mem_required: FIXME
+        :param qubes.batch.MemoryReservation mem_reservation: memory already \
+            requested from qmemman for this domain (and possibly others); it \
+            is closed for this domain whenever this method returns
         '''
 
-        with (yield from self.startup_lock):
-            # Intentionally not used is_running(): eliminate also "Paused",
-            # "Crashed", "Halting"
-            if self.get_power_state() != 'Halted':
-                return self
+        if mem_reservation is not None and self.startup_lock.locked():
+            # whoever holds the lock may be waiting for qmemman, which is
+            # blocked until the reservation is closed; do not wait for the
+            # lock while holding it, request the memory later on our own
+            mem_reservation.close(self)
+            mem_reservation = None
 
-            yield from self._ensure_shutdown_handled()
+        try:
+            with (yield from self.startup_lock):
+                # Intentionally not used is_running(): eliminate also
+                # "Paused", "Crashed", "Halting"
+                if self.get_power_state() != 'Halted':
+                    return self
+
+                timings = PhaseTimings('start')
+                # handler timings are collected only with the lock held, so
+                # that shutdown() does not mix them up
+                self.handler_timings = timings.handlers
+                try:
+                    yield from self._start_locked(timings, start_guid,
+                        notify_function, mem_required, mem_reservation)
+                except Exception as exc:
+                    self.handler_timings = None
+                    yield from self._record_timings(timings, exc)
+                    raise
+                finally:
+                    # also when cancelled
+                    self.handler_timings = None
+                yield from self._record_timings(timings)
+        finally:
+            # qmemman is blocked while the reservation is held; if not done
+            # right after creating the domain, release it on early return
+            # or failure
+            if mem_reservation is not None:
+                mem_reservation.close(self)
 
-            self.log.info('Starting {}'.format(self.name))
+        return self
 
-            try:
-                yield from self.fire_event_async('domain-pre-start',
-                    pre_event=True,
-                    start_guid=start_guid, mem_required=mem_required)
-            except Exception as exc:
-                yield from self.fire_event_async('domain-start-failed',
-                    reason=str(exc))
-                raise
+    @asyncio.coroutine
+    def _start_locked(self, timings, start_guid, notify_function,
+            mem_required, mem_reservation):
+        '''Start domain, recording *timings* of phases
 
-            qmemman_client = None
-            try:
-                for devclass in self.devices:
-                    for dev in self.devices[devclass].persistent():
-                        if isinstance(dev, qubes.devices.UnknownDevice):
-                            raise qubes.exc.QubesException(
-                                '{} device {} not available'.format(
-                                    devclass, dev))
-
-                if self.virt_mode == 'pvh' and not self.kernel:
-                    raise qubes.exc.QubesException(
-                        'virt_mode PVH require kernel to be set')
-                yield from self.storage.verify()
-
-                if self.netvm is not None:
-                    # pylint: disable = no-member
-                    if self.netvm.qid != 0:
-                        if not self.netvm.is_running():
-                            yield from self.netvm.start(start_guid=start_guid,
-                                notify_function=notify_function)
-
-                qmemman_client = yield from asyncio.get_event_loop().\
-                    run_in_executor(None, self.request_memory, mem_required)
-
-                yield from self.storage.start()
-
-            except Exception as exc:
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                    reason=str(exc))
-                if qmemman_client:
-                    qmemman_client.close()
-                raise
+        This function needs to be called with self.startup_lock held.'''
 
-            try:
-                self._update_libvirt_domain()
+        yield from self._ensure_shutdown_handled()
+        timings.mark('previous-shutdown')
 
-                self.libvirt_domain.createWithFlags(
-                    libvirt.VIR_DOMAIN_START_PAUSED)
+        self.log.info('Starting {}'.format(self.name))
 
-            except Exception as exc:
-                self.log.error('Start failed: %s', str(exc))
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                    reason=str(exc))
+        try:
+            yield from self.fire_event_async('domain-pre-start',
+                pre_event=True,
+                start_guid=start_guid, mem_required=mem_required)
+        except Exception as exc:
+            yield from self.fire_event_async('domain-start-failed',
+                reason=str(exc))
+            raise
+        timings.mark('domain-pre-start')
+
+        qmemman_client = None
+        storage_started = False
+        try:
+            for devclass in self.devices:
+                for dev in self.devices[devclass].persistent():
+                    if isinstance(dev, qubes.devices.UnknownDevice):
+                        raise qubes.exc.QubesException(
+                            '{} device {} not available'.format(
+                                devclass, dev))
+
+            if self.virt_mode == 'pvh' and not self.kernel:
+                raise qubes.exc.QubesException(
+                    'virt_mode PVH require kernel to be set')
+
+            # independent phases run concurrently; each group is waited
+            # for as a whole, so that cleanup knows what was done
+            results = yield from asyncio.gather(
+                timings.timed('storage-verify', self.storage.verify()),
+                timings.timed('netvm',
+                    self._start_netvm(start_guid, notify_function)),
+                return_exceptions=True)
+            _raise_first_exception(results)
+
+            # the domain definition does not need the volumes started,
+            # nor the memory available
+            results = yield from asyncio.gather(
+                timings.timed('memory',
+                    self._get_memory(mem_required, mem_reservation)),
+                timings.timed('storage-start', self.storage.start()),
+                timings.timed('define', self._define_libvirt_domain()),
+                return_exceptions=True)
+            if not isinstance(results[0], BaseException):
+                qmemman_client = results[0]
+            storage_started = not isinstance(results[1], BaseException)
+            _raise_first_exception(results)
+
+        except Exception as exc:
+            # let anyone receiving domain-pre-start know that startup failed
+            yield from self.fire_event_async('domain-start-failed',
+                reason=str(exc))
+            if storage_started:
                 yield from self.storage.stop()
-                raise
+            if qmemman_client:
+                qmemman_client.close()
+            raise
 
-            finally:
-                if qmemman_client:
-                    qmemman_client.close()
+        try:
+            self.libvirt_domain.createWithFlags(
+                libvirt.VIR_DOMAIN_START_PAUSED)
+
+        except Exception as exc:
+            self.log.error('Start failed: %s', str(exc))
+            # let anyone receiving domain-pre-start know that startup failed
+            yield from self.fire_event_async('domain-start-failed',
+                reason=str(exc))
+            yield from self.storage.stop()
+            raise
 
-            self._domain_stopped_event_received = False
-            self._domain_stopped_event_handled = False
+        finally:
+            if qmemman_client:
+                qmemman_client.close()
+            if mem_reservation is not None:
+                mem_reservation.close(self)
+        timings.mark('create')
 
-            try:
-                yield from self.fire_event_async('domain-spawn',
-                    start_guid=start_guid)
+        self._domain_stopped_event_received = False
+        self._domain_stopped_event_handled = False
 
-                self.log.info('Setting Qubes DB info for the VM')
-                yield from self.start_qubesdb()
-                self.create_qdb_entries()
-                self.start_qdb_watch()
+        try:
+            yield from self.fire_event_async('domain-spawn',
+                start_guid=start_guid)
+            timings.mark('domain-spawn')
 
-                self.log.warning('Activating the {} VM'.format(self.name))
-                self.libvirt_domain.resume()
+            self.log.info('Setting Qubes DB info for the VM')
+            yield from self.start_qubesdb()
+            self.create_qdb_entries()
+            self.start_qdb_watch()
+            timings.mark('qubesdb')
 
-                yield from self.start_qrexec_daemon()
+            self.log.warning('Activating the {} VM'.format(self.name))
+            self.libvirt_domain.resume()
+            timings.mark('resume')
 
-                yield from self.fire_event_async('domain-start',
-                    start_guid=start_guid)
+            yield from self.start_qrexec_daemon()
+            timings.mark('qrexec')
 
-            except Exception as exc:  # pylint: disable=bare-except
-                self.log.error('Start failed: %s', str(exc))
-                # This avoids losing the exception if an exception is
-                # raised in self.force_shutdown(), because the vm is not
-                # running or paused
-                try:
-                    yield from self._kill_locked()
-                except qubes.exc.QubesVMNotStartedError:
-                    pass
+            yield from self.fire_event_async('domain-start',
+                start_guid=start_guid)
+            timings.mark('domain-start')
+
+        except Exception as exc:  # pylint: disable=bare-except
+            self.log.error('Start failed: %s', str(exc))
+            # This avoids losing the exception if an exception is
+            # raised in self.force_shutdown(), because the vm is not
+            # running or paused
+            try:
+                yield from self._kill_locked()
+            except qubes.exc.QubesVMNotStartedError:
+                pass
+
+            # let anyone receiving domain-pre-start know that startup failed
+            yield from self.fire_event_async('domain-start-failed',
+                reason=str(exc))
+            raise
+
+    @asyncio.coroutine
+    def _record_timings(self, timings, exc=None):
+        '''Keep *timings* in :py:attr:`phase_timings` and report them with
+        ``domain-start-timings`` or ``domain-shutdown-timings`` event'''
+        timings.finish(exc)
+        self.phase_timings.append(timings)
+        yield from self.fire_event_async(
+            'domain-{}-timings'.format(timings.action),
+            result=timings.result,
+            total='{:.6f}'.format(timings.total),
+            phases=','.join('{}={:.6f}'.format(name, duration)
+                for name, _, duration in timings.phases),
+            handlers=','.join('{}={:.6f}'.format(name, duration)
+                for name, duration in sorted(timings.handlers.items())))
+
+    @asyncio.coroutine
+    def _start_netvm(self, start_guid, notify_function):
+        if self.netvm is not None:
+            # pylint: disable = no-member
+            if self.netvm.qid != 0:
+                if not self.netvm.is_running():
+                    yield from self.netvm.start(start_guid=start_guid,
+                        notify_function=notify_function)
 
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                    reason=str(exc))
+    @asyncio.coroutine
+    def _get_memory(self, mem_required, mem_reservation):
+        if mem_reservation is not None:
+            # already requested; closed by start()
+            return None
+        try:
+            return (yield from asyncio.get_event_loop().run_in_executor(None,
+                self.request_memory, mem_required))
+        except qubes.exc.QubesMemoryError:
+            # let others give up some memory, then try once more
+            if not (yield from self.app.fire_event_async(
+                    'memory-shortage', vm=self)):
                 raise
+            return (yield from asyncio.get_event_loop().run_in_executor(None,
+                self.request_memory, mem_required))
 
-        return self
+    @asyncio.coroutine
+    def _define_libvirt_domain(self):
+        self._update_libvirt_domain()
 
     def on_libvirt_domain_stopped(self):
         ''' Handle VIR_DOMAIN_EVENT_STOPPED events from libvirt.
@@ -1177,10 +1457,30 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if self.is_halted():
             raise qubes.exc.QubesVMNotStartedError(self)
 
+        timings = PhaseTimings('shutdown')
+        try:
+            yield from self._shutdown(timings, force, wait, timeout)
+        except Exception as exc:
+            yield from self._record_timings(timings, exc)
+            raise
+        yield from self._record_timings(timings)
+
+        return self
+
+    @asyncio.coroutine
+    def _shutdown(self, timings, force, wait, timeout):
+        '''Shutdown domain, recording *timings* of phases
+
+        Time spent in event handlers is recorded only for the part done with
+        self.startup_lock held, as :py:attr:`handler_timings` is shared with
+        :py:meth:`start`.
+        '''
         yield from self.fire_event_async('domain-pre-shutdown', pre_event=True,
             force=force)
+        timings.mark('domain-pre-shutdown')
 
         self.libvirt_domain.shutdown()
+        timings.mark('libvirt-shutdown')
 
         if wait:
             if timeout is None:
@@ -1188,14 +1488,17 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             while timeout > 0 and not self.is_halted():
                 yield from asyncio.sleep(0.25)
                 timeout -= 0.25
+            timings.mark('wait')
             with (yield from self.startup_lock):
-                if self.is_halted():
+                if not self.is_halted():
+                    raise qubes.exc.QubesVMShutdownTimeoutError(self)
+                self.handler_timings = timings.handlers
+                try:
                     # make sure all shutdown tasks are completed
                     yield from self._ensure_shutdown_handled()
-                else:
-                    raise qubes.exc.QubesVMShutdownTimeoutError(self)
-
-        return self
+                finally:
+                    self.handler_timings = None
+                timings.mark('domain-shutdown')
 
     @asyncio.coroutine
     def kill(self):
@@ -1455,10 +1758,13 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 return False
         return True
 
-    def request_memory(self, mem_required=None):
-        if not qmemman_present:
-            return None
+    def get_mem_required(self, mem_required=None):
+        '''Memory needed to start this domain, including Xen overhead
 
+        :param int mem_required: memory of the domain itself, in bytes \
+            (default: based on :py:attr:`memory`)
+        :returns: memory in bytes
+        '''
         if mem_required is None:
             if self.virt_mode == 'hvm':
                 if self.stubdom_mem:
@@ -1475,10 +1781,16 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             initial_memory = self.memory
             mem_required = int(initial_memory + stubdom_mem) * 1024 * 1024
 
+        return mem_required + MEM_OVERHEAD_BASE \
+            + self.vcpus * MEM_OVERHEAD_PER_VCPU
+
+    def request_memory(self, mem_required=None):
+        if not qmemman_present:
+            return None
+
+        mem_required_with_overhead = self.get_mem_required(mem_required)
         qmemman_client = qubes.qmemman.client.QMemmanClient()
         try:
-            mem_required_with_overhead = mem_required + MEM_OVERHEAD_BASE \
-                + self.vcpus * MEM_OVERHEAD_PER_VCPU
             got_memory = qmemman_client.request_memory(
                 mem_required_with_overhead)
 
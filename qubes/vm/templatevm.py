@@ -25,6 +25,7 @@ import warnings
 
 import qubes
 import qubes.config
+import qubes.events
 import qubes.vm.qubesvm
 import qubes.vm.mix.net
 from qubes.config import defaults
@@ -48,9 +49,11 @@ class TemplateVM(QubesVM):
         ''' Returns a generator containing all domains based on the current
             TemplateVM.
         '''
-        for vm in self.app.domains:
-            if hasattr(vm, 'template') and vm.template is self:
-                yield vm
+        domains = self.app.domains
+        if isinstance(domains, qubes.app.VMCollection):
+            return iter(domains.get_dependents(self, 'template'))
+        return (vm for vm in domains
+            if hasattr(vm, 'template') and vm.template is self)
 
     netvm = qubes.VMProperty('netvm', load_stage=4, allow_none=True,
         default=None,
@@ -94,3 +97,12 @@ class TemplateVM(QubesVM):
             }
         }
         super(TemplateVM, self).__init__(*args, **kwargs)
+
+    @qubes.events.handler('domain-shutdown', 'domain-volume-import-end')
+    def on_dispvm_pool_template_changed(self, event, **kwargs):
+        ''' Replace qubes in pools of DispVMs based on this template, as they
+        were started from the old root volume.
+        '''  # pylint: disable=unused-argument
+        # imported here, like in qubes.vm.appvm
+        import qubes.vm.dispvm  # pylint: disable=redefined-outer-name
+        qubes.vm.dispvm.DispVMPool.recycle_based_on(self)